@@ -0,0 +1,302 @@
+#!/usr/bin/python2.7
+"""
+Copyright (C) 2014 Reinventing Geospatial, Inc.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>,
+or write to the Free Software Foundation, Inc., 59 Temple Place -
+Suite 330, Boston, MA 02111-1307, USA.
+
+   Requires: sqlite3, argparse
+Description: Exports a tile table of a geopackage into a TMS or WMTS
+ folder of z/x/y files, the reverse of tiles2gpkg_parallel.py.  The tiles
+ keep the bytes they were stored with, so a folder packaged with
+ -imagery source comes back unchanged.  A geopackage does not record the
+ file names of the tiles, so the extension comes from the format of each
+ blob: .png, or .jpg for JPEGs unless -jpeg-ext jpeg is given, which a
+ folder of .jpeg files needs to round-trip exactly.
+
+Version:
+"""
+
+from argparse import ArgumentParser
+from errno import EEXIST
+from multiprocessing import cpu_count, Pool
+from multiprocessing.pool import ThreadPool
+from os import makedirs
+from os.path import join
+from sqlite3 import connect
+from sys import stdout
+from time import time
+from tiles2gpkg_parallel import GeopackageReader, progress_line, \
+    sniff_format
+
+# Each worker process exports chunks of whole tile rows of about
+# EXPORT_CHUNK_TILES tiles, reading them through a memory map of up to
+# EXPORT_MMAP_SIZE bytes of the geopackage, and writes the files of a chunk
+# with EXPORT_WRITERS threads, since file creation is I/O bound
+EXPORT_CHUNK_TILES = 2048
+EXPORT_MMAP_SIZE = 1024 * 1024 * 1024
+EXPORT_WRITERS = 8
+# File extensions of the tile formats; other blobs are written as .png, the
+# tiles2gpkg_parallel.py default.  JPEGs can also be written as .jpeg
+# (-jpeg-ext), the other extension tiles2gpkg_parallel.py reads
+EXTENSIONS = {'png': '.png', 'jpeg': '.jpg'}
+JPEG_EXTENSIONS = ('jpg', 'jpeg')
+# Per-worker (geopackage, table name, tile origin) key and GeopackageReader,
+# and writer thread pool, created by export_chunk()
+_READER = None
+_WRITERS = None
+
+
+def row_chunks(file_path, table_name, size=EXPORT_CHUNK_TILES):
+    """
+    Split a tile table into chunks of consecutive tile rows of one zoom
+    level, each holding about size tiles.  The tile counts come from the
+    (zoom_level, tile_column, tile_row) index, not the tiles.
+
+    Inputs:
+    file_path -- the path of the geopackage database
+    table_name -- the name of the tile table
+    size -- the number of tiles to aim for in each chunk
+
+    Returns:
+    A list of (zoom level, first row, last row, tiles) tuples.
+    """
+    db_con = connect(file_path)
+    try:
+        rows = db_con.execute("""
+            SELECT zoom_level, tile_row, count(*) FROM """ + table_name + """
+            GROUP BY zoom_level, tile_row ORDER BY zoom_level, tile_row;
+        """).fetchall()
+    finally:
+        db_con.close()
+    chunks = []
+    for zoom, row, count in rows:
+        if chunks and chunks[-1][0] == zoom and chunks[-1][3] < size:
+            chunks[-1] = (zoom, chunks[-1][1], row, chunks[-1][3] + count)
+        else:
+            chunks.append((zoom, row, row, count))
+    return chunks
+
+
+def make_folders(reader, table_name, out_folder):
+    """
+    Create the z/x folders of every tile column of a tile table up front,
+    so the writers only create files.
+
+    Inputs:
+    reader -- a GeopackageReader of the tile table
+    table_name -- the name of the tile table
+    out_folder -- the root of the TMS or WMTS folder
+
+    Returns:
+    The number of folders.
+    """
+    db_con = connect(reader.file_path)
+    try:
+        columns = db_con.execute("""
+            SELECT DISTINCT zoom_level, tile_column FROM """ + table_name +
+                                 ";").fetchall()
+    finally:
+        db_con.close()
+    for zoom, column in columns:
+        z, x, _ = reader.tile_coordinates(zoom, column, 0)
+        try:
+            makedirs(join(out_folder, str(z), str(x)))
+        except OSError as err:
+            if err.errno != EEXIST:
+                raise
+    return len(columns)
+
+
+def write_tile(item):
+    """
+    Write one tile file and return its size.
+
+    Inputs:
+    item -- a (file path, data) tuple
+    """
+    file_path, data = item
+    with open(file_path, 'wb') as tile_file:
+        tile_file.write(data)
+    return len(data)
+
+
+def export_chunk(chunk, extra_args):
+    """
+    Worker function that writes the tiles of a chunk of tile rows.
+
+    Inputs:
+    chunk -- a (zoom level, first row, last row, tiles) tuple from
+             row_chunks()
+    extra_args -- dictionary with the geopackage, table name, tile origin,
+                  output folder, writer thread count and the extension of
+                  JPEG files
+
+    Returns:
+    A (tiles, bytes) tuple.
+    """
+    global _READER, _WRITERS
+    key = extra_args['gpkg'], extra_args['table_name'], \
+        extra_args['lower_left']
+    if _READER is None or _READER[0] != key:
+        if _READER is not None:
+            _READER[1].close()
+        _READER = key, GeopackageReader(*key, connections=1, cache_bytes=0,
+                                        mmap_size=EXPORT_MMAP_SIZE)
+    if _WRITERS is None or _WRITERS[0] != extra_args['writers']:
+        _WRITERS = extra_args['writers'], ThreadPool(extra_args['writers'])
+    root = extra_args['out_folder']
+    extensions = dict(EXTENSIONS,
+                      jpeg='.' + extra_args.get('jpeg_ext', 'jpg'))
+    items = [(join(root, str(z), str(x),
+                   str(y) + extensions.get(sniff_format(data), '.png')), data)
+             for z, x, y, data in _READER[1].iter_rows(*chunk[:3])]
+    written = sum(_WRITERS[1].map(write_tile, items,
+                                  max(1, len(items) //
+                                      (4 * extra_args['writers']))))
+    return len(items), written
+
+
+def init_export_worker():
+    """
+    Pool initializer that drops the reader and writer threads a forked
+    worker process may have inherited from its parent, since the threads
+    of a pool do not survive the fork.
+    """
+    global _READER, _WRITERS
+    _READER = _WRITERS = None
+
+
+def close_export_worker():
+    """Close the reader and stop the writer threads of this process."""
+    if _READER is not None:
+        _READER[1].close()
+    if _WRITERS is not None:
+        _WRITERS[1].close()
+        _WRITERS[1].join()
+    init_export_worker()
+
+
+def _export_chunk(args):
+    """Unpack the arguments of export_chunk() for Pool.imap_unordered()."""
+    return export_chunk(*args)
+
+
+def main(arg_list):
+    """
+    Export a tile table of a geopackage into a folder of z/x/y tiles.
+
+    Inputs:
+    arg_list -- the parsed command line
+    """
+    lower_left = arg_list.tileorigin in ('ll', 'sw')
+    with GeopackageReader(arg_list.gpkg, arg_list.table_name, lower_left,
+                          connections=1, cache_bytes=0) as reader:
+        folders = make_folders(reader, arg_list.table_name,
+                               arg_list.out_folder)
+    chunks = row_chunks(arg_list.gpkg, arg_list.table_name)
+    total = sum(chunk[3] for chunk in chunks)
+    print("Exporting {} tiles in {} chunks into {} folders...".format(
+        total, len(chunks), folders))
+    extra_args = dict(gpkg=arg_list.gpkg, table_name=arg_list.table_name,
+                      lower_left=lower_left, out_folder=arg_list.out_folder,
+                      writers=arg_list.writers, jpeg_ext=arg_list.jpeg_ext)
+    start = time()
+    done = written = 0
+    if not arg_list.threading:
+        # Debugging call to bypass multiprocessing (-T)
+        results = (export_chunk(chunk, extra_args) for chunk in chunks)
+        pool = None
+    else:
+        pool = Pool(arg_list.processes or cpu_count(), init_export_worker)
+        # Start with the biggest chunks so that none is left to run alone
+        # at the end
+        results = pool.imap_unordered(
+            _export_chunk, [(chunk, extra_args) for chunk in
+                            sorted(chunks, key=lambda chunk: -chunk[3])])
+    try:
+        for tiles, size in results:
+            done += tiles
+            written += size
+            stdout.write("\rExport: " + progress_line(
+                done, total, time() - start, bytes_out=written))
+            stdout.flush()
+    except KeyboardInterrupt:
+        print(" Interrupted!")
+        if pool is not None:
+            pool.terminate()
+        exit(1)
+    if pool is not None:
+        pool.close()
+        pool.join()
+    else:
+        close_export_worker()
+    print(" All Done!")
+    return done
+
+
+if __name__ == '__main__':
+    print("""
+        gpkg2tiles_parallel.py  Copyright (C) 2014  Reinventing Geospatial, Inc
+        This program comes with ABSOLUTELY NO WARRANTY.
+        This is free software, and you are welcome to redistribute it
+        under certain conditions.
+    """)
+    PARSER = ArgumentParser(description="Convert geopackage into TMS folder")
+    PARSER.add_argument("gpkg",
+                        metavar="source",
+                        help="Source geopackage.")
+    PARSER.add_argument("out_folder",
+                        metavar="dest",
+                        help="Destination folder of the tiles.")
+    PARSER.add_argument("-table",
+                        metavar="table_name",
+                        dest="table_name",
+                        help="Tile table to export.",
+                        default="tiles")
+    PARSER.add_argument("-tileorigin",
+                        metavar="tile_origin",
+                        help="Tile point of origin location. Valid options " +
+                        "are ll, ul, nw, or sw.",
+                        choices=["ll", "ul", "sw", "nw"],
+                        default="ll")
+    PARSER.add_argument("-jpeg-ext",
+                        dest="jpeg_ext",
+                        metavar="ext",
+                        help="File extension of JPEG tiles, jpg or jpeg. " +
+                        "The geopackage does not record the extension of " +
+                        "the source files, so a folder of .jpeg tiles " +
+                        "only comes back unchanged with -jpeg-ext jpeg. " +
+                        "Default is jpg.",
+                        choices=JPEG_EXTENSIONS,
+                        default="jpg")
+    PARSER.add_argument("-processes",
+                        metavar="processes",
+                        help="Number of worker processes, one per core by " +
+                        "default.",
+                        type=int,
+                        default=0)
+    PARSER.add_argument("-writers",
+                        metavar="threads",
+                        help="Number of threads writing files in each " +
+                        "worker process.",
+                        type=int,
+                        default=EXPORT_WRITERS)
+    PARSER.add_argument("-T",
+                        dest="threading",
+                        action="store_false",
+                        default=True,
+                        help="Disable multiprocessing.")
+    main(PARSER.parse_args())
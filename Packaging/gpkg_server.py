@@ -0,0 +1,317 @@
+#!/usr/bin/python3
+"""
+Copyright (C) 2014 Reinventing Geospatial, Inc.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>,
+or write to the Free Software Foundation, Inc., 59 Temple Place -
+Suite 330, Boston, MA 02111-1307, USA.
+
+   Requires: Python 3.7 or later, sqlite3
+Description: Serves the tile tables of one or more geopackages over HTTP as
+ /{table}/{z}/{x}/{y} URLs, for map clients on networks without a tile
+ service.  Uses nothing outside the standard library and
+ tiles2gpkg_parallel.py.
+
+Version:
+"""
+
+from argparse import ArgumentParser
+from asyncio import IncompleteReadError, LimitOverrunError, TimeoutError, \
+    run, shield, start_server, wait_for, wrap_future
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate
+from hashlib import sha1
+from sqlite3 import connect
+from tiles2gpkg_parallel import BlobCache, GeopackageReader, sniff_format
+
+# Tiles are read from the geopackages by SERVER_THREADS threads, each with its
+# own connection, and SERVER_CACHE_BYTES of the served tiles are kept in
+# memory for all tables together
+SERVER_THREADS = 8
+SERVER_CACHE_BYTES = 256 * 1024 * 1024
+# Cache-Control max-age of tile responses, in seconds
+SERVER_MAX_AGE = 3600
+# Seconds an idle keep-alive connection is kept open, and the size limit of
+# the request line and headers
+KEEP_ALIVE_SECONDS = 15
+MAX_HEADER_BYTES = 16384
+CONTENT_TYPES = {'png': 'image/png', 'jpeg': 'image/jpeg'}
+REASONS = {200: 'OK', 304: 'Not Modified', 400: 'Bad Request',
+           404: 'Not Found', 405: 'Method Not Allowed'}
+
+
+def tile_tables(file_path):
+    """
+    Return the names of the tile tables of a geopackage.
+
+    Inputs:
+    file_path -- the path of the geopackage database
+    """
+    db_con = connect(file_path)
+    try:
+        return [name for (name,) in db_con.execute("""
+            SELECT table_name FROM gpkg_contents WHERE data_type = 'tiles'
+            ORDER BY table_name;""")]
+    finally:
+        db_con.close()
+
+
+def parse_path(path):
+    """
+    Split a request path into (table, z, x, y), or return None if it is not
+    a tile path.  A file extension on the tile row is ignored, and so is the
+    query string.
+
+    Inputs:
+    path -- the path of the request, e.g. /tiles/3/2/5.png
+    """
+    parts = path.split('?', 1)[0].strip('/').split('/')
+    if len(parts) != 4:
+        return None
+    parts[3] = parts[3].split('.', 1)[0]
+    try:
+        return (parts[0],) + tuple(int(part) for part in parts[1:])
+    except ValueError:
+        return None
+
+
+class TileServer(object):
+    """
+    Asyncio HTTP/1.1 server for the tile tables of one or more geopackages.
+    Cached tiles are answered on the event loop; the others are read by a
+    thread pool, and requests for a tile that is being read already wait
+    for that read instead of starting another one.
+    """
+
+    def __init__(self, file_paths, lower_left=False, threads=SERVER_THREADS,
+                 cache_bytes=SERVER_CACHE_BYTES, max_age=SERVER_MAX_AGE):
+        """
+        Constructor.
+
+        Inputs:
+        file_paths -- the paths of the geopackages to serve
+        lower_left -- bool indicating tile grid numbering scheme (tms or
+                      wmts) of the URLs; XYZ clients number rows from the top
+        threads -- the number of threads reading tiles
+        cache_bytes -- the total size of the tiles kept in memory
+        max_age -- the Cache-Control max-age of tile responses
+        """
+        self.readers = {}
+        self.__executor = ThreadPoolExecutor(threads)
+        for file_path in file_paths:
+            for table in tile_tables(file_path):
+                if table in self.readers:
+                    self.close()
+                    raise ValueError("{} and {} both have a {} table".format(
+                        self.readers[table].file_path, file_path, table))
+                # The server caches the responses itself
+                self.readers[table] = GeopackageReader(
+                    file_path, table, lower_left, connections=threads,
+                    cache_bytes=0)
+        self.max_age = max_age
+        self.__cache = BlobCache(cache_bytes)
+        self.__pending = {}
+
+    async def tile(self, table, z, x, y):
+        """
+        Return the (etag, content type, data) of a tile, or None if there is
+        no such tile.
+        """
+        key = (table, z, x, y)
+        if key in self.__cache:
+            return self.__cache.get(key)
+        if key not in self.__pending:
+            self.__pending[key] = wrap_future(self.__executor.submit(
+                self.readers[table].get_tile, z, x, y))
+        future = self.__pending[key]
+        try:
+            # A client that hangs up must not cancel the read for the others
+            data = await shield(future)
+        finally:
+            self.__pending.pop(key, None)
+        if data is None:
+            return None
+        if key in self.__cache:
+            return self.__cache.get(key)
+        entry = ('"' + sha1(data).hexdigest() + '"',
+                 CONTENT_TYPES.get(sniff_format(data),
+                                   'application/octet-stream'), data)
+        return self.__cache.put(key, entry, len(data))
+
+    async def respond(self, method, path, headers):
+        """
+        Return the status, extra headers and body of the response to a
+        request.
+        """
+        if method not in ('GET', 'HEAD'):
+            return 405, [('Allow', 'GET, HEAD')], b''
+        request = parse_path(path)
+        if request is None:
+            return 400, [], b''
+        if request[0] not in self.readers:
+            return 404, [], b''
+        entry = await self.tile(*request)
+        if entry is None:
+            return 404, [], b''
+        etag, content_type, data = entry
+        cache_headers = [('ETag', etag), ('Cache-Control',
+                                          'max-age={}'.format(self.max_age))]
+        if_none_match = headers.get('if-none-match', '')
+        if etag in if_none_match or if_none_match.strip() == '*':
+            return 304, cache_headers, b''
+        return 200, [('Content-Type', content_type)] + cache_headers, data
+
+    async def handle(self, reader, writer):
+        """Serve the requests on one connection until it is closed."""
+        try:
+            while True:
+                try:
+                    head = await self.__read_head(reader)
+                except (IncompleteReadError, LimitOverrunError,
+                        ConnectionError, TimeoutError):
+                    break
+                lines = head.decode('latin-1').split('\r\n')
+                request = lines[0].split()
+                headers = {}
+                for line in lines[1:]:
+                    name, _, value = line.partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                if len(request) != 3:
+                    await self.__send(writer, 400, [], b'', False)
+                    break
+                method, path, version = request
+                length = headers.get('content-length', '0')
+                if not length.isdigit():
+                    await self.__send(writer, 400, [], b'', False)
+                    break
+                length = int(length)
+                if length:
+                    await reader.readexactly(length)
+                connection = headers.get('connection', '').lower()
+                keep_alive = connection == 'keep-alive' if \
+                    version == 'HTTP/1.0' else connection != 'close'
+                status, extra, body = await self.respond(method, path,
+                                                         headers)
+                await self.__send(writer, status, extra,
+                                  b'' if method == 'HEAD' else body,
+                                  keep_alive, len(body))
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def __read_head(reader):
+        """Read the request line and headers of the next request."""
+        return await wait_for(reader.readuntil(b'\r\n\r\n'),
+                              KEEP_ALIVE_SECONDS)
+
+    @staticmethod
+    async def __send(writer, status, headers, body, keep_alive, length=None):
+        """Write a response and wait until the transport can take more."""
+        head = ['HTTP/1.1 {} {}'.format(status, REASONS[status]),
+                'Date: ' + formatdate(usegmt=True),
+                'Content-Length: {}'.format(len(body) if length is None
+                                            else length),
+                'Connection: ' + ('keep-alive' if keep_alive else 'close')]
+        head += ['{}: {}'.format(name, value) for name, value in headers]
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') +
+                     body)
+        await writer.drain()
+
+    async def start(self, host, port):
+        """Start listening and return the asyncio server."""
+        return await start_server(self.handle, host, port,
+                                  limit=MAX_HEADER_BYTES)
+
+    def stats(self):
+        """Return the cache statistics of the served tiles."""
+        hits, misses = self.__cache.hits, self.__cache.misses
+        return dict(hits=hits, misses=misses,
+                    hit_rate=float(hits) / (hits + misses)
+                    if hits + misses else 0.0,
+                    cached_tiles=len(self.__cache),
+                    cached_bytes=self.__cache.size)
+
+    def close(self):
+        """Stop the reading threads and close the geopackages."""
+        self.__executor.shutdown()
+        for reader in self.readers.values():
+            reader.close()
+
+
+async def serve(arg_list):
+    """Serve the geopackages until the process is stopped."""
+    tile_server = TileServer(arg_list.files,
+                             arg_list.tileorigin in ('ll', 'sw'),
+                             arg_list.threads,
+                             arg_list.cache * 1024 * 1024,
+                             arg_list.max_age)
+    try:
+        server = await tile_server.start(arg_list.host, arg_list.port)
+        for table, reader in sorted(tile_server.readers.items()):
+            print("Serving {} from {} at http://{}:{}/{}/{{z}}/{{x}}/{{y}}"
+                  .format(table, reader.file_path, arg_list.host,
+                          arg_list.port, table))
+        async with server:
+            await server.serve_forever()
+    finally:
+        tile_server.close()
+
+
+if __name__ == '__main__':
+    PARSER = ArgumentParser(description="Serve geopackage tiles over HTTP")
+    PARSER.add_argument("files",
+                        metavar="gpkg",
+                        nargs="+",
+                        help="Geopackages to serve. Each tile table is " +
+                        "served as /table/z/x/y.")
+    PARSER.add_argument("-host",
+                        metavar="host",
+                        help="Address to listen on.",
+                        default="127.0.0.1")
+    PARSER.add_argument("-port",
+                        metavar="port",
+                        help="Port to listen on.",
+                        type=int,
+                        default=8080)
+    PARSER.add_argument("-tileorigin",
+                        metavar="tile_origin",
+                        help="Tile point of origin location of the URLs. " +
+                        "Valid options are ll, ul, nw, or sw.",
+                        choices=["ll", "ul", "sw", "nw"],
+                        default="ul")
+    PARSER.add_argument("-threads",
+                        metavar="threads",
+                        help="Number of threads reading tiles.",
+                        type=int,
+                        default=SERVER_THREADS)
+    PARSER.add_argument("-cache",
+                        metavar="megabytes",
+                        help="Memory for cached tiles, in megabytes.",
+                        type=int,
+                        default=SERVER_CACHE_BYTES // (1024 * 1024))
+    PARSER.add_argument("-max-age",
+                        metavar="seconds",
+                        dest="max_age",
+                        help="Cache-Control max-age of tile responses.",
+                        type=int,
+                        default=SERVER_MAX_AGE)
+    ARG_LIST = PARSER.parse_args()
+    try:
+        run(serve(ARG_LIST))
+    except KeyboardInterrupt:
+        pass
@@ -36,7 +36,7 @@ try:
     from cStringIO import StringIO as ioBuffer
 except ImportError:
     from io import BytesIO as ioBuffer
-from time import sleep
+from time import sleep, time
 from uuid import uuid4
 from sys import stdout
 from sys import version_info
@@ -46,10 +46,37 @@ from operator import attrgetter
 from sqlite3 import connect, Error
 from argparse import ArgumentParser
 from sqlite3 import Binary as sbinary
-from os import walk, remove
-from os.path import split, join, exists
-from multiprocessing import cpu_count, Pool
-from math import pi, sin, log, tan, atan, sinh, degrees
+from os import getpid, listdir, remove, stat, fsync
+try:
+    from os import replace
+except ImportError:
+    from os import rename as replace
+try:
+    from os import scandir
+except ImportError:
+    scandir = None
+from os.path import split, join, exists, getsize, isdir, abspath
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from contextlib import contextmanager
+from cProfile import Profile
+from functools import partial
+from hashlib import sha1
+from json import dumps, loads
+from itertools import chain
+from mmap import mmap, ACCESS_READ
+from multiprocessing import cpu_count, Array, Pool, Process, Queue
+from multiprocessing.util import Finalize
+from multiprocessing.pool import ThreadPool
+from math import pi, sin, log, tan, atan, sinh, degrees, floor, ceil
+from pstats import Stats
+from re import match
+from threading import Lock, Semaphore
+try:
+    from urllib.request import pathname2url
+except ImportError:
+    from urllib import pathname2url
 try:
     from PIL.Image import open as IOPEN
 except ImportError:
@@ -59,6 +86,79 @@ except ImportError:
 # PNGs should be used sparingly (mixed mode) due to their high disk usage RGBA
 # Options are mixed, jpeg, and png
 IMAGE_TYPES = '.png', '.jpeg', '.jpg'
+# Leading bytes that identify encoded tiles that can be stored as they are
+IMAGE_SIGNATURES = ((b'\x89PNG\r\n\x1a\n', 'png'),
+                    (b'\xff\xd8\xff', 'jpeg'))
+# Directory listings are I/O bound (especially on network file systems), so
+# the tile scanner uses more threads than there are cores
+SCAN_THREADS = 16
+# The scheduler sizes each chunk of tiles handed to a worker so that it takes
+# about CHUNK_SECONDS to process, within these bounds; the first chunks are
+# small so costs are measured early
+CHUNK_SECONDS = 10.0
+CHUNK_INITIAL = 256
+CHUNK_MIN = 64
+CHUNK_MAX = 65536
+# Worker databases buffer tiles and write them in one transaction once either
+# of these limits is reached
+BATCH_TILES = 1000
+BATCH_BYTES = 32 * 1024 * 1024
+# Each worker process writes the chunks of a tile table into one .gpkg.part
+# file, and starts a new one once it holds PART_BYTES
+PART_BYTES = 1024 * 1024 * 1024
+# Per-worker TempDB of each tile table, kept open by worker_part()
+_PART_DBS = {}
+# Number of tile batches that may wait for the single writer process before
+# workers block
+WRITER_QUEUE_SIZE = 16
+# Queue to the single writer process, set in each pool worker
+_WRITER_QUEUE = None
+# Memory budget of the per-worker cache of encoded tiles
+ENCODE_CACHE_BYTES = 64 * 1024 * 1024
+# Per-worker EncodeCache, created by sqlite_worker()
+_ENCODE_CACHE = None
+# Workers add their progress to the shared counters every PROGRESS_TILES
+# tiles, and the parent redraws the progress line every PROGRESS_INTERVAL
+# seconds
+PROGRESS_TILES = 256
+PROGRESS_INTERVAL = 0.25
+# ProgressCounters shared with the parent, set in each pool worker
+_PROGRESS = None
+# Stages of worker_map() whose wall-clock time is measured when a run is
+# profiled, and the per-worker StageTimers and cProfile profiler, created by
+# sqlite_worker() in that case
+WORKER_STAGES = ('read', 'cache', 'decode', 'transparency', 'encode',
+                 'insert')
+_STAGE_TIMERS = None
+_PROFILER = None
+# Number of scanned tiles recorded by a Manifest in one transaction
+MANIFEST_BATCH = 10000
+# Output geopackages are built with a page cache of BUILD_CACHE_KIB
+# kilobytes and a memory map of BUILD_MMAP_SIZE bytes
+BUILD_CACHE_KIB = 256 * 1024
+BUILD_MMAP_SIZE = 256 * 1024 * 1024
+# The page size of a new geopackage is a power of two from MIN_PAGE_SIZE to
+# MAX_PAGE_SIZE, chosen for the median size of PAGE_SIZE_SAMPLE tiles in
+# PAGE_SIZE_COLUMNS columns of the deepest zoom level, where most tiles are.
+# Of the page sizes that store it within PAGE_SIZE_SLACK of the smallest
+# file, the one that reads it with the fewest pages is used
+MIN_PAGE_SIZE = 4096
+MAX_PAGE_SIZE = 65536
+PAGE_SIZE_SAMPLE = 256
+PAGE_SIZE_COLUMNS = 16
+PAGE_SIZE_SLACK = 0.1
+# A GeopackageReader keeps up to READER_CONNECTIONS read-only connections for
+# the threads that read from it, maps up to READER_MMAP_SIZE bytes of the
+# file in each, and caches up to READER_CACHE_BYTES of tile blobs
+READER_CONNECTIONS = 8
+READER_MMAP_SIZE = 256 * 1024 * 1024
+READER_CACHE_BYTES = 64 * 1024 * 1024
+# Number of tiles looked up in one statement by GeopackageReader.get_tiles(),
+# within the 999 host parameters older SQLite versions allow
+READER_BATCH = 256
+# Number of tiles the GeopackageReader iterators read at a time; the
+# connection goes back to the pool between batches
+READER_SCAN_BATCH = 256
 
 
 class Mercator(object):
@@ -485,34 +585,139 @@ class ZoomMetadata(object):
         self.__matrix_height = value
 
 
+def hilbert_index(order, x, y):
+    """
+    Returns the position of a tile along a Hilbert curve covering a
+    2^order by 2^order grid.  Tiles that are close on the curve are close on
+    the map, so it makes a good storage order for tiles read by area.
+
+    Inputs:
+    order -- the number of bits needed for the largest x or y value
+    x -- the tile column
+    y -- the tile row
+    """
+    index = 0
+    side = 1 << order
+    step = side >> 1
+    while step > 0:
+        rx = 1 if x & step else 0
+        ry = 1 if y & step else 0
+        index += step * step * ((3 * rx) ^ ry)
+        # Rotate the quadrant so the sub-curve lines up with its neighbours
+        if ry == 0:
+            if rx == 1:
+                x = side - 1 - x
+                y = side - 1 - y
+            x, y = y, x
+        step >>= 1
+    return index
+
+
+def get_projection(srs):
+    """
+    Return the projection object of a spatial reference system.
+
+    Inputs:
+    srs -- the spatial reference system of the tiles
+    """
+    if srs == 3857:
+        return Mercator()
+    elif srs == 3395:
+        return EllipsoidalMercator()
+    elif srs == 9804:
+        return ScaledWorldMercator()
+    return Geodetic()
+
+
+def tile_span(projection, zoom):
+    """
+    Return the coordinates of the bottom-left corner of the tile grid and the
+    width and height of one tile at the given zoom level.
+
+    Inputs:
+    projection -- a projection object returned by get_projection()
+    zoom -- the zoom level
+    """
+    min_x, min_y = projection.get_coord(zoom, 0, 0)
+    span = projection.get_coord(zoom, 1, 0)[0] - min_x
+    # Tiles are square in every supported projection, and the northings
+    # of the ellipsoidal projections are only found numerically
+    return min_x, min_y, span, span
+
+
 class Geopackage(object):
-    """Object representing a GeoPackage container."""
+    """
+    Object representing a tile pyramid in a GeoPackage container.  Several
+    Geopackage objects with different table names can share one file.
+    """
 
     def __enter__(self):
         """With-statement caller"""
         return self
 
-    def __init__(self, file_path, srs):
-        """Constructor."""
+    def __init__(self, file_path, srs, append=False, table_name='tiles',
+                 page_size=None):
+        """
+        Constructor.
+
+        Inputs:
+        file_path -- the path of the geopackage database
+        srs -- the spatial reference system of the tiles
+        append -- open an existing geopackage made by this script to add
+                  tiles to it, instead of creating a new one
+        table_name -- the name of the tile table; a new one is added to the
+                      geopackage if it has other tile tables already
+        page_size -- the page size of a new geopackage file (see
+                     choose_page_size()); a file that has tables already
+                     keeps its page size
+        """
+        if append and not exists(file_path):
+            raise IOError("{} does not exist".format(file_path))
         self.__file_path = file_path
         self.__srs = srs
-        if self.__srs == 3857:
-            self.__projection = Mercator()
-        elif self.__srs == 3395:
-            self.__projection = EllipsoidalMercator()
-        elif self.__srs == 9804:
-            self.__projection = ScaledWorldMercator()
-        else:
-            self.__projection = Geodetic()
+        self.__table = table_name
+        self.__projection = get_projection(self.__srs)
+        self.__page_size = page_size
         self.__db_con = connect(self.__file_path)
-        self.__create_schema()
+        if page_size is not None:
+            # Only takes effect before the first table is created
+            self.__db_con.execute("pragma page_size = {};".format(page_size))
+        self.__db_con.execute("pragma cache_size = -{};".format(
+            BUILD_CACHE_KIB))
+        self.__db_con.execute("pragma mmap_size = {};".format(
+            BUILD_MMAP_SIZE))
+        self.__bulk_path = None
+        if append:
+            self.__check_schema()
+        else:
+            self.__create_schema()
+
+    def __check_schema(self):
+        """Make sure an existing geopackage can take more tiles."""
+        try:
+            row = self.__db_con.execute("""
+                SELECT srs_id FROM gpkg_contents
+                WHERE table_name = ?;""", (self.__table,)).fetchone()
+        except Error:
+            row = None
+        if row is None:
+            self.__db_con.close()
+            raise ValueError("{} has no {} table to append to".format(
+                self.__file_path, self.__table))
+        if row[0] != self.__srs:
+            self.__db_con.close()
+            raise ValueError("{} uses srs {}, not {}".format(
+                self.__file_path, row[0], self.__srs))
 
     def __create_schema(self):
-        """Create default geopackage schema on the database."""
+        """
+        Create default geopackage schema on the database, or add another
+        tile table to it.
+        """
         with self.__db_con as db_con:
             cursor = db_con.cursor()
             cursor.execute("""
-                CREATE TABLE gpkg_contents (
+                CREATE TABLE IF NOT EXISTS gpkg_contents (
                     table_name TEXT NOT NULL PRIMARY KEY,
                     data_type TEXT NOT NULL,
                     identifier TEXT UNIQUE,
@@ -528,7 +733,7 @@ class Geopackage(object):
                         REFERENCES gpkg_spatial_ref_sys(srs_id));
             """)
             cursor.execute("""
-                CREATE TABLE gpkg_spatial_ref_sys (
+                CREATE TABLE IF NOT EXISTS gpkg_spatial_ref_sys (
                     srs_name TEXT NOT NULL,
                     srs_id INTEGER NOT NULL PRIMARY KEY,
                     organization TEXT NOT NULL,
@@ -537,7 +742,7 @@ class Geopackage(object):
                     description TEXT);
             """)
             cursor.execute("""
-                CREATE TABLE gpkg_tile_matrix (
+                CREATE TABLE IF NOT EXISTS gpkg_tile_matrix (
                     table_name TEXT NOT NULL,
                     zoom_level INTEGER NOT NULL,
                     matrix_width INTEGER NOT NULL,
@@ -551,7 +756,7 @@ class Geopackage(object):
                         REFERENCES gpkg_contents(table_name));
             """)
             cursor.execute("""
-                CREATE TABLE gpkg_tile_matrix_set (
+                CREATE TABLE IF NOT EXISTS gpkg_tile_matrix_set (
                     table_name TEXT NOT NULL PRIMARY KEY,
                     srs_id INTEGER NOT NULL,
                     min_x DOUBLE NOT NULL,
@@ -564,7 +769,7 @@ class Geopackage(object):
                         REFERENCES gpkg_spatial_ref_sys(srs_id));
             """)
             cursor.execute("""
-                CREATE TABLE tiles (
+                CREATE TABLE """ + self.__table + """ (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
                     zoom_level INTEGER NOT NULL,
                     tile_column INTEGER NOT NULL,
@@ -587,7 +792,7 @@ class Geopackage(object):
             """
 
             cursor.execute("""
-                INSERT INTO gpkg_spatial_ref_sys (
+                INSERT OR IGNORE INTO gpkg_spatial_ref_sys (
                     srs_id,
                     organization,
                     organization_coordsys_id,
@@ -604,7 +809,7 @@ class Geopackage(object):
             """
 
             cursor.execute("""
-                INSERT INTO gpkg_spatial_ref_sys (
+                INSERT OR IGNORE INTO gpkg_spatial_ref_sys (
                     srs_id,
                     organization,
                     organization_coordsys_id,
@@ -626,7 +831,7 @@ class Geopackage(object):
             """
 
             cursor.execute("""
-                INSERT INTO gpkg_spatial_ref_sys (
+                INSERT OR IGNORE INTO gpkg_spatial_ref_sys (
                     srs_id,
                     organization,
                     organization_coordsys_id,
@@ -648,7 +853,7 @@ class Geopackage(object):
             """
 
             cursor.execute("""
-                INSERT INTO gpkg_spatial_ref_sys (
+                INSERT OR IGNORE INTO gpkg_spatial_ref_sys (
                     srs_id,
                     organization,
                     organization_coordsys_id,
@@ -658,7 +863,7 @@ class Geopackage(object):
             """, ("epsg", "WGS 84 / Scaled World Mercator", wkt))
             wkt = """undefined"""
             cursor.execute("""
-                INSERT INTO gpkg_spatial_ref_sys (
+                INSERT OR IGNORE INTO gpkg_spatial_ref_sys (
                     srs_id,
                     organization,
                     organization_coordsys_id,
@@ -667,7 +872,7 @@ class Geopackage(object):
                 VALUES (-1, ?, -1, ?, ?)
             """, ("NONE", " ", wkt))
             cursor.execute("""
-                INSERT INTO gpkg_spatial_ref_sys (
+                INSERT OR IGNORE INTO gpkg_spatial_ref_sys (
                     srs_id,
                     organization,
                     organization_coordsys_id,
@@ -687,7 +892,8 @@ class Geopackage(object):
                     max_y,
                     srs_id)
                 VALUES (?, ?, ?, ?, 0, 0, 0, 0, ?);
-            """, ("tiles", "tiles", "Raster Tiles",
+            """, (self.__table, "tiles", "Raster Tiles"
+                  if self.__table == 'tiles' else self.__table,
                   "Created by tiles2gpkg_parallel.py, written by S. Lander",
                   self.__srs))
             # Add GP10 to the Sqlite header
@@ -698,6 +904,16 @@ class Geopackage(object):
         """Return the path of the geopackage database on the file system."""
         return self.__file_path
 
+    @property
+    def table_name(self):
+        """Return the name of the tile table."""
+        return self.__table
+
+    @property
+    def page_size(self):
+        """Return the page size of the geopackage file."""
+        return self.__db_con.execute("pragma page_size;").fetchone()[0]
+
     def update_metadata(self, metadata):
         """Update the metadata of the geopackage database after tile merge."""
         # initialize a new projection
@@ -721,7 +937,7 @@ class Geopackage(object):
             for level in metadata:
                 cursor.execute(
                     tile_matrix_stmt,
-                    ("tiles", level.zoom, level.matrix_width,
+                    (self.__table, level.zoom, level.matrix_width,
                      level.matrix_height, self.__projection.tile_size,
                      self.__projection.tile_size,
                      self.__projection.pixel_size(level.zoom),
@@ -732,7 +948,7 @@ class Geopackage(object):
                     min_y = ?,
                     max_x = ?,
                     max_y = ?
-                WHERE table_name = 'tiles';
+                WHERE table_name = ?;
             """
 
             tile_matrix_set_stmt = """
@@ -758,11 +974,189 @@ class Geopackage(object):
             top_level.max_y = top_level.max_y
             # write bounds and matrix set info to table
             cursor.execute(contents_stmt, (top_level.min_x, top_level.min_y,
-                                           top_level.max_x, top_level.max_y))
+                                           top_level.max_x, top_level.max_y,
+                                           self.__table))
             cursor.execute(tile_matrix_set_stmt,
-                           ('tiles', self.__srs, top_level.min_x,
+                           (self.__table, self.__srs, top_level.min_x,
                             top_level.min_y, top_level.max_x, top_level.max_y))
 
+    def __tile_span(self, zoom):
+        """
+        Return the coordinates of the bottom-left corner of the tile grid and
+        the width and height of one tile at the given zoom level.
+        """
+        return tile_span(self.__projection, zoom)
+
+    def append_grid(self, metadata, lower_left):
+        """
+        Fit the tile matrix of this geopackage to a new set of tiles before
+        they are appended.  The tile matrix set grows to cover the existing
+        and the new tiles (on tile boundaries of the coarsest zoom level),
+        and if its top-left corner moves, existing tiles are renumbered.
+
+        Inputs:
+        metadata -- the ZoomMetadata list build_lut() made for the new tiles
+        lower_left -- bool indicating tile grid numbering scheme (tms or wmts)
+
+        Returns:
+        A ZoomMetadata list for the new tiles that numbers them in the tile
+        matrix of this geopackage.
+        """
+        top = min(metadata, key=attrgetter('zoom'))
+        bounds = [top.min_x, top.min_y, top.max_x, top.max_y]
+        zoom = top.zoom
+        with self.__db_con as db_con:
+            old = db_con.execute("""
+                SELECT min_x, min_y, max_x, max_y FROM gpkg_tile_matrix_set
+                WHERE table_name = ?;""", (self.__table,)).fetchone()
+            zooms = [row[0] for row in db_con.execute("""
+                SELECT zoom_level FROM gpkg_tile_matrix
+                WHERE table_name = ? ORDER BY zoom_level;""",
+                                                      (self.__table,))]
+            if old is not None and zooms:
+                bounds = [min(bounds[0], old[0]), min(bounds[1], old[1]),
+                          max(bounds[2], old[2]), max(bounds[3], old[3])]
+                zoom = min(zoom, zooms[0])
+            # Snap the bounds outwards onto the tiles of the coarsest level,
+            # which puts them on tile boundaries at every level; bounds that
+            # are on a boundary already are kept as they are
+            origin_x, origin_y, span_x, span_y = self.__tile_span(zoom)
+
+            def snap(value, origin, span, outwards):
+                """Move a bound outwards onto the nearest tile boundary."""
+                tiles = (value - origin) / span
+                if abs(tiles - round(tiles)) < 1e-6:
+                    return value
+                return origin + outwards(tiles) * span
+            bounds = [snap(bounds[0], origin_x, span_x, floor),
+                      snap(bounds[1], origin_y, span_y, floor),
+                      snap(bounds[2], origin_x, span_x, ceil),
+                      snap(bounds[3], origin_y, span_y, ceil)]
+            manifest = db_con.execute("""
+                SELECT 1 FROM sqlite_master
+                WHERE type = 'table' AND name = ?;""",
+                                      (self.__table + '_manifest',))
+            manifest = manifest.fetchone() is not None
+            if old is not None:
+                for level in zooms:
+                    span_x, span_y = self.__tile_span(level)[2:]
+                    columns = int(round((old[0] - bounds[0]) / span_x))
+                    rows = int(round((bounds[3] - old[3]) / span_y))
+                    if columns or rows:
+                        # Go through negative numbers so that no row hits
+                        # the unique constraint halfway through the update
+                        db_con.execute("""
+                            UPDATE """ + self.__table + """ SET
+                                tile_column = -1 - tile_column - ?,
+                                tile_row = -1 - tile_row - ?
+                            WHERE zoom_level = ?;""", (columns, rows, level))
+                        db_con.execute("""
+                            UPDATE """ + self.__table + """ SET
+                                tile_column = -1 - tile_column,
+                                tile_row = -1 - tile_row
+                            WHERE zoom_level = ?;""", (level,))
+                        if manifest:
+                            # Keep the positions recorded by Manifest in step
+                            db_con.execute("""
+                                UPDATE """ + self.__table + """_manifest SET
+                                    tile_column = tile_column + ?,
+                                    tile_row = tile_row + ?
+                                WHERE zoom_level = ?;""",
+                                           (columns, rows, level))
+            db_con.execute("""
+                INSERT OR REPLACE INTO gpkg_tile_matrix_set (
+                    table_name,
+                    srs_id,
+                    min_x,
+                    min_y,
+                    max_x,
+                    max_y)
+                VALUES (?, ?, ?, ?, ?, ?);""",
+                           [self.__table, self.__srs] + bounds)
+        matrix = []
+        for item in metadata:
+            origin_x, origin_y, span_x, span_y = self.__tile_span(item.zoom)
+            level = ZoomMetadata()
+            level.zoom = item.zoom
+            level.min_x, level.min_y, level.max_x, level.max_y = bounds
+            level.matrix_width = int(round((bounds[2] - bounds[0]) / span_x))
+            level.matrix_height = int(round((bounds[3] - bounds[1]) / span_y))
+            level.min_tile_row = int(round((bounds[0] - origin_x) / span_x))
+            level.max_tile_row = level.min_tile_row + level.matrix_width - 1
+            top_row = int(round((bounds[3] - origin_y) / span_y)) - 1
+            if lower_left:
+                level.max_tile_col = top_row
+                level.min_tile_col = top_row - level.matrix_height + 1
+            else:
+                level.min_tile_col = self.__projection.invert_y(item.zoom,
+                                                                top_row)
+                level.max_tile_col = level.min_tile_col + \
+                    level.matrix_height - 1
+            matrix.append(level)
+        return matrix
+
+    def refresh_metadata(self):
+        """
+        Rebuild the tile matrix and the contents bounds from the tile
+        table, using aggregates over its (zoom_level, tile_column, tile_row)
+        index instead of the source folder.  Used after appending tiles.
+        """
+        with self.__db_con as db_con:
+            grid = db_con.execute("""
+                SELECT min_x, min_y, max_x, max_y FROM gpkg_tile_matrix_set
+                WHERE table_name = ?;""", (self.__table,)).fetchone()
+            extents = db_con.execute("""
+                SELECT zoom_level, min(tile_column), max(tile_column),
+                       min(tile_row), max(tile_row)
+                FROM """ + self.__table + """
+                GROUP BY zoom_level;""").fetchall()
+            if grid is None or not extents:
+                return
+            db_con.execute("""
+                DELETE FROM gpkg_tile_matrix WHERE table_name = ?;""",
+                           (self.__table,))
+            bounds = None
+            for zoom, min_col, max_col, min_row, max_row in extents:
+                span_x, span_y = self.__tile_span(zoom)[2:]
+                db_con.execute("""
+                    INSERT INTO gpkg_tile_matrix (
+                        table_name,
+                        zoom_level,
+                        matrix_width,
+                        matrix_height,
+                        tile_width,
+                        tile_height,
+                        pixel_x_size,
+                        pixel_y_size)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?);""",
+                               (self.__table, zoom,
+                                int(round((grid[2] - grid[0]) / span_x)),
+                                int(round((grid[3] - grid[1]) / span_y)),
+                                self.__projection.tile_size,
+                                self.__projection.tile_size,
+                                self.__projection.pixel_size(zoom),
+                                self.__projection.pixel_size(zoom)))
+                # Tile rows count down from the top of the matrix set
+                extent = (grid[0] + min_col * span_x,
+                          max(grid[1], grid[3] - (max_row + 1) * span_y),
+                          min(grid[2], grid[0] + (max_col + 1) * span_x),
+                          grid[3] - min_row * span_y)
+                if bounds is None:
+                    bounds = extent
+                else:
+                    bounds = (min(bounds[0], extent[0]),
+                              min(bounds[1], extent[1]),
+                              max(bounds[2], extent[2]),
+                              max(bounds[3], extent[3]))
+            db_con.execute("""
+                UPDATE gpkg_contents SET
+                    min_x = ?,
+                    min_y = ?,
+                    max_x = ?,
+                    max_y = ?,
+                    last_change = strftime('%Y-%m-%dT%H:%M:%fZ','now')
+                WHERE table_name = ?;""", bounds + (self.__table,))
+
     def execute(self, statement, inputs=None):
         """Execute a prepared SQL statement on this geopackage database."""
         with self.__db_con as db_con:
@@ -773,58 +1167,565 @@ class Geopackage(object):
                 result_cursor = cursor.execute(statement)
             return result_cursor
 
-    def assimilate(self, source):
-        """Assimilate .gpkg.part tiles into this geopackage database."""
+    def assimilate(self, source, durable=False):
+        """
+        Assimilate .gpkg.part tiles into this geopackage database.
+
+        Inputs:
+        source -- the path of the .gpkg.part file
+        durable -- keep a rollback journal, so that a merge that is killed
+                   halfway is rolled back instead of corrupting this file
+
+        Returns:
+        The number of tiles merged.
+        """
         if not exists(source):
             raise IOError
+        merged = self.__merge_source(source, None, durable)
+        remove(source)
+        return merged
+
+    def assimilate_data(self, data, durable=False):
+        """
+        Assimilate the tiles of a worker database that was kept in memory
+        and serialized (see TempDB) into this geopackage database.
+
+        Inputs:
+        data -- the bytes of the serialized database
+        durable -- see assimilate()
+
+        Returns:
+        The number of tiles merged.
+        """
+        return self.__merge_source(":memory:", data, durable)
+
+    def __merge_source(self, source, data, durable):
+        """
+        Attach a worker database as source, deserializing data into it if
+        given, and insert its tiles.  Returns the number of tiles merged.
+        """
         with self.__db_con as db_con:
             cursor = db_con.cursor()
             cursor.execute("pragma synchronous = off;")
-            cursor.execute("pragma journal_mode = off;")
-            cursor.execute("pragma page_size = 65536;")
+            cursor.execute("pragma journal_mode = {};".format(
+                "delete" if durable else "off"))
             #print "Merging", source, "into", self.__file_path, "..."
             query = "attach '" + source + "' as source;"
             cursor.execute(query)
+            if data is not None:
+                db_con.deserialize(data, name='source')
+            if self.__bulk_path is not None:
+                # The staging table has no index, so there is nothing to
+                # replace; duplicates are resolved by finish_bulk_load()
+                insert = "INSERT INTO bulk." + self.__table
+            else:
+                insert = "INSERT OR REPLACE INTO " + self.__table
             try:
-                cursor.execute("""INSERT OR REPLACE INTO tiles
+                cursor.execute(insert + """
                 (zoom_level, tile_column, tile_row, tile_data)
                 SELECT zoom_level, tile_column, tile_row, tile_data
                 FROM source.tiles;""")
+                merged = cursor.rowcount
+                # An attached database cannot be detached while the insert
+                # transaction is still open
+                db_con.commit()
                 cursor.execute("detach source;")
             except Error as err:
                 print("Error: {}".format(type(err)))
                 print("Error msg:".format(err))
                 raise
-            remove(source)
+        return merged
+
+    @property
+    def bulk_path(self):
+        """Return the path of the bulk load staging database, if any."""
+        return self.__bulk_path
+
+    def start_bulk_load(self):
+        """
+        Start a bulk load.  Until finish_bulk_load() is called, assimilated
+        tiles are appended to an unindexed staging table in a
+        <file_path>.bulk database next to this geopackage (or a
+        <file_path>.<table_name>.bulk one for other tile tables) instead of
+        the tile table.
+        """
+        self.__bulk_path = self.__file_path + ('.bulk' if self.__table ==
+                                               'tiles' else
+                                               '.' + self.__table + '.bulk')
+        staging = connect(self.__bulk_path)
+        if self.__page_size is not None:
+            staging.execute("pragma page_size = {};".format(self.__page_size))
+        with staging:
+            # A resumed run keeps the tiles staged before it was interrupted
+            staging.execute("""
+                CREATE TABLE IF NOT EXISTS """ + self.__table + """ (
+                    zoom_level INTEGER NOT NULL,
+                    tile_column INTEGER NOT NULL,
+                    tile_row INTEGER NOT NULL,
+                    tile_data BLOB NOT NULL);
+            """)
+        staging.close()
+        self.__db_con.execute(
+            "attach '" + self.__bulk_path + "' as bulk;")
+        self.__db_con.execute("pragma bulk.synchronous = off;")
+        self.__db_con.execute("pragma bulk.journal_mode = off;")
+
+    def finish_bulk_load(self, order='zoom'):
+        """
+        Copy the staged tiles into the tiles table in one sorted pass and
+        remove the staging database.  Because the rows arrive in key order,
+        both the table and its UNIQUE (zoom_level, tile_column, tile_row)
+        index are written sequentially instead of being split and
+        rebalanced on every insert, and tiles that are read together end up
+        on neighbouring pages.
+
+        Inputs:
+        order -- 'zoom' to cluster tiles by zoom level, row and column, or
+                 'hilbert' to follow a Hilbert curve within each zoom level
+        """
+        if order == 'hilbert':
+            self.__db_con.create_function('hilbert_index', 3, hilbert_index)
+            order_by = "zoom_level, hilbert_index(zoom_level + 1, " + \
+                "tile_column, tile_row)"
+        else:
+            order_by = "zoom_level, tile_row, tile_column"
+        with self.__db_con as db_con:
+            db_con.execute("pragma synchronous = off;")
+            db_con.execute("INSERT OR REPLACE INTO " + self.__table + """
+                (zoom_level, tile_column, tile_row, tile_data)
+                SELECT zoom_level, tile_column, tile_row, tile_data
+                FROM bulk.""" + self.__table + " ORDER BY " + order_by + ";")
+        self.__db_con.execute("detach bulk;")
+        remove(self.__bulk_path)
+        self.__bulk_path = None
+
+    def close(self):
+        """Close the connection to the geopackage."""
+        self.__db_con.close()
+
+    @staticmethod
+    def optimize(file_path, compact=False):
+        """
+        Prepare a finished geopackage for readers.  ANALYZE records the
+        statistics the query planner uses to pick the tile table indexes,
+        and compacting rewrites the file with VACUUM INTO a copy that then
+        replaces it, leaving out free pages and storing each table and
+        index on consecutive pages.  Call this once all the Geopackage
+        objects of the file are closed.
+
+        Inputs:
+        file_path -- the path of the geopackage database
+        compact -- also compact the file
+
+        Returns:
+        The size of the file.
+        """
+        copy_path = file_path + '.compact' if compact else None
+        db_con = connect(file_path)
+        try:
+            db_con.execute("ANALYZE;")
+            db_con.commit()
+            if compact:
+                if exists(copy_path):
+                    remove(copy_path)
+                try:
+                    db_con.execute("VACUUM INTO ?;", (copy_path,))
+                except Error:
+                    # SQLite before 3.27 can only vacuum in place
+                    db_con.execute("VACUUM;")
+                    copy_path = None
+        finally:
+            db_con.close()
+        if copy_path is not None:
+            replace(copy_path, file_path)
+        return getsize(file_path)
 
     def __exit__(self, type, value, traceback):
         """Resource cleanup on destruction."""
-        self.__db_con.close()
+        self.close()
+
+
+class GeopackageReader(object):
+    """
+    Read-only access to a tile table of a geopackage, for serving tiles from
+    several threads.  Tiles are addressed in the TMS or WMTS numbering of
+    the source folder (the tile matrix of the geopackage starts at the
+    top-left corner of its tile matrix set instead), the connections are
+    pooled, and recently read tiles are kept in a BlobCache.
+    """
+
+    def __enter__(self):
+        """With-statement caller"""
+        return self
+
+    def __init__(self, file_path, table_name='tiles', lower_left=True,
+                 connections=READER_CONNECTIONS,
+                 cache_bytes=READER_CACHE_BYTES, mmap_size=READER_MMAP_SIZE):
+        """
+        Constructor.
+
+        Inputs:
+        file_path -- the path of the geopackage database
+        table_name -- the name of the tile table
+        lower_left -- bool indicating tile grid numbering scheme (tms or
+                      wmts) of the tile coordinates used with this reader
+        connections -- the number of connections threads can read with at
+                       the same time
+        cache_bytes -- the total size of the cached tile blobs, 0 to
+                       disable the cache
+        mmap_size -- the number of bytes of the file each connection maps
+                     into memory
+        """
+        if not exists(file_path):
+            raise IOError("{} does not exist".format(file_path))
+        self.__file_path = file_path
+        self.__table = table_name
+        self.__mmap_size = mmap_size
+        self.__idle = []
+        # Every connection opened, so close() also reaches borrowed ones
+        self.__connections = []
+        self.__lock = Lock()
+        self.__slots = Semaphore(connections)
+        self.__cache = BlobCache(cache_bytes)
+        self.__cache_lock = Lock()
+        with self.__connection() as db_con:
+            row = db_con.execute("""
+                SELECT srs_id, min_x, min_y, max_x, max_y
+                FROM gpkg_tile_matrix_set WHERE table_name = ?;""",
+                                 (table_name,)).fetchone()
+            if row is None:
+                raise ValueError("{} has no {} table".format(file_path,
+                                                             table_name))
+            zooms = [zoom for (zoom,) in db_con.execute("""
+                SELECT zoom_level FROM gpkg_tile_matrix
+                WHERE table_name = ? ORDER BY zoom_level;""", (table_name,))]
+        self.__srs = row[0]
+        self.__bounds = row[1:]
+        self.__projection = get_projection(self.__srs)
+        self.__invert_y = get_invert_y(lower_left, self.__srs)
+        # The source folder coordinates of the top-left tile of the tile
+        # matrix set at each zoom level
+        self.__origins = {}
+        for zoom in zooms:
+            origin_x, origin_y, span_x, span_y = tile_span(self.__projection,
+                                                           zoom)
+            top_row = int(round((self.__bounds[3] - origin_y) / span_y)) - 1
+            self.__origins[zoom] = (
+                int(round((self.__bounds[0] - origin_x) / span_x)),
+                self.__projection.invert_y(zoom, top_row))
+
+    def __connect(self):
+        """Open a read-only connection to the geopackage."""
+        if version_info[0] == 3:
+            db_con = connect("file:{}?mode=ro".format(
+                pathname2url(abspath(self.__file_path))), uri=True,
+                             check_same_thread=False)
+        else:
+            db_con = connect(self.__file_path, check_same_thread=False)
+            db_con.execute("pragma query_only = on;")
+        db_con.execute("pragma mmap_size = {};".format(self.__mmap_size))
+        return db_con
+
+    @contextmanager
+    def __connection(self):
+        """
+        Borrow a connection from the pool, opening one if none is idle and
+        waiting if all of them are in use.
+        """
+        self.__slots.acquire()
+        db_con = None
+        try:
+            with self.__lock:
+                if self.__idle:
+                    db_con = self.__idle.pop()
+            if db_con is None:
+                db_con = self.__connect()
+                with self.__lock:
+                    self.__connections.append(db_con)
+            yield db_con
+        finally:
+            if db_con is not None:
+                with self.__lock:
+                    # A connection closed while it was borrowed is dropped
+                    if db_con in self.__connections:
+                        self.__idle.append(db_con)
+            self.__slots.release()
+
+    @property
+    def file_path(self):
+        """Return the path of the geopackage database on the file system."""
+        return self.__file_path
+
+    @property
+    def srs(self):
+        """Return the spatial reference system of the tiles."""
+        return self.__srs
+
+    @property
+    def zoom_levels(self):
+        """Return the sorted zoom levels of the tile matrix."""
+        return sorted(self.__origins)
+
+    def __position(self, z, x, y):
+        """
+        Return the (zoom level, tile column, tile row) of a tile in the tile
+        matrix, or None if the zoom level is not in it.
+        """
+        if z not in self.__origins:
+            return None
+        first_x, first_y = self.__origins[z]
+        if self.__invert_y is not None:
+            y = self.__invert_y(z, y)
+        return z, x - first_x, y - first_y
+
+    def tile_coordinates(self, z, column, row):
+        """
+        Return the (z, x, y) source folder coordinates of a position in the
+        tile matrix.
+
+        Inputs:
+        z -- the zoom level
+        column -- the tile column in the tile matrix
+        row -- the tile row in the tile matrix, counted from the top
+        """
+        first_x, first_y = self.__origins[z]
+        y = row + first_y
+        if self.__invert_y is not None:
+            y = self.__invert_y(z, y)
+        return z, column + first_x, y
+
+    def get_tile(self, z, x, y):
+        """
+        Return the blob of a tile, or None if the geopackage does not have
+        it.
+
+        Inputs:
+        z -- the zoom level of the tile
+        x -- the tile column
+        y -- the tile row, numbered as this reader was told
+        """
+        return self.get_tiles([(z, x, y)])[(z, x, y)]
+
+    def get_tiles(self, keys):
+        """
+        Return the blobs of several tiles, looking the ones that are not
+        cached up in a few statements.
+
+        Inputs:
+        keys -- (z, x, y) tuples of the tiles to read
+
+        Returns:
+        A dictionary from each key to the blob of the tile, or to None if the
+        geopackage does not have it.
+        """
+        result = {}
+        wanted = {}
+        with self.__cache_lock:
+            for key in keys:
+                position = self.__position(*key)
+                if position is None:
+                    result[key] = None
+                elif position in self.__cache:
+                    result[key] = self.__cache.get(position)
+                else:
+                    wanted.setdefault(position, []).append(key)
+        if not wanted:
+            return result
+        found = {}
+        positions = list(wanted)
+        with self.__connection() as db_con:
+            for start in xrange(0, len(positions), READER_BATCH):
+                batch = positions[start:start + READER_BATCH]
+                query = "WITH wanted(z, c, r) AS (VALUES " + \
+                    ", ".join(["(?, ?, ?)"] * len(batch)) + ") " + """
+                    SELECT zoom_level, tile_column, tile_row, tile_data
+                    FROM wanted JOIN """ + self.__table + """
+                    ON zoom_level = z AND tile_column = c AND tile_row = r;"""
+                for row in db_con.execute(query, list(chain(*batch))):
+                    found[row[:3]] = bytes(row[3])
+        with self.__cache_lock:
+            for position, position_keys in wanted.items():
+                data = found.get(position)
+                if data is not None:
+                    self.__cache.put(position, data)
+                else:
+                    self.__cache.misses += 1
+                for key in position_keys:
+                    result[key] = data
+        return result
+
+    def iter_zoom_range(self, min_zoom=None, max_zoom=None):
+        """
+        Yield every tile of a range of zoom levels as (z, x, y, data)
+        tuples, by tile column and row within each zoom level.  Tiles
+        read this way do not go through the cache, so a full scan does not
+        evict the tiles a server reads most.
+
+        Inputs:
+        min_zoom -- the first zoom level, or None to start at the top
+        max_zoom -- the last zoom level, or None to go to the bottom
+        """
+        for zoom in self.zoom_levels:
+            if (min_zoom is None or zoom >= min_zoom) and \
+                    (max_zoom is None or zoom <= max_zoom):
+                for tile in self.__iter_tiles(zoom):
+                    yield tile
+
+    def iter_bbox(self, bbox, min_zoom=None, max_zoom=None):
+        """
+        Yield the tiles that intersect a bounding box as (z, x, y, data)
+        tuples, zoom level by zoom level.  Like iter_zoom_range(), this
+        bypasses the cache.
+
+        Inputs:
+        bbox -- (min_x, min_y, max_x, max_y) in the units of the srs
+        min_zoom -- the first zoom level, or None to start at the top
+        max_zoom -- the last zoom level, or None to go to the bottom
+        """
+        min_x, min_y, max_x, max_y = bbox
+        for zoom in self.zoom_levels:
+            if (min_zoom is not None and zoom < min_zoom) or \
+                    (max_zoom is not None and zoom > max_zoom):
+                continue
+            span_x, span_y = tile_span(self.__projection, zoom)[2:]
+            # Tile rows count down from the top of the matrix set
+            columns = (max(0, int(floor((min_x - self.__bounds[0]) /
+                                        span_x))),
+                       int(ceil((max_x - self.__bounds[0]) / span_x)) - 1)
+            rows = (max(0, int(floor((self.__bounds[3] - max_y) / span_y))),
+                    int(ceil((self.__bounds[3] - min_y) / span_y)) - 1)
+            if columns[0] <= columns[1] and rows[0] <= rows[1]:
+                for tile in self.__iter_tiles(zoom, columns, rows):
+                    yield tile
+
+    def iter_rows(self, zoom, first_row, last_row):
+        """
+        Yield the tiles of a range of rows of the tile matrix as (z, x, y,
+        data) tuples, bypassing the cache.
+
+        Inputs:
+        zoom -- the zoom level
+        first_row -- the first tile row, counted from the top of the matrix
+        last_row -- the last tile row
+        """
+        return self.__iter_tiles(zoom, rows=(first_row, last_row))
+
+    def __iter_tiles(self, zoom, columns=None, rows=None):
+        """
+        Yield the tiles of one zoom level, optionally limited to ranges of
+        tile columns and rows of the tile matrix.  The tiles are read
+        READER_SCAN_BATCH at a time along the (zoom_level, tile_column,
+        tile_row) index, and the connection is only borrowed while a batch
+        is read, so a suspended iteration does not hold one.
+        """
+        query = """
+            SELECT tile_column, tile_row, tile_data FROM """ + \
+            self.__table + " WHERE zoom_level = ?"
+        inputs = [zoom]
+        if columns is not None:
+            query += " AND tile_column BETWEEN ? AND ?"
+            inputs += list(columns)
+        if rows is not None:
+            query += " AND tile_row BETWEEN ? AND ?"
+            inputs += list(rows)
+        order = " ORDER BY tile_column, tile_row LIMIT {};".format(
+            READER_SCAN_BATCH)
+        batch = None
+        while batch is None or len(batch) == READER_SCAN_BATCH:
+            with self.__connection() as db_con:
+                if batch is None:
+                    batch = db_con.execute(query + order, inputs).fetchall()
+                else:
+                    # Go on after the last tile of the previous batch,
+                    # without row values, which SQLite 3.15 added
+                    column, row = batch[-1][:2]
+                    batch = db_con.execute(
+                        query + " AND (tile_column > ? OR "
+                        "(tile_column = ? AND tile_row > ?))" + order,
+                        inputs + [column, column, row]).fetchall()
+            for column, row, data in batch:
+                yield self.tile_coordinates(zoom, column, row) + \
+                    (bytes(data),)
+
+    def stats(self):
+        """
+        Return the cache statistics: hits, misses, hit_rate (the share of
+        the tiles looked up that were cached), and the number of cached
+        tiles and their total size in bytes.
+        """
+        with self.__cache_lock:
+            hits, misses = self.__cache.hits, self.__cache.misses
+            return dict(hits=hits, misses=misses,
+                        hit_rate=float(hits) / (hits + misses)
+                        if hits + misses else 0.0,
+                        cached_tiles=len(self.__cache),
+                        cached_bytes=self.__cache.size)
+
+    def close(self):
+        """Close every connection of the pool, idle or borrowed."""
+        with self.__lock:
+            for db_con in self.__connections:
+                db_con.close()
+            self.__connections = []
+            self.__idle = []
+
+    def __exit__(self, type, value, traceback):
+        """Resource cleanup on destruction."""
+        self.close()
 
 
 class TempDB(object):
     """
     Returns a temporary sqlite database to hold tiles for async workers.
-    Has a <filename>.gpkg.part file format.
+    Has a <filename>.gpkg.part file format, or is kept in memory and handed
+    over serialized (see memory_bytes).
     """
 
     def __enter__(self):
         """With-statement caller."""
         return self
 
-    def __init__(self, filename):
+    def __init__(self, filename, batch_tiles=BATCH_TILES,
+                 batch_bytes=BATCH_BYTES, page_size=None, memory_bytes=0):
         """
         Constructor.
 
         Inputs:
         filename -- the filename this database will be created with
+        batch_tiles -- the number of buffered tiles that triggers a flush
+        batch_bytes -- the number of buffered bytes that triggers a flush
+        page_size -- the page size of the database, or None for the SQLite
+                     default
+        memory_bytes -- keep the database in memory until it grows past
+                        this many bytes, then move it to its .gpkg.part
+                        file; 0 writes the file from the start.  A database
+                        still in memory on exit is serialized into data,
+                        and file_path is None.
         """
+        self.__batch_tiles = batch_tiles
+        self.__batch_bytes = batch_bytes
+        self.__batch = []
+        self.__batch_size = 0
         uid = uuid4()
         self.name = uid.hex + '.gpkg.part'
         self.__file_path = join(filename, self.name)
-        self.__db_con = connect(self.__file_path)
+        self.__memory_bytes = memory_bytes
+        self.file_path = None if memory_bytes else self.__file_path
+        self.data = None
+        self.__db_con = connect(":memory:" if memory_bytes
+                                else self.__file_path)
         with self.__db_con as db_con:
             cursor = db_con.cursor()
+            # Enable pragma for fast sqlite creation; the page size has to
+            # be set before the table is created.  A part file holds several
+            # chunks, so it keeps a rollback journal: a worker killed while
+            # writing one chunk must not corrupt the chunks before it
+            cursor.execute("pragma synchronous = off;")
+            cursor.execute("pragma journal_mode = {};".format(
+                "off" if memory_bytes else "delete"))
+            if page_size is not None:
+                cursor.execute("pragma page_size = {};".format(page_size))
+            cursor.execute("pragma foreign_keys = 1;")
             stmt = """
                 CREATE TABLE tiles (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -836,11 +1737,6 @@ class TempDB(object):
             """
 
             cursor.execute(stmt)
-            # Enable pragma for fast sqlite creation
-            cursor.execute("pragma synchronous = off;")
-            cursor.execute("pragma journal_mode = off;")
-            cursor.execute("pragma page_size = 80000;")
-            cursor.execute("pragma foreign_keys = 1;")
         self.image_blob_stmt = """
             INSERT INTO tiles
                 (zoom_level, tile_column, tile_row, tile_data)
@@ -848,6 +1744,8 @@ class TempDB(object):
         """
 
     def execute(self, statement, inputs=None):
+        # Make sure buffered tiles are visible to the statement
+        self.flush()
         with self.__db_con as db_con:
             cursor = db_con.cursor()
             if inputs is not None:
@@ -858,8 +1756,9 @@ class TempDB(object):
 
     def insert_image_blob(self, z, x, y, data):
         """
-        Inserts a binary data array containing an image into a sqlite3
-        database.
+        Buffers a binary data array containing an image for insertion into a
+        sqlite3 database.  The buffer is written out once it holds
+        batch_tiles tiles or batch_bytes bytes, whichever comes first.
 
         Inputs:
         z -- the zoom level of the binary data
@@ -867,72 +1766,1288 @@ class TempDB(object):
         y -- the column number of the data
         data -- the image data containing in a binary array
         """
+        self.__batch.append((z, x, y, data))
+        self.__batch_size += len(data)
+        if len(self.__batch) >= self.__batch_tiles or \
+                self.__batch_size >= self.__batch_bytes:
+            self.flush()
+
+    def flush(self):
+        """Write all buffered tiles to the database in one transaction."""
+        if not self.__batch:
+            return
         with self.__db_con as db_con:
-            cursor = db_con.cursor()
-            cursor.execute(self.image_blob_stmt, (z, x, y, data))
+            db_con.executemany(self.image_blob_stmt, self.__batch)
+        self.__batch = []
+        self.__batch_size = 0
+        if self.file_path is None and self.size() > self.__memory_bytes:
+            self.__spill()
+
+    def size(self):
+        """Return the size of the database in bytes."""
+        (pages,) = self.__db_con.execute("pragma page_count;").fetchone()
+        (page_size,) = self.__db_con.execute("pragma page_size;").fetchone()
+        return pages * page_size
+
+    def __spill(self):
+        """Copy the in-memory database to its part file and go on there."""
+        db_con = connect(self.__file_path)
+        db_con.execute("pragma synchronous = off;")
+        db_con.execute("pragma journal_mode = delete;")
+        self.__db_con.backup(db_con)
+        self.__db_con.close()
+        self.__db_con = db_con
+        self.file_path = self.__file_path
+
+    def sync(self):
+        """
+        Write the buffered tiles and force the part file to disk.  It is
+        written without syncing, so this has to happen before the chunks
+        written so far can be journaled as done.
+        """
+        self.flush()
+        if self.file_path is not None:
+            with open(self.__file_path, 'ab') as part:
+                fsync(part.fileno())
+
+    def close(self):
+        """
+        Write the buffered tiles and close the database, syncing its part
+        file or serializing it into data if it is still in memory.
+        """
+        self.sync()
+        if self.file_path is None:
+            # Hand the pages over instead of a file
+            self.data = self.__db_con.serialize()
+        self.__db_con.close()
 
     def __exit__(self, type, value, traceback):
         """Resource cleanup on destruction."""
-        self.__db_con.close()
+        if type is None:
+            self.close()
+        else:
+            self.__db_con.close()
 
 
-def img_to_buf(img, img_type, jpeg_quality=75):
+class QueueDB(object):
     """
-    Returns a buffer array with image binary data for the input image.
-    This code is based on logic implemented in MapProxy to convert PNG
-    images to JPEG then return the buffer.
-
-    Inputs:
-    img -- an image on the filesystem to be converted to binary
-    img_type -- the MIME type of the image (JPG, PNG)
+    Stand-in for TempDB used by the single writer pipeline.  Tiles are
+    buffered the same way, but each full batch is put on a bounded queue
+    read by gpkg_writer() instead of being written to a .gpkg.part file.
+    A worker blocks while the queue is full, so a slow writer throttles the
+    workers rather than letting batches pile up in memory.
     """
-    defaults = {}
-    buf = ioBuffer()
-    if img_type == 'jpeg':
-        img.convert('RGB')
-        # Hardcoding a default compression of 75% for JPEGs
-        defaults['quality'] = jpeg_quality
-    elif img_type == 'source':
-        img_type = img.format
-    img.save(buf, img_type, **defaults)
-    buf.seek(0)
-    return buf
 
+    def __enter__(self):
+        """With-statement caller."""
+        return self
 
-def img_has_transparency(img):
-    """
-    Returns a 0 if the input image has no transparency, 1 if it has some,
-    and -1 if the image is fully transparent. Tiles *should be a perfect
-    square (e.g, 256x256), so it can be safe to assume the first dimension
-    will match the second.  This will ensure compatibility with different
-    tile sizes other than 256x256.  This code is based on logic implemented
-    in MapProxy to check for images that have transparency.
+    def __init__(self, queue, batch_tiles=BATCH_TILES,
+                 batch_bytes=BATCH_BYTES, table_name='tiles'):
+        """
+        Constructor.
 
-    Inputs:
-    img -- an Image object from the PIL library
-    """
-    size = img.size[0]
-    if img.mode == 'P':
-        # For paletted images
-        if img.info.get('transparency', False):
-            return True
-        # Convert to RGBA to check alpha
-        img = img.convert('RGBA')
-    if img.mode == 'RGBA':
-        # Returns the number of pixels in this image that are transparent
-        # Assuming a tile size of 256, 65536 would be fully transparent
-        transparent_pixels = img.histogram()[-size]
-        if transparent_pixels == 0:
-            # No transparency
-            return 0
-        elif 0 < transparent_pixels < (size * size):
-            # Image has some transparency
-            return 1
-        else:
-            # Image is fully transparent, and can be discarded
-            return -1
-        #return img.histogram()[-size]
-    return False
+        Inputs:
+        queue -- the multiprocessing queue read by gpkg_writer()
+        batch_tiles -- the number of buffered tiles that triggers a flush
+        batch_bytes -- the number of buffered bytes that triggers a flush
+        table_name -- the tile table the tiles are written to
+        """
+        self.__queue = queue
+        self.__table = table_name
+        self.__batch_tiles = batch_tiles
+        self.__batch_bytes = batch_bytes
+        self.__batch = []
+        self.__batch_size = 0
+
+    def insert_image_blob(self, z, x, y, data):
+        """
+        Buffers a binary data array containing an image for the writer.
+
+        Inputs:
+        z -- the zoom level of the binary data
+        x -- the row number of the data
+        y -- the column number of the data
+        data -- the image data containing in a binary array
+        """
+        # sqlite3.Binary objects cannot be pickled onto the queue
+        data = bytes(data)
+        self.__batch.append((z, x, y, data))
+        self.__batch_size += len(data)
+        if len(self.__batch) >= self.__batch_tiles or \
+                self.__batch_size >= self.__batch_bytes:
+            self.flush()
+
+    def flush(self):
+        """Hand all buffered tiles to the writer, blocking if it is busy."""
+        if not self.__batch:
+            return
+        self.__queue.put((self.__table, self.__batch))
+        self.__batch = []
+        self.__batch_size = 0
+
+    def __exit__(self, type, value, traceback):
+        """Hand over any remaining tiles."""
+        if type is None:
+            self.flush()
+
+
+class BlobCache(object):
+    """
+    Least recently used cache of tile blobs, bounded by the total size of
+    the blobs it holds.
+    """
+
+    def __init__(self, max_bytes):
+        """
+        Constructor.
+
+        Inputs:
+        max_bytes -- the total size of the cached blobs
+        """
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.__size = 0
+        self.__entries = OrderedDict()
+
+    def get(self, key):
+        """
+        Return a cached blob and mark it as recently used.
+
+        Inputs:
+        key -- the key the blob was cached under
+        """
+        entry = self.__entries.pop(key)
+        self.__entries[key] = entry
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key, value, size=None):
+        """
+        Cache a blob, evicting the least recently used ones until the cache
+        fits its budget, and return the blob.  None (a skipped tile) can be
+        cached as well.
+
+        Inputs:
+        key -- the key to cache the blob under
+        value -- the blob
+        size -- the size to count for the value, if it is not a blob
+        """
+        self.misses += 1
+        if size is None:
+            size = len(value) if value is not None else 0
+        if size > self.max_bytes:
+            return value
+        self.__entries[key] = value, size
+        self.__size += size
+        while self.__size > self.max_bytes:
+            _, (_, evicted) = self.__entries.popitem(last=False)
+            self.__size -= evicted
+        return value
+
+    def __contains__(self, key):
+        """Return whether a key is cached."""
+        return key in self.__entries
+
+    def __len__(self):
+        """Return the number of cached blobs."""
+        return len(self.__entries)
+
+    @property
+    def size(self):
+        """Return the total size of the cached blobs."""
+        return self.__size
+
+
+class EncodeCache(BlobCache):
+    """
+    Least recently used cache of encoded tiles, keyed by a digest of the
+    source tile bytes.  Large pyramids repeat the same source tile (open
+    ocean, nodata fill, solid colors) many times, and a hit returns the
+    encoded blob without decoding the tile again.
+    """
+
+    def __init__(self, max_bytes=ENCODE_CACHE_BYTES):
+        """
+        Constructor.
+
+        Inputs:
+        max_bytes -- the total size of the cached blobs
+        """
+        super(EncodeCache, self).__init__(max_bytes)
+
+    @staticmethod
+    def key(data):
+        """
+        Return the cache key of a source tile.
+
+        Inputs:
+        data -- the raw bytes of the source tile
+        """
+        return sha1(data).digest()
+
+
+class ProgressCounters(object):
+    """
+    Tile and byte counters in shared memory.  Pool workers add to them in
+    batches while they process a chunk, so the parent process can report
+    progress at the granularity of tiles instead of finished chunks.
+    """
+
+    def __init__(self):
+        """Constructor."""
+        # Doubles do not overflow on byte counts of large pyramids
+        self.__values = Array('d', 3)
+
+    def add(self, tiles, bytes_in, bytes_out):
+        """
+        Add to the counters.
+
+        Inputs:
+        tiles -- the number of tiles processed
+        bytes_in -- the number of source tile bytes read
+        bytes_out -- the number of encoded tile bytes written
+        """
+        with self.__values.get_lock():
+            self.__values[0] += tiles
+            self.__values[1] += bytes_in
+            self.__values[2] += bytes_out
+
+    def values(self):
+        """Return the tiles, bytes in and bytes out counted so far."""
+        with self.__values.get_lock():
+            return tuple(int(value) for value in self.__values)
+
+
+class StageTimer(object):
+    """Context manager that adds its wall-clock time to a stage."""
+
+    def __init__(self, seconds, name):
+        """
+        Constructor.
+
+        Inputs:
+        seconds -- the dictionary of seconds per stage to add to
+        name -- the name of the stage
+        """
+        self.__seconds = seconds
+        self.__name = name
+        self.__start = None
+
+    def __enter__(self):
+        self.__start = time()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.__seconds[self.__name] += time() - self.__start
+
+
+class NoTimer(object):
+    """Context manager that does nothing, used when no stages are timed."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        pass
+
+
+NO_TIMER = NoTimer()
+
+
+class StageTimers(object):
+    """
+    Wall-clock seconds spent in each stage of worker_map() by one worker
+    process, summed over all of its tiles.
+    """
+
+    def __init__(self, stages=WORKER_STAGES):
+        """Constructor."""
+        self.seconds = dict((name, 0.0) for name in stages)
+
+    def stage(self, name):
+        """Return a context manager that times one run of a stage."""
+        return StageTimer(self.seconds, name)
+
+    def since(self, earlier):
+        """
+        Return the seconds per stage added since an earlier copy of
+        seconds.
+        """
+        return dict((name, value - earlier.get(name, 0.0))
+                    for name, value in self.seconds.items())
+
+
+def timed(name):
+    """
+    Return a context manager that adds its wall-clock time to a stage of
+    this worker's StageTimers, or one that does nothing if the run is not
+    profiled.
+
+    Inputs:
+    name -- one of WORKER_STAGES
+    """
+    if _STAGE_TIMERS is None:
+        return NO_TIMER
+    return _STAGE_TIMERS.stage(name)
+
+
+class Manifest(object):
+    """
+    Record of the source tiles packaged into a tile table, kept in a
+    <table_name>_manifest table next to it with the relative path, size,
+    mtime and (optionally) SHA-1 of every tile and the position it was
+    stored at.
+    A run records the tiles it scans in a temporary table and compares the
+    two in SQL, so only new or changed tiles have to be encoded again and
+    tiles that disappeared from the source can be deleted.
+    """
+
+    def __enter__(self):
+        """With-statement caller."""
+        return self
+
+    def __init__(self, file_path, root, table_name='tiles'):
+        """
+        Constructor.
+
+        Inputs:
+        file_path -- the path of the geopackage
+        root -- the TMS folder the tiles come from
+        table_name -- the tile table the tiles are stored in
+        """
+        self.root = root
+        self.__table = table_name
+        self.__manifest = table_name + '_manifest'
+        self.__db_con = connect(file_path)
+        self.__batch = []
+        with self.__db_con as db_con:
+            db_con.execute("""
+                CREATE TABLE IF NOT EXISTS """ + self.__manifest + """ (
+                    path TEXT NOT NULL PRIMARY KEY,
+                    zoom_level INTEGER NOT NULL,
+                    tile_column INTEGER NOT NULL,
+                    tile_row INTEGER NOT NULL,
+                    size INTEGER NOT NULL,
+                    mtime DOUBLE NOT NULL,
+                    hash TEXT);""")
+            db_con.execute("""
+                CREATE TEMP TABLE manifest_scan (
+                    path TEXT NOT NULL PRIMARY KEY,
+                    z INTEGER NOT NULL,
+                    x INTEGER NOT NULL,
+                    y INTEGER NOT NULL,
+                    size INTEGER NOT NULL,
+                    mtime DOUBLE NOT NULL);""")
+
+    def record(self, tiles):
+        """
+        Generator that records tiles in the scan table as they pass
+        through it, so the scan can feed the workers at the same time.
+
+        Inputs:
+        tiles -- an iterable of tile dictionaries with size and mtime keys,
+                 see scan_tiles()
+        """
+        start = len(self.root.rstrip('/\\')) + 1
+        for tile in tiles:
+            self.__batch.append((tile['path'][start:], tile['z'], tile['x'],
+                                 tile['y'], tile['size'], tile['mtime']))
+            if len(self.__batch) >= MANIFEST_BATCH:
+                self.__flush()
+            yield tile
+        self.__flush()
+
+    def __flush(self):
+        """Write the recorded tiles to the scan table."""
+        if self.__batch:
+            with self.__db_con as db_con:
+                db_con.executemany("""
+                    INSERT OR REPLACE INTO temp.manifest_scan
+                    VALUES (?, ?, ?, ?, ?, ?);""", self.__batch)
+            self.__batch = []
+
+    def diff(self, use_hash=False, threads=SCAN_THREADS):
+        """
+        Compare the scanned tiles to the manifest.  A tile is dirty if it is
+        new or its size or mtime changed; with use_hash, a dirty tile whose
+        contents still match the recorded hash is only touched up in the
+        manifest and not encoded again.
+
+        Inputs:
+        use_hash -- hash dirty tiles and record the hashes
+        threads -- the number of threads used to hash tiles
+
+        Returns:
+        The numbers of changed (or new), removed and unchanged tiles.
+        """
+        with self.__db_con as db_con:
+            db_con.execute("""
+                CREATE TEMP TABLE manifest_dirty AS
+                SELECT s.path, s.z, s.x, s.y, s.size, s.mtime,
+                       NULL AS hash, m.hash AS old_hash,
+                       m.path IS NULL AS is_new
+                FROM temp.manifest_scan s
+                LEFT JOIN """ + self.__manifest + """ m ON m.path = s.path
+                WHERE m.path IS NULL OR m.size != s.size OR
+                      m.mtime != s.mtime;""")
+            db_con.execute("""
+                CREATE TEMP TABLE manifest_removed AS
+                SELECT path FROM """ + self.__manifest + """ m
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM temp.manifest_scan s
+                    WHERE s.path = m.path);""")
+        if use_hash:
+            self.__hash_dirty(threads)
+        (changed,), (removed,), (scanned,) = [
+            self.__db_con.execute(query).fetchone() for query in (
+                """SELECT count(*) FROM temp.manifest_dirty WHERE is_new OR
+                   hash IS NULL OR hash IS NOT old_hash;""",
+                "SELECT count(*) FROM temp.manifest_removed;",
+                "SELECT count(*) FROM temp.manifest_scan;")]
+        return changed, removed, scanned - changed
+
+    def __hash(self, path):
+        """Return the SHA-1 of a tile, given its path relative to root."""
+        return sha1(read_tile(join(self.root, path))).hexdigest()
+
+    def __hash_dirty(self, threads):
+        """Hash the dirty tiles on a thread pool, a batch at a time."""
+        cursor = self.__db_con.cursor()
+        cursor.execute("""
+            CREATE TEMP TABLE manifest_hash (
+                path TEXT NOT NULL PRIMARY KEY,
+                hash TEXT NOT NULL);""")
+        rows = self.__db_con.execute("SELECT path FROM temp.manifest_dirty;")
+        pool = ThreadPool(threads)
+        try:
+            while True:
+                # sqlite3 connections cannot be used from the pool threads,
+                # so only the file reads run there
+                paths = [row[0] for row in rows.fetchmany(MANIFEST_BATCH)]
+                if not paths:
+                    break
+                cursor.executemany("""
+                    INSERT INTO temp.manifest_hash VALUES (?, ?);""",
+                                   zip(paths, pool.map(self.__hash, paths)))
+        finally:
+            pool.terminate()
+        with self.__db_con as db_con:
+            db_con.execute("""
+                UPDATE temp.manifest_dirty SET hash = (
+                    SELECT hash FROM temp.manifest_hash h
+                    WHERE h.path = manifest_dirty.path);""")
+
+    def changed(self):
+        """
+        Return a TileIndex of the tiles that diff() found to be new or to
+        have changed contents.
+        """
+        index = TileIndex(self.root)
+        for path, z, x, y in self.__db_con.execute("""
+                SELECT path, z, x, y FROM temp.manifest_dirty
+                WHERE is_new OR hash IS NULL OR hash IS NOT old_hash
+                ORDER BY z, x, y;"""):
+            index.append(z, x, y, path[path.rindex('.'):])
+        return index
+
+    def delete_stale(self):
+        """
+        Delete the stored tiles of removed and changed source tiles from the
+        geopackage.  Changed tiles are encoded again afterwards; deleting
+        them first means a tile that is now empty (see -skip-empty) does not
+        leave its old version behind.
+
+        Returns:
+        The number of tiles deleted.
+        """
+        with self.__db_con as db_con:
+            cursor = db_con.execute("""
+                DELETE FROM """ + self.__table + """ WHERE id IN (
+                    SELECT t.id FROM """ + self.__manifest + """ m
+                    JOIN """ + self.__table + """ t ON
+                        t.zoom_level = m.zoom_level AND
+                        t.tile_column = m.tile_column AND
+                        t.tile_row = m.tile_row
+                    WHERE m.path IN (
+                        SELECT path FROM temp.manifest_removed
+                        UNION ALL
+                        SELECT path FROM temp.manifest_dirty
+                        WHERE NOT is_new AND
+                            (hash IS NULL OR hash IS NOT old_hash)));""")
+            return cursor.rowcount
+
+    def update(self, tile_info, invert_y):
+        """
+        Write the dirty tiles, with the positions they are stored at, to the
+        manifest and drop the removed ones.  Called once the tiles have been
+        written, so an interrupted run leaves the manifest as it was.
+
+        Inputs:
+        tile_info -- the ZoomMetadata list the tiles were positioned with
+        invert_y -- a function that will flip the Y axis of the tile if present
+        """
+        rows = self.__db_con.execute("""
+            SELECT path, z, x, y, size, mtime, hash
+            FROM temp.manifest_dirty;""")
+
+        def records():
+            """Add the stored position to each dirty tile."""
+            for path, z, x, y, size, mtime, digest in rows:
+                position = tile_position(dict(z=z, x=x, y=y), tile_info,
+                                         invert_y)
+                yield (path,) + position + (size, mtime, digest)
+        with self.__db_con as db_con:
+            db_con.executemany("""
+                INSERT OR REPLACE INTO """ + self.__manifest + """
+                VALUES (?, ?, ?, ?, ?, ?, ?);""", records())
+            db_con.execute("""
+                DELETE FROM """ + self.__manifest + """ WHERE path IN (
+                    SELECT path FROM temp.manifest_removed);""")
+
+    def close(self):
+        """Close the connection to the geopackage."""
+        self.__db_con.close()
+
+    def __exit__(self, type, value, traceback):
+        """Resource cleanup on destruction."""
+        self.close()
+
+
+def column_ranges(chunk):
+    """
+    Returns the tiles of a TileIndex as ranges of consecutive y values per
+    z/x column, the form in which a RunJournal records them.
+
+    Inputs:
+    chunk -- a TileIndex
+
+    Returns:
+    A sorted list of [z, x, min y, max y] lists.
+    """
+    ranges = []
+    for z, x, y in sorted(zip(*chunk.columns)):
+        if ranges and ranges[-1][:2] == [z, x] and ranges[-1][3] + 1 >= y:
+            ranges[-1][3] = y
+        else:
+            ranges.append([z, x, y, y])
+    return ranges
+
+
+class RunJournal(object):
+    """
+    Journal of a packaging run, kept in a <output>.journal database next to
+    the geopackage until the run completes.  It records the options of the
+    run, which tiles each finished chunk holds (as ranges of y values per
+    z/x column, which stays small even for tens of millions of tiles), the
+    tile table and .gpkg.part file each chunk was written to and whether
+    that part has been merged, so an interrupted run can be resumed.
+    """
+
+    def __enter__(self):
+        """With-statement caller."""
+        return self
+
+    def __init__(self, file_path, settings, resume=False):
+        """
+        Constructor.
+
+        Inputs:
+        file_path -- the path of the journal
+        settings -- a dictionary of the options that affect the output; a
+                    resumed run must use the same ones
+        resume -- continue the run recorded in an existing journal
+        """
+        if resume and not exists(file_path):
+            raise IOError("{} does not exist".format(file_path))
+        self.file_path = file_path
+        self.skipped = 0
+        self.__column = None
+        self.__ranges = []
+        self.__db_con = connect(file_path)
+        with self.__db_con as db_con:
+            db_con.execute("""
+                CREATE TABLE IF NOT EXISTS settings (
+                    name TEXT NOT NULL PRIMARY KEY,
+                    value TEXT NOT NULL);""")
+            db_con.execute("""
+                CREATE TABLE IF NOT EXISTS chunks (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    table_name TEXT NOT NULL,
+                    part TEXT,
+                    merged INTEGER NOT NULL DEFAULT 0);""")
+            db_con.execute("""
+                CREATE TABLE IF NOT EXISTS done (
+                    chunk INTEGER NOT NULL,
+                    zoom_level INTEGER NOT NULL,
+                    x INTEGER NOT NULL,
+                    min_y INTEGER NOT NULL,
+                    max_y INTEGER NOT NULL);""")
+            db_con.execute("""
+                CREATE INDEX IF NOT EXISTS done_column
+                ON done (zoom_level, x);""")
+        # Settings go through JSON so they compare the same after a restart
+        settings = loads(dumps(settings))
+        recorded = self.get('settings')
+        if not resume:
+            self.set('settings', settings)
+        elif recorded != settings:
+            changed = sorted(key for key in set(settings) | set(recorded or {})
+                             if settings.get(key) !=
+                             (recorded or {}).get(key))
+            self.close()
+            raise ValueError("the run was started with different options: "
+                             "{}".format(", ".join(changed)))
+
+    def get(self, name, default=None):
+        """Return a value stored in the journal."""
+        row = self.__db_con.execute(
+            "SELECT value FROM settings WHERE name = ?;", (name,)).fetchone()
+        return default if row is None else loads(row[0])
+
+    def set(self, name, value):
+        """Store a value that can be serialized as JSON in the journal."""
+        with self.__db_con as db_con:
+            db_con.execute("INSERT OR REPLACE INTO settings VALUES (?, ?);",
+                           (name, dumps(value)))
+
+    def chunk_done(self, chunk, part=None, table_name='tiles'):
+        """
+        Record that all tiles of a chunk have been written.
+
+        Inputs:
+        chunk -- the TileIndex handed to sqlite_worker()
+        part -- the .gpkg.part file the chunk was written to, if any
+        table_name -- the tile table the chunk belongs to
+        """
+        self.ranges_done(column_ranges(chunk), part, table_name)
+
+    def ranges_done(self, ranges, part=None, table_name='tiles'):
+        """
+        Record that all tiles of a chunk, given as ranges of y values per
+        z/x column, have been written.
+
+        Inputs:
+        ranges -- a list of [z, x, min y, max y] lists from column_ranges()
+        part -- the .gpkg.part file the chunk was written to, if any
+        table_name -- the tile table the chunk belongs to
+        """
+        with self.__db_con as db_con:
+            chunk_id = db_con.execute("""
+                INSERT INTO chunks (table_name, part) VALUES (?, ?);""",
+                                      (table_name, part)).lastrowid
+            db_con.executemany("INSERT INTO done VALUES (?, ?, ?, ?, ?);",
+                               ([chunk_id] + item for item in ranges))
+
+    def is_done(self, tile, table_name='tiles'):
+        """
+        Return whether a tile of a tile table was written by a chunk of this
+        run.  The y ranges of one column are looked up once, and the scanner
+        yields the tiles of a column together.
+        """
+        column = table_name, tile['z'], tile['x']
+        if column != self.__column:
+            self.__column = column
+            self.__ranges = self.__db_con.execute("""
+                SELECT min_y, max_y FROM done
+                JOIN chunks ON chunks.id = done.chunk
+                WHERE table_name = ? AND zoom_level = ? AND x = ?;""",
+                                                  column).fetchall()
+        y = tile['y']
+        return any(low <= y <= high for low, high in self.__ranges)
+
+    def done_columns(self, zoom, table_name='tiles'):
+        """
+        Return the y ranges already written in each column of a zoom level
+        of a tile table, as a dictionary from x to a list of (min y, max y)
+        tuples.
+        """
+        columns = {}
+        for x, low, high in self.__db_con.execute("""
+                SELECT x, min_y, max_y FROM done
+                JOIN chunks ON chunks.id = done.chunk
+                WHERE table_name = ? AND zoom_level = ?;""",
+                                                  (table_name, zoom)):
+            columns.setdefault(x, []).append((low, high))
+        return columns
+
+    def filter(self, tiles, table_name='tiles'):
+        """
+        Generator that leaves out the tiles already written by this run.
+
+        Inputs:
+        tiles -- an iterable of tile dictionaries
+        table_name -- the tile table the tiles are written to
+        """
+        for tile in tiles:
+            if self.is_done(tile, table_name):
+                self.skipped += 1
+            else:
+                yield tile
+
+    def parts(self, table_name='tiles'):
+        """
+        Return the .gpkg.part files written for a tile table that are not
+        merged yet, each once, though a part holds several chunks.
+        """
+        return [row[0] for row in self.__db_con.execute("""
+            SELECT part FROM chunks
+            WHERE table_name = ? AND part IS NOT NULL AND NOT merged
+            GROUP BY part ORDER BY min(id);""", (table_name,))
+                if exists(row[0])]
+
+    def part_merged(self, part):
+        """Record that a .gpkg.part file has been merged."""
+        with self.__db_con as db_con:
+            db_con.execute("UPDATE chunks SET merged = 1 WHERE part = ?;",
+                           (part,))
+
+    def close(self):
+        """Close the journal."""
+        self.__db_con.close()
+
+    def remove(self):
+        """Close and delete the journal once the run has completed."""
+        self.close()
+        remove(self.file_path)
+
+    def __exit__(self, type, value, traceback):
+        """Resource cleanup on destruction."""
+        self.close()
+
+
+class TileIndex(object):
+    """
+    Compact, column oriented index of the tiles in a TMS folder.  Zoom, x
+    and y values are held in parallel integer arrays alongside an index into
+    IMAGE_TYPES for the file extension, and full paths are rebuilt from the
+    root folder on demand.  This keeps tens of millions of tiles in a few
+    hundred megabytes and pickles as raw array bytes when handed to workers.
+    Iterating (or indexing with an integer) returns the same dictionaries
+    that split_all() does.
+    """
+
+    def __init__(self, root):
+        """
+        Constructor.
+
+        Inputs:
+        root -- the TMS folder the tiles live in
+        """
+        self.root = root
+        self.__z = array('i')
+        self.__x = array('i')
+        self.__y = array('i')
+        self.__ext = array('b')
+        self.__sorted = True
+
+    @classmethod
+    def from_tiles(cls, root, tiles):
+        """
+        Build an index from tile dictionaries such as those produced by
+        scan_tiles() or split_all().
+
+        Inputs:
+        root -- the TMS folder the tiles live in
+        tiles -- an iterable of tile dictionaries
+        """
+        index = cls(root)
+        index.extend(tiles)
+        return index
+
+    def append(self, z, x, y, ext):
+        """
+        Add a tile to the index.
+
+        Inputs:
+        z -- the zoom level of the tile
+        x -- the x (column directory) value of the tile
+        y -- the y (file name) value of the tile
+        ext -- the file extension of the tile, one of IMAGE_TYPES
+        """
+        size = len(self.__z)
+        if size and self.__sorted:
+            last = self.__z[-1], self.__x[-1], self.__y[-1]
+            self.__sorted = last <= (z, x, y)
+        self.__z.append(z)
+        self.__x.append(x)
+        self.__y.append(y)
+        self.__ext.append(IMAGE_TYPES.index(ext))
+
+    def add(self, tile):
+        """
+        Add a tile dictionary to the index.
+
+        Inputs:
+        tile -- a dictionary with z, x, y and path keys
+        """
+        path = tile['path']
+        self.append(tile['z'], tile['x'], tile['y'], path[path.rindex('.'):])
+
+    def extend(self, tiles):
+        """
+        Add several tile dictionaries to the index.
+
+        Inputs:
+        tiles -- an iterable of tile dictionaries
+        """
+        for tile in tiles:
+            self.add(tile)
+
+    @property
+    def columns(self):
+        """Return the zoom, x and y arrays of this index."""
+        return self.__z, self.__x, self.__y
+
+    def path(self, i):
+        """
+        Return the full file path of a tile.
+
+        Inputs:
+        i -- the position of the tile in this index
+        """
+        return join(self.root, str(self.__z[i]), str(self.__x[i]),
+                    str(self.__y[i]) + IMAGE_TYPES[self.__ext[i]])
+
+    def zoom_levels(self):
+        """Return a sorted list of the zoom levels in this index."""
+        return sorted(set(self.__z))
+
+    def sort(self):
+        """Sort the index in place by zoom, then x, then y."""
+        if self.__sorted:
+            return
+        # Sorting zipped tuples keeps all the comparisons in C
+        rows = sorted(zip(self.__z, self.__x, self.__y, self.__ext))
+        self.__z = array('i', (row[0] for row in rows))
+        self.__x = array('i', (row[1] for row in rows))
+        self.__y = array('i', (row[2] for row in rows))
+        self.__ext = array('b', (row[3] for row in rows))
+        self.__sorted = True
+
+    def zoom(self, zoom):
+        """
+        Return a new index holding only the tiles of one zoom level.  On a
+        sorted index this is a contiguous slice found by bisection.
+
+        Inputs:
+        zoom -- the zoom level to select
+        """
+        if self.__sorted:
+            return self[bisect_left(self.__z, zoom):
+                        bisect_right(self.__z, zoom)]
+        index = TileIndex(self.root)
+        for i in xrange(len(self)):
+            if self.__z[i] == zoom:
+                index.append(zoom, self.__x[i], self.__y[i],
+                             IMAGE_TYPES[self.__ext[i]])
+        return index
+
+    def __len__(self):
+        """Return the number of tiles in this index."""
+        return len(self.__z)
+
+    def __getitem__(self, key):
+        """
+        Return a tile dictionary for an integer key or a new index for a
+        slice.
+        """
+        if isinstance(key, slice):
+            index = TileIndex(self.root)
+            index.__z = self.__z[key]
+            index.__x = self.__x[key]
+            index.__y = self.__y[key]
+            index.__ext = self.__ext[key]
+            index.__sorted = self.__sorted and key.step in (None, 1)
+            return index
+        if key < 0:
+            key += len(self)
+        return dict(z=self.__z[key], x=self.__x[key], y=self.__y[key],
+                    path=self.path(key))
+
+    def __iter__(self):
+        """Iterate over the tiles as dictionaries."""
+        for i in xrange(len(self)):
+            yield self[i]
+
+
+class TileShard(object):
+    """
+    Work description of a sharded run (-shards): a run of the x directories
+    of one zoom level, which the worker lists itself instead of being handed
+    the tiles.  It pickles as a few bytes per column, however many tiles
+    the columns hold.
+    """
+
+    def __init__(self, root, zoom, columns, estimate, done=None):
+        """
+        Constructor.
+
+        Inputs:
+        root -- the TMS folder the tiles live in
+        zoom -- the zoom level of the columns
+        columns -- the x values of the column directories
+        estimate -- the expected number of tiles, used for the progress
+                    line and the chunk sizes until the shard is listed
+        done -- a dictionary from x to the (min y, max y) ranges of tiles a
+                resumed run already wrote (see RunJournal.done_columns())
+        """
+        self.root = root
+        self.zoom = zoom
+        self.columns = array('i', columns)
+        self.estimate = estimate
+        self.done = done or {}
+
+    def tiles(self):
+        """
+        List the tiles of the shard.
+
+        Returns:
+        A tuple of a sorted TileIndex of the tiles that are not done yet and
+        the number of tiles that are.
+        """
+        index = TileIndex(self.root)
+        skipped = 0
+        zoom_dir = join(self.root, str(self.zoom))
+        for x in self.columns:
+            done = self.done.get(x, ())
+            records = _scan_column((join(zoom_dir, str(x)), self.zoom, x))
+            for record in sorted(records, key=lambda record: record['y']):
+                if any(low <= record['y'] <= high for low, high in done):
+                    skipped += 1
+                else:
+                    index.add(record)
+        return index, skipped
+
+    def __len__(self):
+        """Return the expected number of tiles in the shard."""
+        return self.estimate
+
+
+def img_to_buf(img, img_type, jpeg_quality=75):
+    """
+    Returns a buffer array with image binary data for the input image.
+    This code is based on logic implemented in MapProxy to convert PNG
+    images to JPEG then return the buffer.
+
+    Inputs:
+    img -- an image on the filesystem to be converted to binary
+    img_type -- the MIME type of the image (JPG, PNG)
+    """
+    defaults = {}
+    buf = ioBuffer()
+    if img_type == 'jpeg':
+        if img.mode not in ('RGB', 'L'):
+            # JPEG has no alpha or palette support
+            img = img.convert('RGB')
+        # Hardcoding a default compression of 75% for JPEGs
+        defaults['quality'] = jpeg_quality
+    elif img_type == 'source':
+        img_type = img.format
+    img.save(buf, img_type, **defaults)
+    buf.seek(0)
+    return buf
+
+
+def sniff_format(data):
+    """
+    Returns the image format of encoded tile data from its leading magic
+    bytes: 'png', 'jpeg', or None for anything else.
+
+    Inputs:
+    data -- the encoded image bytes
+    """
+    for signature, img_type in IMAGE_SIGNATURES:
+        if data[:len(signature)] == signature:
+            return img_type
+    return None
+
+
+def read_tile(path, use_mmap=False):
+    """
+    Returns the raw bytes of a tile file.
+
+    Inputs:
+    path -- the full path of the tile
+    use_mmap -- read the file through a memory map instead of read()
+    """
+    with open(path, 'rb') as file_handle:
+        if use_mmap:
+            try:
+                mapped = mmap(file_handle.fileno(), 0, access=ACCESS_READ)
+            except ValueError:
+                # Empty files cannot be mapped
+                return b''
+            try:
+                return mapped[:]
+            finally:
+                mapped.close()
+        return file_handle.read()
+
+
+def img_has_transparency(img):
+    """
+    Returns a 0 if the input image has no transparency, 1 if it has some,
+    and -1 if the image is fully transparent.  Only fully transparent
+    pixels (alpha of 0) count.  The alpha band is classified from its
+    minimum and maximum values, which PIL computes in a single pass without
+    building a histogram, so this works for any tile size.  This code is
+    based on logic implemented in MapProxy to check for images that have
+    transparency.
+
+    Inputs:
+    img -- an Image object from the PIL library
+    """
+    if img.mode == 'P':
+        # For paletted images
+        if 'transparency' not in img.info:
+            return 0
+        # Convert to RGBA to check alpha
+        img = img.convert('RGBA')
+    if img.mode in ('RGBA', 'LA', 'PA'):
+        # Only the alpha band is extracted; the extrema of the whole image
+        # would also scan the color bands
+        if hasattr(img, 'getchannel'):
+            alpha = img.getchannel('A')
+        else:
+            alpha = img.split()[-1]
+        low, high = alpha.getextrema()
+        if low > 0:
+            # No transparency
+            return 0
+        elif high > 0:
+            # Image has some transparency
+            return 1
+        else:
+            # Image is fully transparent, and can be discarded
+            return -1
+    return 0
+
+
+def list_dir(path):
+    """
+    Returns the entries of a directory as (name, is_dir) tuples.  Uses
+    os.scandir where available so no extra stat call is made per entry.
+
+    Inputs:
+    path -- the directory to list
+    """
+    if scandir is not None:
+        return [(entry.name, entry.is_dir()) for entry in scandir(path)]
+    return [(name, isdir(join(path, name))) for name in listdir(path)]
+
+
+def scan_zoom_levels(base_dir):
+    """
+    Returns a sorted list of the zoom levels (z directories) present in a
+    TMS folder.
+
+    Inputs:
+    base_dir -- the name of the TMS folder containing tiles.
+    """
+    return sorted(int(name) for name, is_dir in list_dir(base_dir)
+                  if is_dir and name.isdigit())
+
+
+def _scan_zoom(args):
+    """
+    Thread pool task that lists the x directories of one zoom directory.
+
+    Inputs:
+    args -- a (zoom directory, zoom level) tuple
+
+    Returns:
+    A list of (column directory, zoom level, x value) tuples.
+    """
+    zoom_dir, zoom = args
+    return [(join(zoom_dir, name), zoom, int(name))
+            for name, is_dir in list_dir(zoom_dir)
+            if is_dir and name.isdigit()]
+
+
+def _scan_column(args, with_stat=False):
+    """
+    Thread pool task that lists the image tiles of one z/x directory.
+
+    Inputs:
+    args -- a (column directory, zoom level, x value) tuple
+    with_stat -- also add the size and mtime of each tile file
+
+    Returns:
+    A list of tile dictionaries in the format produced by split_all().
+    """
+    column_dir, zoom, x = args
+    records = []
+    for name, is_dir in list_dir(column_dir):
+        if is_dir or not name.endswith(IMAGE_TYPES):
+            continue
+        stem = name.split('.')[0]
+        if stem.isdigit():
+            record = dict(z=zoom, x=x, y=int(stem),
+                          path=join(column_dir, name))
+            if with_stat:
+                info = stat(record['path'])
+                record['size'] = info.st_size
+                record['mtime'] = info.st_mtime
+            records.append(record)
+    return records
+
+
+def scan_tiles(base_dir, zoom_levels=None, threads=SCAN_THREADS,
+               with_stat=False):
+    """
+    Generator that finds all image tiles in a TMS folder.  The zoom and x
+    directories are listed concurrently on a thread pool and tiles are
+    yielded as soon as their column directory has been read, so callers can
+    start work before the whole tree has been scanned.  Tiles from the same
+    z/x directory are always yielded together.
+
+    Inputs:
+    base_dir -- the name of the TMS folder containing tiles.
+    zoom_levels -- an optional list of zoom levels to restrict the scan to
+    threads -- the number of threads used to list directories
+    with_stat -- also stat every tile file on the scan threads, adding size
+                 and mtime keys to the tile dictionaries
+
+    Returns:
+    A generator of dictionary objects containing the full file path and TMS
+    coordinates of each image tile.
+    """
+    if zoom_levels is None:
+        zoom_levels = scan_zoom_levels(base_dir)
+    zoom_dirs = [(join(base_dir, str(zoom)), zoom) for zoom in zoom_levels]
+    zoom_dirs = [item for item in zoom_dirs if isdir(item[0])]
+    pool = ThreadPool(threads)
+    try:
+        # All zoom tasks are queued before the column tasks that consume
+        # them, so the shared pool cannot deadlock on itself
+        columns = chain.from_iterable(pool.imap_unordered(_scan_zoom,
+                                                          zoom_dirs))
+        scan_column = partial(_scan_column, with_stat=with_stat)
+        for records in pool.imap_unordered(scan_column, columns):
+            for record in records:
+                yield record
+    finally:
+        pool.terminate()
+
+
+def scan_anchor_tiles(base_dir, zoom_levels, with_stat=False):
+    """
+    Scans only the zoom levels that build_lut() cannot derive from the level
+    above them, i.e. those whose preceding zoom level is absent.  This is
+    usually just the top of the pyramid, so the tile matrix metadata can be
+    built long before the rest of the tree has been scanned.
+
+    Inputs:
+    base_dir -- the name of the TMS folder containing tiles.
+    zoom_levels -- the zoom levels present in base_dir
+    with_stat -- add the size and mtime of each tile (see scan_tiles())
+
+    Returns:
+    A tuple of the zoom levels that contain tiles and a list of the tile
+    dictionaries found on the anchor zoom levels.
+    """
+    zoom_levels = sorted(zoom_levels)
+    scanned = set()
+    tiles = []
+    while True:
+        anchors = [zoom for zoom in zoom_levels
+                   if zoom - 1 not in zoom_levels and zoom not in scanned]
+        if not anchors:
+            return zoom_levels, tiles
+        found = list(scan_tiles(base_dir, anchors, with_stat=with_stat))
+        scanned.update(anchors)
+        tiles += found
+        # An empty anchor is dropped, which promotes the next level down
+        present = set(item['z'] for item in found)
+        zoom_levels = [zoom for zoom in zoom_levels
+                       if zoom in present or zoom not in anchors]
+
+
+def spread(items, count):
+    """Returns up to count items spaced evenly through a list."""
+    if len(items) <= count:
+        return items
+    return [items[i * len(items) // count] for i in xrange(count)]
+
+
+def sample_tile_sizes(base_dir, zoom_levels, count=PAGE_SIZE_SAMPLE,
+                      columns=PAGE_SIZE_COLUMNS):
+    """
+    Returns the file sizes of up to count tiles of the deepest zoom level of
+    a TMS folder that has tiles.  The tiles are spread over a few column
+    directories across the zoom level, since neighbouring tiles (the edge
+    of the data, open water) tend to have similar sizes.
+
+    Inputs:
+    base_dir -- the name of the TMS folder containing tiles.
+    zoom_levels -- the zoom levels present in base_dir
+    count -- the number of tiles to sample
+    columns -- the number of column directories to sample them from
+    """
+    for zoom in sorted(zoom_levels, reverse=True):
+        zoom_dir = join(base_dir, str(zoom))
+        column_dirs = sorted(join(zoom_dir, name) for name, is_dir
+                             in list_dir(zoom_dir) if is_dir)
+        sizes = []
+        for column_dir in spread(column_dirs, columns):
+            names = sorted(name for name, is_dir in list_dir(column_dir)
+                           if not is_dir and
+                           name.lower().endswith(IMAGE_TYPES))
+            sizes += [getsize(join(column_dir, name)) for name in
+                      spread(names, max(1, count // columns))]
+        if sizes:
+            return sizes
+    return []
+
+
+def tile_pages(page_size, tile_size):
+    """
+    Returns the space a tile takes up in a SQLite table with the given page
+    size, and the number of pages read to get it.  A row larger than a leaf
+    page allows keeps part of it on the leaf page and the rest on a chain of
+    overflow pages, and small rows share leaf pages.
+
+    Inputs:
+    page_size -- the page size of the database
+    tile_size -- the size of the tile blob, in bytes
+    """
+    # The record header and the three tile coordinates come with the blob,
+    # and each cell adds a pointer, its size and the rowid to the leaf page
+    payload = tile_size + 16
+    max_local = page_size - 35
+    min_local = (page_size - 12) * 32 // 255 - 23
+    local = payload
+    if payload > max_local:
+        local = min_local + (payload - min_local) % (page_size - 4)
+        if local > max_local:
+            local = min_local
+    overflow = -(-(payload - local) // (page_size - 4))
+    per_leaf = max(1, (page_size - 8) // (local + 12))
+    return (overflow + 1.0 / per_leaf) * page_size, overflow + 1
+
+
+def choose_page_size(sizes):
+    """
+    Returns the page size for a geopackage of tiles with the median of a
+    sample of tile sizes (see MIN_PAGE_SIZE).  Tiles that fit on a page are
+    read at once, but pages that tiles only fill halfway make a larger file.
+
+    Inputs:
+    sizes -- the sizes of the sampled tiles, in bytes
+    """
+    if not sizes:
+        return MIN_PAGE_SIZE
+    median = sorted(sizes)[len(sizes) // 2]
+    candidates = []
+    page_size = MIN_PAGE_SIZE
+    while page_size <= MAX_PAGE_SIZE:
+        candidates.append((page_size,) + tile_pages(page_size, median))
+        page_size *= 2
+    smallest = min(space for _, space, _ in candidates)
+    return min((reads, page_size) for page_size, space, reads in candidates
+               if space <= smallest * (1 + PAGE_SIZE_SLACK))[1]
 
 
 def file_count(base_dir):
@@ -944,18 +3059,13 @@ def file_count(base_dir):
     base_dir -- the name of the TMS folder containing tiles.
 
     Returns:
-    A list of dictionary objects containing the full file path and TMS
-    coordinates of the image tile.
+    A TileIndex of the image tiles, which iterates as dictionary objects
+    containing the full file path and TMS coordinates of each tile.
     """
     print("Calculating number of tiles, this could take a while...")
-    file_list = []
-    # Avoiding dots (functional references) will increase performance of
-    #  the loop because they will not be reevaluated each iteration.
-    for root, sub_folders, files in walk(base_dir):
-        temp_list = [join(root, f) for f in files if f.endswith(IMAGE_TYPES)]
-        file_list += temp_list
+    file_list = TileIndex.from_tiles(base_dir, scan_tiles(base_dir))
     print("Found {} total tiles.".format(len(file_list)))
-    return [split_all(item) for item in file_list]
+    return file_list
 
 
 def split_all(path):
@@ -992,12 +3102,61 @@ def worker_map(temp_db, tile_dict, extra_args, invert_y):
     temp_db -- a temporary sqlite3 database that will hold this worker's tiles
     tile_dict -- a dictionary with TMS coordinates and file path for a tile
     tile_info -- a list of ZoomMetadata objects pre-generated for this tile set
-    imagery -- the type of image format to send to the sqlite3 database
+    imagery -- the type of image format to send to the sqlite3 database;
+               'source' tiles, and png or jpeg tiles that already have the
+               requested format, are stored without being decoded
+    skip_empty -- leave fully transparent tiles out of the database
     invert_y -- a function that will flip the Y axis of the tile if present
+
+    Returns:
+    The number of source bytes read and of tile bytes stored.
     """
-    tile_info = extra_args['tile_info']
     imagery = extra_args['imagery']
     jpeg_quality = extra_args['jpeg_quality']
+    zoom, x_row, y_column = tile_position(tile_dict, extra_args['tile_info'],
+                                          invert_y)
+    skip_empty = extra_args.get('skip_empty', False)
+    with timed('read'):
+        data = read_tile(tile_dict['path'], extra_args.get('use_mmap', False))
+    img_type = sniff_format(data)
+    bytes_in = len(data)
+    # Tiles are only decoded to pick a format in mixed mode, to convert
+    # them, or to find empty ones (JPEGs cannot be transparent)
+    decode = IOPEN is not None and \
+        (imagery == 'mixed' or (skip_empty and img_type != 'jpeg') or
+         (imagery in ('png', 'jpeg') and img_type != imagery))
+    cache = _ENCODE_CACHE if decode else None
+    if cache is not None:
+        # The same source bytes encode differently under other options
+        with timed('cache'):
+            key = (cache.key(data), imagery, jpeg_quality, skip_empty)
+            cached = key in cache
+        if cached:
+            data = cache.get(key)
+        else:
+            data = cache.put(key, encode_tile(data, img_type, imagery,
+                                              jpeg_quality, skip_empty))
+    else:
+        data = encode_tile(data, img_type, imagery, jpeg_quality, skip_empty)
+    if data is None:
+        return bytes_in, 0
+    with timed('insert'):
+        temp_db.insert_image_blob(zoom, x_row, y_column, sbinary(data))
+    return bytes_in, len(data)
+
+
+def tile_position(tile_dict, tile_info, invert_y):
+    """
+    Returns the position of a source tile in the geopackage tile matrix.
+
+    Inputs:
+    tile_dict -- a dictionary with the TMS coordinates of the tile
+    tile_info -- a list of ZoomMetadata objects pre-generated for this tile set
+    invert_y -- a function that will flip the Y axis of the tile if present
+
+    Returns:
+    A (zoom level, tile column, tile row) tuple.
+    """
     zoom = tile_dict['z']
     level = next((item for item in tile_info if item.zoom == zoom), None)
     x_row = tile_dict['x'] - level.min_tile_row
@@ -1007,22 +3166,123 @@ def worker_map(temp_db, tile_dict, extra_args, invert_y):
         y_column -= y_offset
     else:
         y_column = tile_dict['y'] - level.min_tile_col
-    if IOPEN is not None:
-        img = IOPEN(tile_dict['path'], 'r')
-        data = ioBuffer()
-        if imagery == 'mixed':
-            if img_has_transparency(img):
-                data = img_to_buf(img, 'png', jpeg_quality).read()
-            else:
-                data = img_to_buf(img, 'jpeg', jpeg_quality).read()
-        else:
-            data = img_to_buf(img, imagery, jpeg_quality).read()
-        temp_db.insert_image_blob(zoom, x_row, y_column, sbinary(data))
+    return zoom, x_row, y_column
+
+
+def get_invert_y(lower_left, srs):
+    """
+    Returns the function that flips the Y axis of TMS tiles in a spatial
+    reference system, or None if the tiles are numbered from the top.
+
+    Inputs:
+    lower_left -- bool indicating tile grid numbering scheme (tms or wmts)
+    srs -- the spatial reference system of the tile grid
+    """
+    if not lower_left:
+        return None
+    if srs == 3857:
+        return Mercator.invert_y
+    elif srs == 4326:
+        return Geodetic.invert_y
+    elif srs == 3395:
+        return EllipsoidalMercator.invert_y
+    elif srs == 9804:
+        return ScaledWorldMercator.invert_y
+    return None
+
+
+def encode_tile(data, img_type, imagery, jpeg_quality, skip_empty=False):
+    """
+    Returns the bytes that should be stored for a source tile.
+
+    Inputs:
+    data -- the raw bytes of the source tile
+    img_type -- the format of data as returned by sniff_format()
+    imagery -- the type of image format to store (mixed, jpeg, png, source)
+    jpeg_quality -- the quality of JPEGs this function encodes
+    skip_empty -- return None for fully transparent tiles
+
+    Returns:
+    The encoded tile, or None if it should be left out.
+    """
+    img = transparency = None
+    if IOPEN is not None and \
+            (imagery == 'mixed' or (skip_empty and img_type != 'jpeg')):
+        img = decode_tile(data)
+        with timed('transparency'):
+            transparency = img_has_transparency(img)
+        if skip_empty and transparency == -1:
+            # A fully transparent tile holds no imagery, so leave it out
+            return None
+    if IOPEN is None or imagery == 'source' or \
+            (imagery in ('png', 'jpeg') and img_type == imagery):
+        # The stored bytes already have the requested format, so keep
+        # them untouched rather than decoding and re-encoding them
+        return data
+    if img is None:
+        img = decode_tile(data)
+    if imagery == 'mixed':
+        img_type = 'png' if transparency else 'jpeg'
     else:
-        file_handle = open(tile_dict['path'], 'rb')
-        data = buffer(file_handle.read())
-        temp_db.insert_image_blob(zoom, x_row, y_column, data)
-        file_handle.close()
+        img_type = imagery
+    with timed('encode'):
+        return img_to_buf(img, img_type, jpeg_quality).read()
+
+
+def decode_tile(data):
+    """
+    Returns the decoded PIL image of an encoded tile.  PIL opens images
+    lazily, so the pixels are loaded here to keep the decoding separate
+    from whatever uses them.
+
+    Inputs:
+    data -- the raw bytes of the tile
+    """
+    with timed('decode'):
+        img = IOPEN(ioBuffer(data), 'r')
+        img.load()
+    return img
+
+
+@contextmanager
+def worker_part(extra_args):
+    """
+    Lend the TempDB this worker process writes the chunks of a tile table
+    into.  It is kept open across chunks, and only replaced by a new one
+    once it holds PART_BYTES, so a run writes a few large .gpkg.part files
+    rather than one per chunk.  The part is synced after each chunk, so the
+    chunk can be journaled as done.
+
+    Inputs:
+    extra_args -- the options of sqlite_worker()
+    """
+    key = (extra_args.get('table_name', 'tiles'),
+           extra_args.get('temp_dir') or extra_args['root_dir'],
+           extra_args.get('page_size'))
+    temp_db = _PART_DBS.get(key)
+    if temp_db is None:
+        temp_db = TempDB(key[1], extra_args.get('batch_tiles', BATCH_TILES),
+                         extra_args.get('batch_bytes', BATCH_BYTES), key[2])
+        _PART_DBS[key] = temp_db
+    try:
+        yield temp_db
+    except Exception:
+        # The chunk failed half written: close the part without flushing it,
+        # and let the next chunk start a new one
+        del _PART_DBS[key]
+        with temp_db:
+            raise
+    temp_db.sync()
+    if temp_db.size() >= PART_BYTES:
+        del _PART_DBS[key]
+        temp_db.close()
+
+
+def close_worker_parts():
+    """Close the .gpkg.part files this worker process still has open."""
+    for temp_db in _PART_DBS.values():
+        temp_db.close()
+    _PART_DBS.clear()
 
 
 def sqlite_worker(file_list, extra_args):
@@ -1037,41 +3297,223 @@ def sqlite_worker(file_list, extra_args):
                 .gpkg.part files will be generated here
     metadata -- a ZoomLevelMetadata object containing information about
                 the tiles in the TMS directory
+
+    Returns:
+    A dictionary with the number of tiles processed, the time spent, the
+    encode cache hits and misses and the .gpkg.part file (if any) the
+    chunk was written to, or the serialized database under 'data' if it
+    was kept in memory (extra_args['memory_bytes']).  A profiled run
+    (extra_args['profile']) adds the process id of the worker, its seconds
+    per stage of worker_map() and the file its cProfile statistics so far
+    were written to.
+    """
+    global _ENCODE_CACHE, _STAGE_TIMERS, _PROFILER
+    profile = extra_args.get('profile')
+    if not profile:
+        _STAGE_TIMERS = _PROFILER = None
+    elif _PROFILER is None:
+        # Both live on in the worker process between chunks
+        _STAGE_TIMERS = StageTimers()
+        _PROFILER = Profile()
+    if profile:
+        timed_before = dict(_STAGE_TIMERS.seconds)
+        _PROFILER.enable()
+    cache_bytes = extra_args.get('encode_cache_bytes', 0)
+    if not cache_bytes:
+        _ENCODE_CACHE = None
+    elif _ENCODE_CACHE is None or _ENCODE_CACHE.max_bytes != cache_bytes:
+        # The cache lives on in the worker process between chunks
+        _ENCODE_CACHE = EncodeCache(cache_bytes)
+    hits, misses = (_ENCODE_CACHE.hits, _ENCODE_CACHE.misses) \
+        if _ENCODE_CACHE is not None else (0, 0)
+    start = time()
+    batch_tiles = extra_args.get('batch_tiles', BATCH_TILES)
+    batch_bytes = extra_args.get('batch_bytes', BATCH_BYTES)
+    if extra_args.get('single_writer'):
+        sink = QueueDB(_WRITER_QUEUE, batch_tiles, batch_bytes,
+                       extra_args.get('table_name', 'tiles'))
+    elif extra_args.get('memory_bytes'):
+        # Handed over whole at the end of the chunk
+        sink = TempDB(extra_args.get('temp_dir') or extra_args['root_dir'],
+                      batch_tiles, batch_bytes, extra_args.get('page_size'),
+                      extra_args['memory_bytes'])
+    else:
+        sink = worker_part(extra_args)
+    with sink as temp_db:
+        invert_y = get_invert_y(extra_args['lower_left'], extra_args['srs'])
+        tiles = bytes_in = bytes_out = 0
+        published = (0, 0, 0)
+        for item in file_list:
+            read, written = worker_map(temp_db, item, extra_args, invert_y)
+            tiles += 1
+            bytes_in += read
+            bytes_out += written
+            if _PROGRESS is not None and \
+                    (tiles % PROGRESS_TILES == 0 or tiles == len(file_list)):
+                # Publish what was done since the last update
+                _PROGRESS.add(tiles - published[0], bytes_in - published[1],
+                              bytes_out - published[2])
+                published = (tiles, bytes_in, bytes_out)
+    stats = dict(tiles=len(file_list), seconds=time() - start,
+                 bytes_in=bytes_in, bytes_out=bytes_out,
+                 cache_hits=0, cache_misses=0)
+    if _ENCODE_CACHE is not None:
+        stats['cache_hits'] = _ENCODE_CACHE.hits - hits
+        stats['cache_misses'] = _ENCODE_CACHE.misses - misses
+    if not extra_args.get('single_writer'):
+        if temp_db.data is not None:
+            stats['data'] = temp_db.data
+        else:
+            stats['part'] = temp_db.file_path
+    if profile:
+        _PROFILER.disable()
+        # The statistics of all chunks so far, merged by the parent
+        stats['profile'] = '{}.{}'.format(profile, getpid())
+        _PROFILER.dump_stats(stats['profile'])
+        stats['worker'] = getpid()
+        stats['stages'] = _STAGE_TIMERS.since(timed_before)
+    return stats
+
+
+def shard_worker(shard, extra_args):
+    """
+    Worker function of a sharded run, called by asynchronous processes.
+    Lists the tiles of a shard of column directories and processes them
+    with sqlite_worker(), so the parent never holds the tiles.
+
+    Inputs:
+    shard -- a TileShard
+    extra_args -- the options of sqlite_worker()
+
+    Returns:
+    The statistics of sqlite_worker(), with the number of tiles of the
+    shard that a resumed run already wrote under 'skipped' and the tiles
+    written, as ranges for RunJournal.ranges_done(), under 'ranges'.
+    """
+    tiles, skipped = shard.tiles()
+    if len(tiles):
+        stats = sqlite_worker(tiles, extra_args)
+    else:
+        # Nothing to write, so no part file either
+        stats = dict(tiles=0, seconds=0.0, bytes_in=0, bytes_out=0,
+                     cache_hits=0, cache_misses=0)
+    stats['skipped'] = skipped
+    stats['ranges'] = column_ranges(tiles)
+    return stats
+
+
+def init_worker(queue=None, counters=None):
+    """
+    Pool initializer that gives a worker process the queue to the single
+    writer process and the shared progress counters, and closes its part
+    files when it exits.
+
+    Inputs:
+    queue -- the multiprocessing queue read by gpkg_writer(), if any
+    counters -- the ProgressCounters of the run, if any
+    """
+    global _WRITER_QUEUE, _PROGRESS
+    _WRITER_QUEUE = queue
+    _PROGRESS = counters
+    # The part files stay open between chunks, and are closed when the
+    # process exits
+    Finalize(None, close_worker_parts, exitpriority=10)
+
+
+def gpkg_writer(queue, file_path):
+    """
+    Process target of the single writer pipeline.  Takes tile batches off the
+    queue and inserts each one straight into its tile table of the output
+    geopackage in a single transaction, until a None sentinel is received.
+
+    Inputs:
+    queue -- the multiprocessing queue filled by QueueDB objects
+    file_path -- the path of the output geopackage, or of its bulk load
+                 staging database; or a dictionary mapping each tile table
+                 name to one of those paths
     """
-    temp_db = TempDB(extra_args['root_dir'])
-    with TempDB(extra_args['root_dir']) as temp_db:
-        invert_y = None
-        if extra_args['lower_left']:
-            if extra_args['srs'] == 3857:
-                invert_y = Mercator.invert_y
-            elif extra_args['srs'] == 4326:
-                invert_y = Geodetic.invert_y
-            elif extra_args['srs'] == 3395:
-                invert_y = EllipsoidalMercator.invert_y
-            elif extra_args['srs'] == 9804:
-                invert_y = ScaledWorldMercator.invert_y
-        [worker_map(temp_db, item, extra_args, invert_y) for item in file_list]
+    if not isinstance(file_path, dict):
+        file_path = dict(tiles=file_path)
+    connections = {}
+    try:
+        for path in set(file_path.values()):
+            connections[path] = connect(path)
+            connections[path].execute("pragma synchronous = off;")
+            connections[path].execute("pragma cache_size = -{};".format(
+                BUILD_CACHE_KIB))
+        while True:
+            item = queue.get()
+            if item is None:
+                break
+            table, batch = item
+            db_con = connections[file_path[table]]
+            with db_con:
+                db_con.executemany("INSERT OR REPLACE INTO " + table + """
+                    (zoom_level, tile_column, tile_row, tile_data)
+                    VALUES (?,?,?,?)""", batch)
+    finally:
+        for db_con in connections.values():
+            db_con.close()
 
 
 def allocate(cores, pool, file_list, extra_args):
     """
-    Recursive function that fairly distributes tiles to asynchronous worker
-    processes.  For N processes and C cores, N=C if C is divisible by 2.  If
-    not, then N is the largest factor of 8 that is still less than C.
+    Splits the tiles into one slice per core, with sizes that differ by at
+    most one tile, and hands each slice to an asynchronous worker process.
+    main() uses the dynamic scheduling in run_workers() instead, which
+    balances uneven per-tile costs; this is kept for callers that want one
+    fixed slice per worker.
+
+    Returns:
+    A list of AsyncResult objects, one per slice.
     """
-    if cores is 1:
-        print("Spawning worker with {} files".format(len(file_list)))
-        return [pool.apply_async(sqlite_worker, [file_list, extra_args])]
-    else:
-        files = len(file_list)
-        head = allocate(
-            int(cores / 2), pool, file_list[:int(files / 2)], extra_args)
-        tail = allocate(
-            int(cores / 2), pool, file_list[int(files / 2):], extra_args)
-        return head + tail
+    size, extra = divmod(len(file_list), cores)
+    results = []
+    start = 0
+    for i in xrange(cores):
+        end = start + size + (1 if i < extra else 0)
+        results.append(pool.apply_async(sqlite_worker,
+                                        [file_list[start:end], extra_args]))
+        start = end
+    return results
+
+
+def zoom_extents(file_list):
+    """
+    Finds the minimum and maximum x and y values of every zoom level in a
+    single pass over the tiles.
 
+    Inputs:
+    file_list -- a TileIndex or a list of tile dictionaries
 
-def build_lut(file_list, lower_left, srs):
+    Returns:
+    A dictionary mapping each zoom level to a [min x, max x, min y, max y]
+    list.
+    """
+    if isinstance(file_list, TileIndex):
+        # Read the integer columns directly instead of building dicts
+        coords = zip(*file_list.columns)
+    else:
+        coords = ((int(item['z']), int(item['x']), int(item['y']))
+                  for item in file_list)
+    extents = {}
+    for z, x, y in coords:
+        extent = extents.get(z)
+        if extent is None:
+            extents[z] = [x, x, y, y]
+            continue
+        if x < extent[0]:
+            extent[0] = x
+        elif x > extent[1]:
+            extent[1] = x
+        if y < extent[2]:
+            extent[2] = y
+        elif y > extent[3]:
+            extent[3] = y
+    return extents
+
+
+def build_lut(file_list, lower_left, srs, zoom_levels=None):
     """
     Build a lookup table that aids in metadata generation.
 
@@ -1079,6 +3521,9 @@ def build_lut(file_list, lower_left, srs):
     file_list -- the file_list dict made with file_count()
     lower_left -- bool indicating tile grid numbering scheme (tms or wmts)
     srs -- the spatial reference system of the tile grid
+    zoom_levels -- optional list of every zoom level in the tile grid; when
+                   given, file_list only needs the tiles of the levels that
+                   do not follow another level (see scan_anchor_tiles())
 
     Returns:
     An array of ZoomLevelMetadata objects that describe each zoom level of the
@@ -1093,10 +3538,13 @@ def build_lut(file_list, lower_left, srs):
         projection = ScaledWorldMercator()
     else:
         projection = EllipsoidalMercator()
-    # Create a list of zoom levels from the base directory
-    zoom_levels = list(set([int(item['z']) for item in file_list]))
-    zoom_levels.sort()
+    # Gather the tile extent of every zoom level in one pass
+    extents = zoom_extents(file_list)
+    if zoom_levels is None:
+        zoom_levels = extents.keys()
+    zoom_levels = sorted(zoom_levels)
     matrix = []
+    levels = {}
     # For every zoom in the list...
     for zoom in zoom_levels:
         # create a new ZoomMetadata object...
@@ -1107,10 +3555,9 @@ def build_lut(file_list, lower_left, srs):
         # in tiles "shifting" because of the way they are renumbered when
         # placed into a geopackage.
         # To fix, is there a zoom level preceding this one...
-        if zoom - 1 in [item for item in zoom_levels if item == (zoom - 1)]:
-            # there is, now retrieve it....
-            (prev, ) = ([item for item in matrix if item.zoom == (zoom - 1)])
-            # and fix the grid alignment values
+        prev = levels.get(zoom - 1)
+        if prev is not None:
+            # there is, so fix the grid alignment values
             level.min_tile_row = 2 * prev.min_tile_row
             level.min_tile_col = 2 * prev.min_tile_col
             level.max_tile_row = 2 * prev.max_tile_row + 1
@@ -1119,25 +3566,13 @@ def build_lut(file_list, lower_left, srs):
             level.matrix_width = prev.matrix_width * 2
             level.matrix_height = prev.matrix_height * 2
         else:
-            # Get all possible x and y values...
-            x_vals = [int(item['x'])
-                      for item in file_list if int(item['z']) == zoom]
-            y_vals = [int(item['y'])
-                      for item in file_list if int(item['z']) == zoom]
-            # then get the min/max values for each.
-            level.min_tile_row, level.max_tile_row = min(x_vals), max(x_vals)
-            level.min_tile_col, level.max_tile_col = min(y_vals), max(y_vals)
-            # Fill in the matrix width and height for this top level
-            x_width_max = max([item[
-                'x'] for item in file_list if item['z'] == level.zoom])
-            x_width_min = min([item[
-                'x'] for item in file_list if item['z'] == level.zoom])
-            level.matrix_width = (x_width_max - x_width_min) + 1
-            y_height_max = max([item[
-                'y'] for item in file_list if item['z'] == level.zoom])
-            y_height_min = min([item[
-                'y'] for item in file_list if item['z'] == level.zoom])
-            level.matrix_height = (y_height_max - y_height_min) + 1
+            # Get the min/max x and y values...
+            min_x, max_x, min_y, max_y = extents[zoom]
+            level.min_tile_row, level.max_tile_row = min_x, max_x
+            level.min_tile_col, level.max_tile_col = min_y, max_y
+            # and fill in the matrix width and height for this top level
+            level.matrix_width = (max_x - min_x) + 1
+            level.matrix_height = (max_y - min_y) + 1
         if lower_left:
             # TMS-style tile grid, so to calc the top left corner of the grid,
             # you must get the min x (row) value and the max y (col) value + 1.
@@ -1163,119 +3598,802 @@ def build_lut(file_list, lower_left, srs):
                 level.zoom, level.max_tile_row + 1, inv_max_y)
         # Finally, add this ZoomMetadata object to the list
         matrix.append(level)
+        levels[zoom] = level
     return matrix
 
 
-def combine_worker_dbs(out_geopackage):
+def combine_worker_dbs(out_geopackage, file_list=None, journal=None):
     """
-    Searches for .gpkg.part files in the base directory and merges them
-    into one Geopackage file
+    Merges .gpkg.part files into one Geopackage file
 
     Inputs:
     out_geopackage -- the final output geopackage file
+    file_list -- the .gpkg.part files to merge; by default every one found
+                 in the directory of the geopackage
+    journal -- a RunJournal that records each part once it is merged; the
+               merges are then also made safe to interrupt
+
+    Returns:
+    A dictionary with the number of tiles and part file bytes merged and
+    the time it took.
     """
-    base_dir = split(out_geopackage.file_path)[0]
-    if base_dir == "":
-        base_dir = "."
-    glob_path = join(base_dir + '/*.gpkg.part')
-    file_list = glob(glob_path)
+    if file_list is None:
+        base_dir = split(out_geopackage.file_path)[0]
+        if base_dir == "":
+            base_dir = "."
+        glob_path = join(base_dir + '/*.gpkg.part')
+        file_list = glob(glob_path)
     print("Merging temporary databases...")
-    #[out_geopackage.assimilate(f) for f in file_list]
-    itr = len(file_list)
+    # The ETA is based on bytes, as part files differ in size
+    sizes = [getsize(tdb) for tdb in file_list]
+    total_bytes = sum(sizes)
+    tiles = merged_bytes = 0
     status = ["|", "/", "-", "\\"]
-    counter = 0
-    for tdb in file_list:
-        comp = len(file_list) - itr
-        itr -= 1
-        out_geopackage.assimilate(tdb)
-        if tdb == file_list[-1]:
-            stdout.write("\r[X] Progress: [" + "==" * comp + "  " * itr + "]")
-        else:
-            stdout.write("\r[" + status[counter] + "] Progress: [" + "==" *
-                         comp + "  " * itr + "]")
+    start = time()
+    for counter, (tdb, size) in enumerate(zip(file_list, sizes)):
+        tiles += out_geopackage.assimilate(tdb, journal is not None)
+        if journal is not None:
+            journal.part_merged(tdb)
+        merged_bytes += size
+        mark = "X" if merged_bytes == total_bytes else \
+            status[counter % len(status)]
+        stdout.write("\r[" + mark + "] Merge: " + progress_line(
+            merged_bytes, total_bytes, time() - start, tiles=tiles))
         stdout.flush()
-        if counter != len(status) - 1:
-            counter += 1
-        else:
-            counter = 0
     print(" All geopackages merged!")
+    return dict(tiles=tiles, bytes=total_bytes, seconds=time() - start)
+
+
+def format_duration(seconds):
+    """Return a number of seconds formatted as h:mm:ss."""
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return "{}:{:02d}:{:02d}".format(hours, minutes, seconds)
+
+
+def progress_line(done, total, seconds, tiles=None, bytes_in=None,
+                  bytes_out=None, final=True):
+    """
+    Formats a progress report with the completed fraction, throughput and
+    an estimate of the time remaining.
+
+    Inputs:
+    done -- the amount of work done, in tiles or bytes
+    total -- the total amount of work known so far, in the same unit
+    seconds -- the time spent so far
+    tiles -- the number of tiles processed, if done is not a tile count
+    bytes_in -- the number of bytes read, if known
+    bytes_out -- the number of bytes written, if known
+    final -- False while the total may still grow (the scan is running)
+
+    Returns:
+    The progress report as a string.
+    """
+    seconds = max(seconds, 1e-6)
+    if tiles is None:
+        # done counts tiles
+        parts = ["{}/{}{} tiles".format(done, total, "" if final else "+")]
+        tiles = done
+    else:
+        parts = ["{} tiles".format(tiles)]
+    if total:
+        parts[0] += " ({:.1f}%)".format(100.0 * done / total)
+    parts.append("{:.0f} tiles/s".format(tiles / seconds))
+    if bytes_in is not None:
+        parts.append("{:.1f} MB/s in".format(bytes_in / seconds / 1e6))
+    if bytes_out is not None:
+        parts.append("{:.1f} MB/s out".format(bytes_out / seconds / 1e6))
+    if done:
+        eta = format_duration((total - done) * seconds / done)
+        parts.append("ETA " + (eta if final else ">" + eta))
+    return ", ".join(parts)
+
+
+def phase_summary(tiles, seconds, bytes_in=None, bytes_out=None):
+    """
+    Returns a dictionary describing the throughput of one phase of a run,
+    for the JSON summary printed by main().
+    """
+    seconds = max(seconds, 1e-6)
+    summary = dict(tiles=tiles, seconds=round(seconds, 3),
+                   tiles_per_second=round(tiles / seconds, 1))
+    if bytes_in is not None:
+        summary['bytes_in'] = bytes_in
+        summary['mb_per_second_in'] = round(bytes_in / seconds / 1e6, 3)
+    if bytes_out is not None:
+        summary['bytes_out'] = bytes_out
+        summary['mb_per_second_out'] = round(bytes_out / seconds / 1e6, 3)
+    return summary
+
+
+def merge_profiles(file_paths, out_path):
+    """
+    Merges the cProfile statistics files written by the workers into one
+    pstats file, and removes them.
+
+    Inputs:
+    file_paths -- the statistics files of the workers
+    out_path -- the path of the merged file
+    """
+    merged = Stats(file_paths[0])
+    for file_path in file_paths[1:]:
+        merged.add(file_path)
+    merged.dump_stats(out_path)
+    for file_path in file_paths:
+        remove(file_path)
+
+
+def stage_report(workers):
+    """
+    Returns the lines of a table of the wall-clock seconds each worker
+    process spent in the stages of worker_map(), with the totals and the
+    share of each stage in the last two rows.  The time outside of the
+    stages is under other.
+
+    Inputs:
+    workers -- a dictionary from process id to a dictionary of the tiles,
+               seconds and seconds per stage of the worker
+    """
+    columns = ('tiles',) + WORKER_STAGES + ('other',)
+    totals = dict((name, 0) for name in columns)
+    lines = ['{:>8}'.format('worker') + ''.join(
+        '{:>13}'.format(name) for name in columns)]
+    for pid, worker in sorted(workers.items()):
+        row = dict(worker, other=worker['seconds'] - sum(
+            worker.get(name, 0.0) for name in WORKER_STAGES))
+        for name in columns:
+            totals[name] += row.get(name, 0)
+        lines.append('{:>8}'.format(pid) + '{:>13}'.format(row['tiles']) +
+                     ''.join('{:>13.3f}'.format(row.get(name, 0.0))
+                             for name in columns[1:]))
+    lines.append('{:>8}'.format('total') + '{:>13}'.format(totals['tiles']) +
+                 ''.join('{:>13.3f}'.format(totals[name])
+                         for name in columns[1:]))
+    seconds = sum(totals[name] for name in columns[1:]) or 1.0
+    lines.append('{:>8}'.format('share') + ' ' * 13 + ''.join(
+        '{:>12.1f}%'.format(100.0 * totals[name] / seconds)
+        for name in columns[1:]))
+    return lines
+
+
+def chunk_tiles(tiles, size, root):
+    """
+    Generator that groups a stream of tile dictionaries into TileIndex
+    chunks that can be handed to sqlite_worker().
+
+    Inputs:
+    tiles -- an iterable of tile dictionaries
+    size -- the number of tiles in each chunk, or a function returning the
+            size of the next chunk
+    root -- the TMS folder the tiles live in
+    """
+    next_size = size if callable(size) else lambda: size
+    chunk = TileIndex(root)
+    limit = next_size()
+    for tile in tiles:
+        chunk.add(tile)
+        if len(chunk) >= limit:
+            yield chunk
+            chunk = TileIndex(root)
+            limit = next_size()
+    if len(chunk):
+        yield chunk
+
+
+def shard_columns(zoom_levels, size, root, done=None):
+    """
+    Generator that splits the column directories of a TMS folder into
+    TileShard chunks of consecutive columns of one zoom level, for a
+    sharded run.  Only the zoom directories are listed, and the first
+    column of each zoom level, from which the tiles per column are
+    estimated.
+
+    Inputs:
+    zoom_levels -- the zoom levels to shard
+    size -- a function returning the number of tiles for the next shard
+    root -- the TMS folder the tiles live in
+    done -- an optional function from a zoom level to the tiles a resumed
+            run already wrote, see RunJournal.done_columns()
+    """
+    for zoom in sorted(zoom_levels):
+        zoom_dir = join(root, str(zoom))
+        if not isdir(zoom_dir):
+            continue
+        columns = sorted(x for _, _, x in _scan_zoom((zoom_dir, zoom)))
+        if not columns:
+            continue
+        per_column = max(1, len(_scan_column(
+            (join(zoom_dir, str(columns[0])), zoom, columns[0]))))
+        done_columns = done(zoom) if done is not None else {}
+        first = 0
+        while first < len(columns):
+            shard = columns[first:first + max(1, size() // per_column)]
+            first += len(shard)
+            yield TileShard(root, zoom, shard, per_column * len(shard),
+                            dict((x, done_columns[x]) for x in shard
+                                 if x in done_columns))
+
+
+class ChunkSizer(object):
+    """
+    Picks chunk sizes for the dynamic scheduler in run_workers().  The cost
+    per tile is measured from the chunks that finish (it changes a lot
+    between zoom levels and between opaque JPEG and transparent PNG
+    regions), and each new chunk is sized to take about target seconds.
+    """
+
+    def __init__(self, target=CHUNK_SECONDS, initial=CHUNK_INITIAL,
+                 minimum=CHUNK_MIN, maximum=CHUNK_MAX):
+        """
+        Constructor.
+
+        Inputs:
+        target -- the number of seconds a chunk should take
+        initial -- the chunk size used until a cost has been measured
+        minimum -- the smallest chunk size
+        maximum -- the largest chunk size
+        """
+        self.target = target
+        self.minimum = minimum
+        self.maximum = maximum
+        self.__initial = initial
+        self.__cost = None
+
+    @property
+    def cost(self):
+        """Return the smoothed number of seconds spent per tile."""
+        return self.__cost
+
+    def update(self, tiles, seconds):
+        """
+        Record the time a finished chunk took.
+
+        Inputs:
+        tiles -- the number of tiles in the chunk
+        seconds -- the time the worker spent on it
+        """
+        if tiles <= 0:
+            return
+        cost = float(seconds) / tiles
+        if self.__cost is None:
+            self.__cost = cost
+        else:
+            # Exponential moving average, so the size follows the pyramid
+            self.__cost = 0.7 * self.__cost + 0.3 * cost
+
+    def size(self):
+        """Return the number of tiles to put in the next chunk."""
+        if self.__cost is None:
+            return self.__initial
+        if self.__cost <= 0:
+            return self.maximum
+        size = int(self.target / self.__cost)
+        return max(self.minimum, min(self.maximum, size))
+
+
+def interleave_chunks(layers, sizers, shards=False, journal=None):
+    """
+    Generator that takes chunks from several layers in turn, so that the
+    workers encode all of them at once instead of one after the other.
+
+    Inputs:
+    layers -- a list of (tiles, root, extra_args) tuples, see run_workers()
+    sizers -- a ChunkSizer for each layer, as their costs per tile differ
+    shards -- the layers hold zoom levels to split into TileShard chunks
+              instead of tiles
+    journal -- the RunJournal of a resumed sharded run
+
+    Yields:
+    (layer index, TileIndex or TileShard chunk) tuples.
+    """
+    def make_chunks(tiles, size, root, extra_args):
+        """Return the chunks of one layer."""
+        if not shards:
+            return chunk_tiles(tiles, size, root)
+        done = None
+        if journal is not None:
+            done = partial(journal.done_columns,
+                           table_name=extra_args.get('table_name', 'tiles'))
+        return shard_columns(tiles, size, root, done)
+    sources = [(index, make_chunks(tiles, sizer.size, root, extra_args))
+               for index, ((tiles, root, extra_args), sizer) in
+               enumerate(zip(layers, sizers))]
+    while sources:
+        for source in list(sources):
+            chunk = next(source[1], None)
+            if chunk is None:
+                sources.remove(source)
+            else:
+                yield source[0], chunk
+
+
+def run_workers(layers, threading, queue=None, writer=None, journal=None,
+                shards=False, merge=None):
+    """
+    Runs sqlite_worker() over streams of tiles with a dynamic scheduler and
+    reports progress.  Tiles are grouped into chunks as they arrive, sized
+    by a ChunkSizer from the measured cost per tile, and handed to whichever
+    worker is free; only two chunks per core are queued at a time so the
+    sizes keep adapting and every core stays busy until the end.  When
+    there are several layers, they share the workers and their chunks are
+    handed out in turn.
+
+    Inputs:
+    layers -- a list of (tiles, root, extra_args) tuples, one per tile
+              table: an iterable of tile dictionaries, the TMS folder they
+              live in and the dictionary of options passed to
+              sqlite_worker()
+    threading -- False to process the chunks in this process (debugging)
+    queue -- the queue to the single writer process, if one is used
+    writer -- the single writer process, if one is used
+    journal -- a RunJournal to record each finished chunk in
+    shards -- hand the workers TileShard chunks to list themselves; the
+              layers then hold the zoom levels to shard instead of tiles
+    merge -- a function called with the layer index and the serialized
+             database of a chunk kept in memory, which merges it into the
+             output before the chunk is journaled
+
+    Returns:
+    The number of tiles processed and a dictionary of the statistics
+    returned by sqlite_worker(), summed over all chunks, with the number
+    of tiles of each tile table under 'layers' and the list of .gpkg.part
+    files written under 'parts'.  A sharded run has the zoom levels with
+    tiles of each tile table under 'zooms'.  A profiled run also has the
+    cProfile files of the workers under 'profiles', and their tiles,
+    seconds and seconds per stage by process id under 'workers'.
+    """
+    total = 0
+    stats = dict(parts=[], layers=dict(
+        (extra_args.get('table_name', 'tiles'), 0)
+        for _, _, extra_args in layers))
+    sizers = [ChunkSizer() for _ in layers]
+    chunks = interleave_chunks(layers, sizers, shards,
+                               journal if shards else None)
+    worker = shard_worker if shards else sqlite_worker
+    counters = ProgressCounters()
+    scanning = [True]
+    status = ["|", "/", "-", "\\"]
+    counter = [0]
+    start = time()
+    drawn = [0.0]
+    # Shards are counted by their estimates until they have been listed
+    listed = [0]
+
+    def add_stats(index, chunk, result):
+        """Sum the statistics of one chunk into the run totals."""
+        table_name = layers[index][2].get('table_name', 'tiles')
+        part = result.pop('part', None)
+        if part is not None and part not in stats['parts']:
+            stats['parts'].append(part)
+        data = result.pop('data', None)
+        if data is not None:
+            merge(index, data)
+        if shards:
+            ranges = result.pop('ranges')
+            skipped = result.pop('skipped')
+            listed[0] += result['tiles'] - len(chunk)
+            if result['tiles'] or skipped:
+                stats.setdefault('zooms', {}).setdefault(
+                    table_name, set()).add(chunk.zoom)
+            if journal is not None:
+                journal.skipped += skipped
+                if ranges:
+                    journal.ranges_done(ranges, part, table_name)
+        elif journal is not None:
+            journal.chunk_done(chunk, part, table_name)
+        profile = result.pop('profile', None)
+        if profile is not None and \
+                profile not in stats.setdefault('profiles', []):
+            stats['profiles'].append(profile)
+        if 'stages' in result:
+            worker = stats.setdefault('workers', {}).setdefault(
+                result.pop('worker'), dict(tiles=0, seconds=0.0))
+            worker['tiles'] += result['tiles']
+            worker['seconds'] += result['seconds']
+            for name, seconds in result.pop('stages').items():
+                worker[name] = worker.get(name, 0.0) + seconds
+        sizers[index].update(result['tiles'], result['seconds'])
+        stats['layers'][table_name] += result['tiles']
+        for key, value in result.items():
+            stats[key] = stats.get(key, 0) + value
+
+    def progress(mark=None):
+        """Draw the progress line from the shared counters."""
+        now = time()
+        if mark is None:
+            if now - drawn[0] < PROGRESS_INTERVAL:
+                return
+            mark = status[counter[0]]
+            counter[0] = (counter[0] + 1) % len(status)
+        drawn[0] = now
+        done, bytes_in, bytes_out = counters.values()
+        stdout.write("\r[" + mark + "] Encode: " + progress_line(
+            done, max(done, total + listed[0]), now - start,
+            bytes_in=bytes_in, bytes_out=bytes_out, final=not scanning[0]))
+        stdout.flush()
+    if not threading:
+        # Debugging call to bypass multiprocessing (-T)
+        init_worker(queue, counters)
+        for index, chunk in chunks:
+            total += len(chunk)
+            add_stats(index, chunk, worker(chunk, layers[index][2]))
+            progress()
+        close_worker_parts()
+        scanning[0] = False
+        progress("X")
+        print(" All Done!")
+        return total + listed[0], stats
+    # Enable tiling on multiple CPU cores
+    cores = cpu_count()
+    pool = Pool(cores, init_worker, (queue, counters))
+    max_pending = 2 * cores
+    pending = []
+
+    def collect(limit):
+        """Gather finished chunks until fewer than limit are pending."""
+        while True:
+            for item in [item for item in pending if item[0].ready()]:
+                pending.remove(item)
+                # get() re-raises any exception from the worker
+                add_stats(item[1], item[2], item[0].get())
+            if len(pending) < limit:
+                return
+            if writer is not None and not writer.is_alive():
+                print(" Error: the writer process stopped.")
+                pool.terminate()
+                exit(1)
+            progress()
+            sleep(.05)
+    try:
+        # Hand out chunks as soon as the scanners produce them
+        for index, chunk in chunks:
+            total += len(chunk)
+            pending.append((pool.apply_async(worker,
+                                             [chunk, layers[index][2]]),
+                            index, chunk))
+            collect(max_pending)
+            progress()
+        scanning[0] = False
+        collect(1)
+        progress("X")
+        print(" All Done!")
+        pool.close()
+        pool.join()
+    except KeyboardInterrupt:
+        print(" Interrupted!")
+        pool.terminate()
+        exit(1)
+    return total + listed[0], stats
+
+
+def parse_layer(spec, arg_list):
+    """
+    Parses a source folder given on the command line, with the name of the
+    tile table it goes into and the options that differ from the rest, in
+    the form folder[=table_name][,option=value...], e.g.
+    imagery/=ortho,srs=4326,tileorigin=ul.  The options are srs,
+    tileorigin, imagery and q.
+
+    Inputs:
+    spec -- the source folder argument
+    arg_list -- the parsed command line, which has the default options
+
+    Returns:
+    A dictionary with source, table_name, srs, tileorigin, imagery and
+    jpeg_quality keys.
+    """
+    layer = dict(source=spec, table_name=None, srs=arg_list.srs,
+                 tileorigin=arg_list.tileorigin, imagery=arg_list.imagery,
+                 jpeg_quality=arg_list.q)
+    if exists(spec):
+        return layer
+    fields = spec.split(',')
+    folder, _, table_name = fields[0].rpartition('=')
+    if not folder or not match(r'^[A-Za-z_][A-Za-z0-9_]*$', table_name) or \
+            table_name.lower().startswith(('gpkg_', 'sqlite_')):
+        raise ValueError("invalid tile table name in " + spec)
+    layer.update(source=folder, table_name=table_name)
+    for field in fields[1:]:
+        key, _, value = field.partition('=')
+        try:
+            if key == 'srs' and int(value) in (3857, 4326, 3395, 9804):
+                layer['srs'] = int(value)
+            elif key == 'tileorigin' and value in ('ll', 'ul', 'sw', 'nw'):
+                layer['tileorigin'] = value
+            elif key == 'imagery' and \
+                    value in ('mixed', 'jpeg', 'png', 'source'):
+                layer['imagery'] = value
+            elif key == 'q' and 0 <= int(value) <= 100:
+                layer['jpeg_quality'] = int(value)
+            else:
+                raise ValueError
+        except ValueError:
+            raise ValueError("invalid option {} in {}".format(field, spec))
+    return layer
+
+
+def record_zooms(tiles, found_zooms):
+    """Generator that records which zoom levels actually contain tiles."""
+    for tile in tiles:
+        found_zooms.add(tile['z'])
+        yield tile
 
 
 def main(arg_list):
     """
-    Create a geopackage from a directory of tiles arranged in TMS or WMTS
-    format.
+    Create a geopackage from one or more directories of tiles arranged in
+    TMS or WMTS format, each in its own tile table.
 
     Inputs:
     arg_list -- an ArgumentParser object containing command-line options and
-    flags
+    flags, with the parsed source folders in layers (see parse_layer())
     """
-    # Build the file dictionary
-    files = file_count(arg_list.source_folder)
-    if len(files) == 0:
-        # If there are no files, exit the script
-        print(" Ensure the correct source tile directory was specified.")
-        exit(1)
-    # Is the input tile grid aligned to lower-left or not?
-    lower_left = arg_list.tileorigin == 'll' or arg_list.tileorigin == 'sw'
+    # Only the top of each zoom level run is needed to build the metadata,
+    # the rest of the tree is scanned while the workers are running
+    print("Scanning source tiles, this could take a while...")
+    # The manifest compares file sizes and mtimes, which are read by the
+    # scanner threads
+    use_manifest = arg_list.manifest or arg_list.manifest_hash
     # Get the output file destination directory
     root_dir, _ = split(arg_list.output_file)
-    # Build the tile matrix info object
-    tile_info = build_lut(files, lower_left, arg_list.srs)
-    # Initialize the output file
-    if arg_list.threading:
-        # Enable tiling on multiple CPU cores
-        cores = cpu_count()
-        pool = Pool(cores)
-        # Build allocate dictionary
-        extra_args = dict(root_dir=root_dir,
-                          tile_info=tile_info,
-                          lower_left=lower_left,
-                          srs=arg_list.srs,
-                          imagery=arg_list.imagery,
-                          jpeg_quality=arg_list.q)
-        results = allocate(cores, pool, files, extra_args)
-        status = ["|", "/", "-", "\\"]
-        counter = 0
-        try:
-            while True:
-                rem = sum([1 for item in results if not item.ready()])
-                if rem == 0:
-                    stdout.write("\r[X] Progress: [" + "==" * (cores - rem) +
-                                 "  " * rem + "]")
-                    stdout.flush()
-                    print(" All Done!")
-                    break
-                else:
-                    stdout.write("\r[" + status[counter] + "] Progress: [" +
-                                 "==" * (cores - rem) + "  " * rem + "]")
-                    stdout.flush()
-                    if counter != len(status) - 1:
-                        counter += 1
-                    else:
-                        counter = 0
-                sleep(.25)
-            pool.close()
-            pool.join()
-        except KeyboardInterrupt:
-            print(" Interrupted!")
-            pool.terminate()
+    layers = arg_list.layers
+    tile_sizes = []
+    for layer in layers:
+        source = layer['source']
+        zoom_levels, anchor_tiles = scan_anchor_tiles(
+            source, scan_zoom_levels(source), use_manifest)
+        if len(anchor_tiles) == 0:
+            # If there are no files, exit the script
+            print(" Ensure the correct source tile directory was specified.")
+            exit(1)
+        if not arg_list.page_size:
+            tile_sizes += sample_tile_sizes(source, zoom_levels)
+        # Is the input tile grid aligned to lower-left or not?
+        lower_left = layer['tileorigin'] in ('ll', 'sw')
+        # Build the tile matrix info object
+        tile_info = build_lut(anchor_tiles, lower_left, layer['srs'],
+                              zoom_levels)
+        layer['found_zooms'] = set()
+        if arg_list.shards:
+            # The workers list the zoom levels themselves, a shard of
+            # column directories at a time
+            layer['work'] = zoom_levels
+        else:
+            anchors = set(item['z'] for item in anchor_tiles)
+            remaining = scan_tiles(source, [zoom for zoom in zoom_levels
+                                            if zoom not in anchors],
+                                   arg_list.scan_threads, use_manifest)
+            layer['work'] = record_zooms(chain(anchor_tiles, remaining),
+                                         layer['found_zooms'])
+        layer['extra_args'] = dict(
+            root_dir=root_dir,
+            tile_info=tile_info,
+            lower_left=lower_left,
+            srs=layer['srs'],
+            imagery=layer['imagery'],
+            jpeg_quality=75 if layer['jpeg_quality'] is None
+            else layer['jpeg_quality'],
+            use_mmap=arg_list.use_mmap,
+            skip_empty=arg_list.skip_empty,
+            encode_cache_bytes=arg_list.encode_cache_bytes,
+            batch_tiles=arg_list.batch_tiles,
+            batch_bytes=arg_list.batch_bytes,
+            single_writer=arg_list.single_writer,
+            profile=arg_list.profile,
+            temp_dir=arg_list.temp_dir,
+            memory_bytes=arg_list.memory_bytes,
+            table_name=layer['table_name'])
+    # Fit the pages to the tiles, so that most of them are read with a
+    # single page and not a chain of overflow pages
+    page_size = arg_list.page_size or choose_page_size(tile_sizes)
+    start = time()
+    merge = journal = None
+    changes = {}
+    # A resumed run finds the geopackage it started
+    reopen = arg_list.append or \
+        (arg_list.resume and exists(arg_list.output_file))
+    try:
+        for layer in layers:
+            # The first layer creates the file, the others add tile tables
+            layer['gpkg'] = Geopackage(arg_list.output_file, layer['srs'],
+                                       reopen, layer['table_name'],
+                                       page_size)
+        # An existing file keeps its page size, and the worker databases
+        # follow it
+        page_size = layers[0]['gpkg'].page_size
+        for layer in layers:
+            layer['extra_args']['page_size'] = page_size
+        if not arg_list.single_writer:
+            # Options that change the tiles written must stay the same
+            settings = dict(layers=[dict((key, layer[key]) for key in (
+                'table_name', 'srs', 'tileorigin', 'imagery', 'jpeg_quality'))
+                                    for layer in layers],
+                            sources=[abspath(layer['source'])
+                                     for layer in layers],
+                            skip_empty=arg_list.skip_empty,
+                            append=arg_list.append,
+                            manifest=use_manifest,
+                            manifest_hash=arg_list.manifest_hash,
+                            bulk_order=arg_list.bulk_order)
+            journal = RunJournal(arg_list.output_file + '.journal', settings,
+                                 arg_list.resume)
+    except (ValueError, IOError) as err:
+        print("Error: {}".format(err))
+        exit(1)
+    for layer in layers:
+        gpkg = layer['gpkg']
+        table_name = layer['table_name']
+        if arg_list.append:
+            # Number the new tiles in the tile matrix of the existing file
+            layer['extra_args']['tile_info'] = gpkg.append_grid(
+                layer['extra_args']['tile_info'],
+                layer['extra_args']['lower_left'])
+        layer['manifest'] = None
+        if use_manifest:
+            manifest = Manifest(gpkg.file_path, layer['source'], table_name)
+            layer['manifest'] = manifest
+            if arg_list.append:
+                # Compare the whole source to the manifest, then only hand
+                # new and changed tiles to the workers
+                for _ in manifest.record(layer['work']):
+                    pass
+                changes[table_name] = manifest.diff(arg_list.manifest_hash,
+                                                    arg_list.scan_threads)
+                print("Manifest{}: {} new or changed, {} removed, {} "
+                      "unchanged tiles.".format(
+                          "" if len(layers) == 1 else " " + table_name,
+                          *changes[table_name]))
+                # The manifest is only updated once the run is done, so a
+                # resumed run finds the same changes; deleting them again
+                # would drop the tiles merged before it was interrupted
+                stale_deleted = [] if journal is None else \
+                    journal.get('stale_deleted', [])
+                if table_name not in stale_deleted:
+                    manifest.delete_stale()
+                    if journal is not None:
+                        journal.set('stale_deleted',
+                                    stale_deleted + [table_name])
+                layer['work'] = manifest.changed()
+            else:
+                layer['work'] = manifest.record(layer['work'])
+        if journal is not None and not arg_list.shards:
+            # Leave out the tiles finished before the run was interrupted,
+            # which the workers of a sharded run do themselves
+            layer['work'] = journal.filter(layer['work'], table_name)
+        if arg_list.bulk_order is not None:
+            # Stage tiles unindexed and insert them in order at the end
+            gpkg.start_bulk_load()
+    work = [(layer['work'], layer['source'], layer['extra_args'])
+            for layer in layers]
+    if arg_list.single_writer:
+        # Workers stream encoded tiles to one process that writes them
+        # directly into the output file
+        queue = Queue(arg_list.queue_size)
+        writer = Process(target=gpkg_writer, args=(queue, dict(
+            (layer['table_name'],
+             layer['gpkg'].bulk_path or layer['gpkg'].file_path)
+            for layer in layers)))
+        writer.start()
+        total, stats = run_workers(work, arg_list.threading, queue, writer,
+                                   shards=arg_list.shards)
+        queue.put(None)
+        writer.join()
+        encode_seconds = time() - start
+        if writer.exitcode != 0:
+            print("Error: the writer process failed.")
             exit(1)
     else:
-        # Debugging call to bypass multiprocessing (-T)
-        extra_args = dict(root_dir=root_dir,
-                          tile_info=tile_info,
-                          lower_left=lower_left,
-                          srs=arg_list.srs,
-                          imagery=arg_list.imagery,
-                          jpeg_quality=arg_list.q)
-        sqlite_worker(files, extra_args)
-    # Combine the individual temp databases into the output file
-    with Geopackage(arg_list.output_file, arg_list.srs) as gpkg:
-        combine_worker_dbs(gpkg)
-        # Using the data in the output file, create the metadata for it
-        gpkg.update_metadata(tile_info)
+        merge = dict(tiles=0, bytes=0, seconds=0)
+
+        def merge_data(index, data):
+            """Merge a worker database kept in memory as it comes in."""
+            began = time()
+            merge['tiles'] += layers[index]['gpkg'].assimilate_data(
+                data, journal is not None)
+            merge['bytes'] += len(data)
+            merge['seconds'] += time() - began
+        total, stats = run_workers(work, arg_list.threading,
+                                   journal=journal, shards=arg_list.shards,
+                                   merge=merge_data)
+        encode_seconds = time() - start
+        # Combine the individual temp databases into the output file,
+        # including those a resumed run did not get to merge
+        for layer in layers:
+            merged = combine_worker_dbs(
+                layer['gpkg'], journal.parts(layer['table_name']), journal)
+            for key in merge:
+                merge[key] += merged[key]
+    stats.pop('parts', None)
+    for layer in layers:
+        layer['found_zooms'].update(
+            stats.get('zooms', {}).get(layer['table_name'], ()))
+    profiles = stats.pop('profiles', [])
+    workers = stats.pop('workers', None)
+    for layer in layers:
+        if arg_list.bulk_order is not None:
+            print("Writing {} tiles in {} order...".format(
+                layer['table_name'], arg_list.bulk_order))
+            layer['gpkg'].finish_bulk_load(arg_list.bulk_order)
+    print("Found {} total tiles.".format(total))
+    if len(layers) > 1:
+        for layer in layers:
+            print("  {}: {} tiles".format(
+                layer['table_name'], stats['layers'][layer['table_name']]))
+    if journal is not None and journal.skipped:
+        print("Resumed: {} tiles were already done.".format(journal.skipped))
+    lookups = stats.get('cache_hits', 0) + stats.get('cache_misses', 0)
+    if lookups:
+        print("Encode cache: {} hits, {} misses ({:.1f}% hit rate)".format(
+            stats['cache_hits'], stats['cache_misses'],
+            100.0 * stats['cache_hits'] / lookups))
+    for layer in layers:
+        gpkg = layer['gpkg']
+        manifest = layer['manifest']
+        extra_args = layer['extra_args']
+        if manifest is not None:
+            if layer['table_name'] not in changes:
+                # Everything in a new geopackage is new to the manifest
+                changes[layer['table_name']] = manifest.diff(
+                    arg_list.manifest_hash, arg_list.scan_threads)
+            manifest.update(extra_args['tile_info'],
+                            get_invert_y(extra_args['lower_left'],
+                                         layer['srs']))
+            manifest.close()
+        if arg_list.append:
+            # The source folder only holds the new tiles, so the metadata
+            # comes from the whole tile table
+            gpkg.refresh_metadata()
+        else:
+            # Empty zoom directories do not get a tile matrix entry
+            tile_info = [level for level in extra_args['tile_info']
+                         if level.zoom in layer['found_zooms']]
+            # Using the data in the output file, create the metadata for it
+            gpkg.update_metadata(tile_info)
+        gpkg.close()
+    if workers:
+        print("Worker stages (wall-clock seconds):")
+        for line in stage_report(workers):
+            print(line)
+    if profiles:
+        merge_profiles(profiles, arg_list.profile)
+        print("Profile of the workers written to {}".format(
+            arg_list.profile))
+    print("Analyzing{} the geopackage...".format(
+        " and compacting" if arg_list.compact else ""))
+    output_bytes = Geopackage.optimize(arg_list.output_file, arg_list.compact)
+    if journal is not None:
+        # The geopackage is complete, so there is nothing left to resume
+        journal.remove()
     print("Complete")
+    # One machine-readable line describing the run
+    summary = dict(
+        tiles=total,
+        seconds=round(time() - start, 3),
+        encode=phase_summary(total, encode_seconds,
+                             stats.get('bytes_in', 0),
+                             stats.get('bytes_out', 0)),
+        merge=None if merge is None else
+        phase_summary(merge['tiles'], merge['seconds'], merge['bytes']),
+        cache_hits=stats.get('cache_hits', 0),
+        cache_misses=stats.get('cache_misses', 0),
+        page_size=page_size,
+        output_bytes=output_bytes,
+        output=arg_list.output_file)
+    if len(layers) > 1:
+        summary['layers'] = stats['layers']
+    if workers:
+        summary['stages'] = dict(
+            (name, round(sum(worker.get(name, 0.0)
+                             for worker in workers.values()), 3))
+            for name in WORKER_STAGES)
+        summary['profile'] = arg_list.profile
+    if changes:
+        counts = dict((table_name, dict(zip(
+            ('changed', 'removed', 'unchanged'), counts)))
+                      for table_name, counts in changes.items())
+        summary['manifest'] = list(counts.values())[0] \
+            if len(layers) == 1 else counts
+    print(dumps(summary, sort_keys=True))
 
 
 if __name__ == '__main__':
@@ -1288,7 +4406,12 @@ if __name__ == '__main__':
     PARSER = ArgumentParser(description="Convert TMS folder into geopackage")
     PARSER.add_argument("source_folder",
                         metavar="source",
-                        help="Source folder of TMS files.")
+                        nargs="+",
+                        help="Source folder of TMS files. To package " +
+                        "several tile sets into one geopackage, give each " +
+                        "folder as folder=table_name, optionally followed " +
+                        "by ,srs=...,tileorigin=...,imagery=...,q=... for " +
+                        "options that differ from the ones below.")
     PARSER.add_argument("output_file",
                         metavar="dest",
                         help="Destination file path.")
@@ -1314,25 +4437,226 @@ if __name__ == '__main__':
     PARSER.add_argument("-q",
                         metavar="quality",
                         type=int,
-                        default=75,
-                        help="Quality for jpeg images, 0-100. Default is 75",
-                        choices=list(range(100)))
+                        default=None,
+                        help="Quality for jpeg images, 0-100. Default is " +
+                        "75. Source tiles that are already JPEGs are " +
+                        "stored as they are.",
+                        choices=list(range(101)))
+    PARSER.add_argument("-skip-empty",
+                        dest="skip_empty",
+                        action="store_true",
+                        default=False,
+                        help="Leave fully transparent tiles out of the " +
+                        "geopackage.")
+    PARSER.add_argument("-encode-cache",
+                        dest="encode_cache_bytes",
+                        metavar="bytes",
+                        type=int,
+                        default=ENCODE_CACHE_BYTES,
+                        help="Size of each worker's cache of encoded tiles, " +
+                        "keyed by the source tile bytes. 0 disables it. " +
+                        "Default is {}".format(ENCODE_CACHE_BYTES))
+    PARSER.add_argument("-mmap",
+                        dest="use_mmap",
+                        action="store_true",
+                        default=False,
+                        help="Read source tiles through memory maps.")
     PARSER.add_argument("-a",
                         dest="append",
                         action="store_true",
                         default=False,
-                        help="Append tile set to existing geopackage")
+                        help="Append tile set to an existing geopackage " +
+                        "made by this script. Tiles already in it are " +
+                        "replaced; if the new tiles extend it to the west " +
+                        "or north, the existing tiles are renumbered.")
+    PARSER.add_argument("-manifest",
+                        dest="manifest",
+                        action="store_true",
+                        default=False,
+                        help="Keep a manifest of the path, size and mtime " +
+                        "of every source tile in the geopackage. With -a, " +
+                        "only tiles that are new or changed since the last " +
+                        "run are encoded, and tiles that were removed from " +
+                        "the source are deleted.")
+    PARSER.add_argument("-manifest-hash",
+                        dest="manifest_hash",
+                        action="store_true",
+                        default=False,
+                        help="Like -manifest, but also record a SHA-1 of " +
+                        "each tile, so tiles whose mtime changed but whose " +
+                        "contents did not are not encoded again.")
+    PARSER.add_argument("-shards",
+                        dest="shards",
+                        action="store_true",
+                        default=False,
+                        help="Hand each worker a range of tile columns " +
+                        "to list and package itself, instead of listing " +
+                        "every tile in the main process. Not available " +
+                        "with -manifest or -manifest-hash.")
+    PARSER.add_argument("-scan-threads",
+                        dest="scan_threads",
+                        metavar="threads",
+                        type=int,
+                        default=SCAN_THREADS,
+                        help="Number of threads used to scan the source " +
+                        "folder. Default is {}".format(SCAN_THREADS))
+    PARSER.add_argument("-batch-tiles",
+                        dest="batch_tiles",
+                        metavar="tiles",
+                        type=int,
+                        default=BATCH_TILES,
+                        help="Number of tiles a worker buffers before " +
+                        "writing them in one transaction. Default is " +
+                        "{}".format(BATCH_TILES))
+    PARSER.add_argument("-batch-bytes",
+                        dest="batch_bytes",
+                        metavar="bytes",
+                        type=int,
+                        default=BATCH_BYTES,
+                        help="Number of tile bytes a worker buffers before " +
+                        "writing them in one transaction. Default is " +
+                        "{}".format(BATCH_BYTES))
+    PARSER.add_argument("-temp-dir",
+                        dest="temp_dir",
+                        metavar="dir",
+                        default=None,
+                        help="Folder for the .gpkg.part files of the " +
+                        "workers, such as a tmpfs or a local SSD, instead " +
+                        "of the folder of the output file. To -resume a " +
+                        "run, it must keep its files until the run " +
+                        "completes.")
+    PARSER.add_argument("-memory-parts",
+                        dest="memory_bytes",
+                        metavar="bytes",
+                        type=int,
+                        default=0,
+                        help="Build each worker database in memory, up to " +
+                        "this many bytes, and merge it into the output as " +
+                        "it comes in instead of writing a .gpkg.part " +
+                        "file. A database that grows larger moves to its " +
+                        "part file. Needs Python 3.11 or later. Default " +
+                        "is 0 (off).")
+    PARSER.add_argument("-single-writer",
+                        dest="single_writer",
+                        action="store_true",
+                        default=False,
+                        help="Stream encoded tiles from the workers to one " +
+                        "process that writes the output file directly, " +
+                        "instead of merging .gpkg.part files.")
+    PARSER.add_argument("-queue-size",
+                        dest="queue_size",
+                        metavar="batches",
+                        type=int,
+                        default=WRITER_QUEUE_SIZE,
+                        help="Number of tile batches that may wait for the " +
+                        "single writer before workers block. Default is " +
+                        "{}".format(WRITER_QUEUE_SIZE))
+    PARSER.add_argument("-bulk-order",
+                        dest="bulk_order",
+                        metavar="order",
+                        choices=["zoom", "hilbert"],
+                        default=None,
+                        help="Stage tiles without an index and write them " +
+                        "to the output in one sorted pass, clustered by " +
+                        "zoom/row/column (zoom) or along a Hilbert curve " +
+                        "within each zoom level (hilbert).")
+    PARSER.add_argument("-page-size",
+                        dest="page_size",
+                        metavar="bytes",
+                        type=int,
+                        choices=[0] + [2**n for n in range(9, 17)],
+                        default=0,
+                        help="Page size of a new output file, a power of " +
+                        "two from 512 to 65536. By default it is chosen " +
+                        "from the size of the source tiles.")
+    PARSER.add_argument("-profile", "--profile",
+                        dest="profile",
+                        metavar="file",
+                        default=None,
+                        help="Profile the workers with cProfile and merge " +
+                        "their statistics into this pstats file, and " +
+                        "report the time each worker spent reading, " +
+                        "decoding, encoding and inserting tiles.")
+    PARSER.add_argument("-compact",
+                        dest="compact",
+                        action="store_true",
+                        default=False,
+                        help="Rewrite the finished output file without " +
+                        "free pages, with VACUUM INTO a copy.")
+    PARSER.add_argument("-resume",
+                        dest="resume",
+                        action="store_true",
+                        default=False,
+                        help="Continue an interrupted run with the same " +
+                        "options, skipping the tiles it already wrote. " +
+                        "Each run keeps a <dest>.journal until it " +
+                        "completes. Not available with -single-writer.")
     PARSER.add_argument("-T",
                         dest="threading",
                         action="store_false",
                         default=True,
                         help="Disable multiprocessing.")
     ARG_LIST = PARSER.parse_args()
-    if not exists(ARG_LIST.source_folder) or exists(ARG_LIST.output_file):
+    try:
+        ARG_LIST.layers = [parse_layer(spec, ARG_LIST)
+                           for spec in ARG_LIST.source_folder]
+    except ValueError as err:
+        PARSER.print_usage()
+        print("Error: {}".format(err))
+        exit(1)
+    if len(ARG_LIST.layers) == 1 and ARG_LIST.layers[0]['table_name'] is None:
+        ARG_LIST.layers[0]['table_name'] = 'tiles'
+    TABLE_NAMES = [layer['table_name'] for layer in ARG_LIST.layers]
+    if None in TABLE_NAMES or \
+            len(set(name.lower() for name in TABLE_NAMES)) != len(TABLE_NAMES):
+        PARSER.print_usage()
+        print("Give each source folder a different table name, as in " +
+              "folder=table_name.")
+        exit(1)
+    if not all(exists(layer['source']) for layer in ARG_LIST.layers):
+        PARSER.print_usage()
+        print("Ensure that TMS directory exists.")
+        exit(1)
+    if ARG_LIST.resume:
+        if ARG_LIST.single_writer:
+            PARSER.print_usage()
+            print("-resume cannot be used with -single-writer")
+            exit(1)
+        if not exists(ARG_LIST.output_file + '.journal'):
+            PARSER.print_usage()
+            print("Ensure that an unfinished run of the geopackage exists.")
+            exit(1)
+    elif exists(ARG_LIST.output_file + '.journal'):
+        PARSER.print_usage()
+        print("The last run of the geopackage did not finish; use -resume " +
+              "or delete {}.journal".format(ARG_LIST.output_file))
+        exit(1)
+    elif ARG_LIST.append != exists(ARG_LIST.output_file):
+        PARSER.print_usage()
+        if ARG_LIST.append:
+            print("Ensure that the geopackage to append to exists.")
+        else:
+            print("Ensure that out file does not exist, or use -a.")
+        exit(1)
+    if ARG_LIST.temp_dir is not None and not isdir(ARG_LIST.temp_dir):
+        PARSER.print_usage()
+        print("Ensure that the -temp-dir folder exists.")
+        exit(1)
+    if ARG_LIST.memory_bytes:
+        if ARG_LIST.single_writer:
+            PARSER.print_usage()
+            print("-memory-parts cannot be used with -single-writer")
+            exit(1)
+        if not hasattr(connect(":memory:"), 'serialize'):
+            PARSER.print_usage()
+            print("-memory-parts needs Python 3.11 or later")
+            exit(1)
+    if ARG_LIST.shards and (ARG_LIST.manifest or ARG_LIST.manifest_hash):
         PARSER.print_usage()
-        print("Ensure that TMS directory exists and out file does not.")
+        print("-shards cannot be used with -manifest or -manifest-hash")
         exit(1)
-    if ARG_LIST.q is not None and ARG_LIST.imagery == 'png':
+    if any(layer['jpeg_quality'] is not None and layer['imagery'] == 'png'
+           for layer in ARG_LIST.layers):
         PARSER.print_usage()
         print("-q cannot be used with png")
         exit(1)
@@ -10,6 +10,7 @@ from gdal2tiles_parallel import PixelsPoint
 from gdal2tiles_parallel import LonLatPoint
 from gdal2tiles_parallel import ITileProfile
 from gdal2tiles_parallel import GlobalMercatorProfile
+from gdal2tiles_parallel import gpkg_tile_position
 
 
 class TestITileProfile:
@@ -282,3 +283,22 @@ class TestGlobalMercatorProfile:
             assert False
         except NotImplementedError as e:
             assert e is not None and type(e) == NotImplementedError
+
+
+class TestGpkgTilePosition:
+    def test_top_zoom_1(self):
+        # the top-left tile of the top zoom level is the matrix origin
+        result = gpkg_tile_position(Tile(1, 2), 2, (1, 1, 2, 2), 2)
+        assert result == (0, 0)
+
+    def test_top_zoom_2(self):
+        result = gpkg_tile_position(Tile(2, 1), 2, (1, 1, 2, 2), 2)
+        assert result == (1, 1)
+
+    def test_lower_zoom_1(self):
+        result = gpkg_tile_position(Tile(4, 11), 4, (1, 1, 2, 2), 2)
+        assert result == (0, 0)
+
+    def test_lower_zoom_2(self):
+        result = gpkg_tile_position(Tile(11, 4), 4, (1, 1, 2, 2), 2)
+        assert result == (7, 7)
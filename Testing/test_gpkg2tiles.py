@@ -0,0 +1,109 @@
+"""
+Copyright (C) 2014 Reinventing Geospatial, Inc.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>,
+or write to the Free Software Foundation, Inc., 59 Temple Place -
+Suite 330, Boston, MA 02111-1307, USA.
+
+Requires: Sqlite3
+Description: Test cases for gpkg2tiles_parallel.py
+
+Version:
+"""
+
+from argparse import Namespace
+from os import getcwd, makedirs, walk
+from os.path import abspath, exists, join, relpath
+from sys import path
+
+path.append(abspath("Packaging"))
+from gpkg2tiles_parallel import main
+from gpkg2tiles_parallel import row_chunks
+from test_tiles2gpkg import make_session_folder
+from test_tiles2gpkg import make_tile_gpkg
+from tiles2gpkg_parallel import Geodetic
+from tiles2gpkg_parallel import scan_tiles
+
+GEODETIC_FILE_PATH = join(getcwd(), "Testing", "rgb_tiles", "geodetic")
+
+
+def read_file(tile):
+    """Return the bytes of a tile file."""
+    with open(tile['path'], 'rb') as tile_file:
+        return tile_file.read()
+
+
+def make_gpkg():
+    """Package the geodetic test tiles as they are."""
+    return make_tile_gpkg(list(scan_tiles(GEODETIC_FILE_PATH)), 4326,
+                          read_file)
+
+
+def read_tree(root):
+    """Return a dictionary from the relative path of each file to its bytes."""
+    files = {}
+    for folder, _, names in walk(root):
+        for name in names:
+            with open(join(folder, name), 'rb') as tile_file:
+                files[relpath(join(folder, name), root)] = tile_file.read()
+    return files
+
+
+def export(file_path, tileorigin='ll', threading=False, jpeg_ext='jpg'):
+    out_folder = join(abspath(make_session_folder()), 'export')
+    arg_list = Namespace(gpkg=file_path, out_folder=out_folder,
+                         table_name='tiles', tileorigin=tileorigin,
+                         processes=2, writers=2, threading=threading,
+                         jpeg_ext=jpeg_ext)
+    assert main(arg_list) == 5
+    return out_folder
+
+
+def test_row_chunks():
+    file_path = make_gpkg()
+    assert row_chunks(file_path, 'tiles') == [(1, 0, 0, 1), (2, 0, 1, 4)]
+    assert row_chunks(file_path, 'tiles', 2) == [(1, 0, 0, 1), (2, 0, 0, 2),
+                                                 (2, 1, 1, 2)]
+
+
+def test_round_trip():
+    file_path = make_gpkg()
+    assert read_tree(export(file_path)) == read_tree(GEODETIC_FILE_PATH)
+    assert read_tree(export(file_path, threading=True)) == \
+        read_tree(GEODETIC_FILE_PATH)
+
+
+def test_wmts_rows():
+    file_path = make_gpkg()
+    expected = {}
+    for name, data in read_tree(GEODETIC_FILE_PATH).items():
+        z, x, y = name[:-len('.png')].split('/')
+        y = Geodetic.invert_y(int(z), int(y))
+        expected['{}/{}/{}.png'.format(z, x, y)] = data
+    assert read_tree(export(file_path, 'ul')) == expected
+
+
+def test_jpeg_ext():
+    # A folder of .jpeg tiles, whose blobs start like JPEGs
+    source = join(abspath(make_session_folder()), 'jpeg')
+    for name in read_tree(GEODETIC_FILE_PATH):
+        z, x, y = name[:-len('.png')].split('/')
+        if not exists(join(source, z, x)):
+            makedirs(join(source, z, x))
+        with open(join(source, z, x, y + '.jpeg'), 'wb') as tile_file:
+            tile_file.write(b'\xff\xd8\xff' + name.encode())
+    file_path = make_tile_gpkg(list(scan_tiles(source)), 4326, read_file)
+    assert read_tree(export(file_path, jpeg_ext='jpeg')) == read_tree(source)
+    assert sorted(read_tree(export(file_path))) == sorted(
+        name[:-len('.jpeg')] + '.jpg' for name in read_tree(source))
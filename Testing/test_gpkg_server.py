@@ -0,0 +1,144 @@
+"""
+Copyright (C) 2014 Reinventing Geospatial, Inc.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>,
+or write to the Free Software Foundation, Inc., 59 Temple Place -
+Suite 330, Boston, MA 02111-1307, USA.
+
+Requires: Python 3.7 or later, Sqlite3
+Description: Test cases for gpkg_server.py
+
+Version:
+"""
+
+from asyncio import gather, open_connection, run
+from os.path import abspath
+from sys import path
+
+from pytest import raises
+
+path.append(abspath("Packaging"))
+from gpkg_server import TileServer
+from gpkg_server import parse_path
+from test_tiles2gpkg import make_tile_gpkg
+
+PNG = b'\x89PNG\r\n\x1a\n'
+
+
+def make_gpkg(table_name='tiles'):
+    """Make a geopackage with the four zoom 1 tiles, named by position."""
+    tiles = [dict(z=1, x=x, y=y, path='') for x in (0, 1) for y in (0, 1)]
+    return make_tile_gpkg(tiles, data_fn=lambda tile: PNG + '{z}/{x}/{y}'
+                          .format(**tile).encode(), table_name=table_name)
+
+
+async def request(reader, writer, path, headers=(), method='GET'):
+    """Send one request on a connection and return (status, headers, body)."""
+    lines = ['{} {} HTTP/1.1'.format(method, path), 'Host: test']
+    lines += ['{}: {}'.format(*header) for header in headers]
+    writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode())
+    head = (await reader.readuntil(b'\r\n\r\n')).decode().split('\r\n')
+    fields = dict(line.split(': ', 1) for line in head[1:] if line)
+    length = int(fields['Content-Length'])
+    body = await reader.readexactly(length) if method != 'HEAD' else b''
+    return int(head[0].split()[1]), fields, body
+
+
+def serve(coroutine, *args, **kwargs):
+    """Run a test coroutine against a TileServer on a free port."""
+    async def main():
+        tile_server = TileServer(*args, **kwargs)
+        server = await tile_server.start('127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            return await coroutine(tile_server, port)
+        finally:
+            server.close()
+            await server.wait_closed()
+            tile_server.close()
+    return run(main())
+
+
+def test_parse_path():
+    assert parse_path('/tiles/3/2/5') == ('tiles', 3, 2, 5)
+    assert parse_path('/tiles/3/2/5.png?key=1') == ('tiles', 3, 2, 5)
+    assert parse_path('/tiles/3/2') is None
+    assert parse_path('/tiles/3/a/5') is None
+
+
+def test_tiles_and_keep_alive():
+    async def check(tile_server, port):
+        reader, writer = await open_connection('127.0.0.1', port)
+        # XYZ rows count from the top, so TMS row 1 is XYZ row 0
+        status, fields, body = await request(reader, writer, '/tiles/1/0/0')
+        assert status == 200 and body == PNG + b'1/0/1'
+        assert fields['Content-Type'] == 'image/png'
+        assert fields['Connection'] == 'keep-alive'
+        status, _, body = await request(reader, writer, '/tiles/1/1/1.png')
+        assert status == 200 and body == PNG + b'1/1/0'
+        status, _, _ = await request(reader, writer, '/tiles/2/0/0')
+        assert status == 404
+        status, _, _ = await request(reader, writer, '/other/1/0/0')
+        assert status == 404
+        status, _, _ = await request(reader, writer, '/tiles/1/0')
+        assert status == 400
+        status, fields, body = await request(reader, writer, '/tiles/1/0/0',
+                                             method='HEAD')
+        assert status == 200 and fields['Content-Length'] == '13'
+        status, fields, _ = await request(reader, writer, '/tiles/1/0/0',
+                                          [('Connection', 'close')])
+        assert fields['Connection'] == 'close'
+        assert await reader.read() == b''
+        writer.close()
+        return tile_server.stats()
+    stats = serve(check, [make_gpkg()])
+    assert stats['misses'] == 2 and stats['hits'] == 2
+
+
+def test_etag():
+    async def check(tile_server, port):
+        reader, writer = await open_connection('127.0.0.1', port)
+        status, fields, _ = await request(reader, writer, '/tiles/1/0/0')
+        etag = fields['ETag']
+        status, fields, body = await request(reader, writer, '/tiles/1/0/0',
+                                             [('If-None-Match', etag)])
+        assert status == 304 and body == b'' and fields['ETag'] == etag
+        status, _, _ = await request(reader, writer, '/tiles/1/0/1',
+                                     [('If-None-Match', etag)])
+        assert status == 200
+        writer.close()
+    serve(check, [make_gpkg()])
+
+
+def test_concurrent_clients():
+    async def client(port, paths):
+        reader, writer = await open_connection('127.0.0.1', port)
+        bodies = [(await request(reader, writer, path))[2] for path in paths]
+        writer.close()
+        return bodies
+
+    async def check(tile_server, port):
+        paths = ['/ortho/1/{}/{}'.format(x, y) for x in (0, 1)
+                 for y in (0, 1)]
+        results = await gather(*[client(port, paths) for _ in range(8)])
+        assert all(bodies == results[0] for bodies in results)
+        # Every tile was read from the geopackage once
+        return tile_server.stats()
+    stats = serve(check, [make_gpkg('ortho')], lower_left=True, threads=2)
+    assert stats['misses'] == 4 and stats['cached_tiles'] == 4
+
+
+def test_duplicate_tables():
+    with raises(ValueError):
+        TileServer([make_gpkg(), make_gpkg()])
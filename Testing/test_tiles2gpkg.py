@@ -28,20 +28,36 @@ Description: Test cases for tiles2gpkg_parallel.py
 Version:
 """
 
+from argparse import Namespace
 from math import pi
 from os import chdir
+from os import getpid
 from os import getcwd
 from os import listdir
 from os import mkdir
 from os import remove
+from os import utime
 from os import walk
 
 from os.path import abspath
+from os.path import exists
+from os.path import getsize
 from os.path import join
+from os.path import split
+from pickle import dumps
+from pstats import Stats
+from pickle import loads
+from multiprocessing import Queue
+from multiprocessing.pool import ThreadPool
 from random import randint
+from shutil import copytree
 from sqlite3 import Binary
+from sqlite3 import ProgrammingError
+from sqlite3 import connect
 from sys import path
 from sys import version_info
+# Worker databases can only be kept in memory with sqlite3 serialize()
+SERIALIZE = hasattr(connect(":memory:"), 'serialize')
 if version_info[0] == 3:
     xrange = range
 from tempfile import gettempdir
@@ -51,27 +67,63 @@ from PIL import ImageDraw
 from PIL.Image import new
 from PIL.Image import open as iopen
 
+from pytest import mark
 from pytest import raises
 
 path.append(abspath("Packaging"))
+from tiles2gpkg_parallel import ChunkSizer
 from tiles2gpkg_parallel import EllipsoidalMercator
+from tiles2gpkg_parallel import EncodeCache
 from tiles2gpkg_parallel import Geodetic
 from tiles2gpkg_parallel import Geopackage
+from tiles2gpkg_parallel import GeopackageReader
+from tiles2gpkg_parallel import Manifest
 from tiles2gpkg_parallel import Mercator
+from tiles2gpkg_parallel import ProgressCounters
+from tiles2gpkg_parallel import RunJournal
+from tiles2gpkg_parallel import QueueDB
 from tiles2gpkg_parallel import ScaledWorldMercator
 from tiles2gpkg_parallel import TempDB
+from tiles2gpkg_parallel import TileIndex
+from tiles2gpkg_parallel import TileShard
 from tiles2gpkg_parallel import ZoomMetadata
 from tiles2gpkg_parallel import allocate
 from tiles2gpkg_parallel import build_lut
+from tiles2gpkg_parallel import choose_page_size
+from tiles2gpkg_parallel import chunk_tiles
+from tiles2gpkg_parallel import close_worker_parts
+from tiles2gpkg_parallel import column_ranges
 from tiles2gpkg_parallel import combine_worker_dbs
 from tiles2gpkg_parallel import file_count
+from tiles2gpkg_parallel import format_duration
+from tiles2gpkg_parallel import get_invert_y
+from tiles2gpkg_parallel import gpkg_writer
+from tiles2gpkg_parallel import hilbert_index
 from tiles2gpkg_parallel import img_has_transparency
 from tiles2gpkg_parallel import img_to_buf
+from tiles2gpkg_parallel import init_worker
+from tiles2gpkg_parallel import interleave_chunks
+from tiles2gpkg_parallel import main
+from tiles2gpkg_parallel import merge_profiles
+from tiles2gpkg_parallel import parse_layer
+from tiles2gpkg_parallel import phase_summary
+from tiles2gpkg_parallel import progress_line
+from tiles2gpkg_parallel import read_tile
+from tiles2gpkg_parallel import sample_tile_sizes
+from tiles2gpkg_parallel import scan_anchor_tiles
+from tiles2gpkg_parallel import run_workers
+from tiles2gpkg_parallel import scan_tiles
+from tiles2gpkg_parallel import sniff_format
+from tiles2gpkg_parallel import shard_columns
+from tiles2gpkg_parallel import shard_worker
 from tiles2gpkg_parallel import split_all
+from tiles2gpkg_parallel import stage_report
 from tiles2gpkg_parallel import sqlite_worker
+from tiles2gpkg_parallel import tile_position
 from tiles2gpkg_parallel import worker_map
+from tiles2gpkg_parallel import zoom_extents
 
-GEODETIC_FILE_PATH = join(getcwd(), "rgb_tiles", "geodetic")
+GEODETIC_FILE_PATH = join(getcwd(), "Testing", "rgb_tiles", "geodetic")
 MERCATOR_FILE_PATH = join(getcwd(), "Testing", "rgb_tiles", "mercator")
 
 # testing commands:
@@ -522,6 +574,213 @@ class Testgeopackage:
                 assert False
             assert True
 
+    def test_append_missing_file(self):
+        with raises(IOError):
+            Geopackage(join(gettempdir(), uuid4().hex + '.gpkg'), 3857,
+                       append=True)
+
+    def test_append_wrong_srs(self):
+        gpkg = make_gpkg()
+        with raises(ValueError):
+            Geopackage(gpkg.file_path, 3857, append=True)
+
+    def test_append_grid(self):
+        # The east half of zoom 1 and 2 goes in first...
+        east = [dict(z=z, x=x, y=y) for z in (1, 2)
+                for x in xrange(2**z // 2, 2**z) for y in xrange(2**z)]
+        west = [dict(z=z, x=x, y=y) for z in (1, 2)
+                for x in xrange(2**z // 2) for y in xrange(2**z)]
+        file_path = join(gettempdir(), uuid4().hex + '.gpkg')
+        with Geopackage(file_path, 3857) as gpkg:
+            lut = build_lut(east, True, 3857)
+            gpkg.update_metadata(lut)
+            for tile in east:
+                level = lut[tile['z'] - 1]
+                gpkg.execute("""INSERT INTO tiles (zoom_level, tile_column,
+                    tile_row, tile_data) VALUES (?, ?, ?, ?)""",
+                             (tile['z'], tile['x'] - level.min_tile_row,
+                              Mercator.invert_y(tile['z'], tile['y']),
+                              Binary(b'east')))
+        # ...then the west half is appended, which moves the origin west
+        with Geopackage(file_path, 3857, append=True) as gpkg:
+            lut = gpkg.append_grid(build_lut(west, True, 3857), True)
+            assert [(level.zoom, level.min_tile_row, level.matrix_width)
+                    for level in lut] == [(1, 0, 2), (2, 0, 4)]
+            for tile in west:
+                gpkg.execute("""INSERT INTO tiles (zoom_level, tile_column,
+                    tile_row, tile_data) VALUES (?, ?, ?, ?)""",
+                             (tile['z'], tile['x'],
+                              Mercator.invert_y(tile['z'], tile['y']),
+                              Binary(b'west')))
+            gpkg.refresh_metadata()
+            tiles = gpkg.execute("""SELECT zoom_level, tile_column,
+                CAST(tile_data AS TEXT) FROM tiles""").fetchall()
+            assert all((data == 'east') == (column >= 2**zoom // 2)
+                       for zoom, column, data in tiles)
+            assert len(tiles) == len(east) + len(west)
+            matrix = gpkg.execute("""SELECT zoom_level, matrix_width,
+                matrix_height FROM gpkg_tile_matrix
+                ORDER BY zoom_level""").fetchall()
+            assert matrix == [(1, 2, 2), (2, 4, 4)]
+            (bounds,) = gpkg.execute("""SELECT min_x, min_y, max_x, max_y
+                FROM gpkg_contents""").fetchall()
+            assert [round(item) for item in bounds] == \
+                [-20037508, -20037508, 20037508, 20037508]
+
+    def test_several_tables(self):
+        file_path = join(make_session_folder(), 'layers.gpkg')
+        lut = build_lut(make_mercator_filelist(), True, 3857)
+        with Geopackage(file_path, 3857) as gpkg:
+            gpkg.update_metadata(lut)
+        with Geopackage(file_path, 4326, table_name='ortho') as gpkg:
+            assert gpkg.table_name == 'ortho'
+            gpkg.update_metadata(build_lut(make_geodetic_filelist(), True,
+                                           4326))
+            result = gpkg.execute("""SELECT table_name, srs_id
+                FROM gpkg_tile_matrix_set ORDER BY table_name""").fetchall()
+            assert result == [('ortho', 4326), ('tiles', 3857)]
+            result = gpkg.execute("""SELECT count(*)
+                FROM gpkg_spatial_ref_sys""").fetchone()
+            assert result == (6,)
+        with Geopackage(file_path, 4326, True, 'ortho') as gpkg:
+            gpkg.execute("""INSERT INTO ortho
+                (zoom_level, tile_column, tile_row, tile_data)
+                VALUES (1, 0, 0, x'00')""")
+            gpkg.refresh_metadata()
+            result = gpkg.execute("""SELECT table_name, zoom_level
+                FROM gpkg_tile_matrix ORDER BY table_name""").fetchall()
+            assert result == [('ortho', 1), ('tiles', 1)]
+
+    def test_page_size_and_optimize(self):
+        file_path = join(make_session_folder(), 'pages.gpkg')
+        with Geopackage(file_path, 3857, page_size=8192) as gpkg:
+            gpkg.update_metadata(build_lut(make_mercator_filelist(), True,
+                                           3857))
+            gpkg.execute("""INSERT INTO tiles
+                (zoom_level, tile_column, tile_row, tile_data)
+                VALUES (1, 0, 0, ?), (1, 0, 1, x'00')""",
+                         (Binary(b'0' * 100000),))
+            gpkg.execute("DELETE FROM tiles WHERE tile_row = 0")
+        # A second tile table keeps the page size of the file
+        with Geopackage(file_path, 3857, table_name='more',
+                        page_size=4096) as gpkg:
+            assert gpkg.page_size == 8192
+        con = connect(file_path)
+        assert con.execute("pragma freelist_count;").fetchone()[0] > 0
+        con.close()
+        size = Geopackage.optimize(file_path, compact=True)
+        assert size == getsize(file_path) and not exists(file_path +
+                                                         '.compact')
+        con = connect(file_path)
+        assert con.execute("pragma freelist_count;").fetchone() == (0,)
+        assert con.execute("pragma page_size;").fetchone() == (8192,)
+        assert con.execute("""SELECT count(*) FROM sqlite_stat1
+            WHERE tbl = 'tiles'""").fetchone()[0] > 0
+        con.close()
+
+
+class TestGeopackageReader:
+
+    """Test the GeopackageReader object."""
+
+    def __make_gpkg(self, srs=3857):
+        """Make a geopackage of a 2x2 tile area at zoom 3 and 4x4 at 4."""
+        tiles = [dict(z=3, x=x, y=y, path='') for x in (2, 3) for y in (5, 6)]
+        tiles += [dict(z=4, x=x, y=y, path='') for x in xrange(4, 8)
+                  for y in xrange(10, 14)]
+        return make_tile_gpkg(tiles, srs), tiles
+
+    def test_get_tile(self):
+        file_path, tiles = self.__make_gpkg()
+        with GeopackageReader(file_path) as reader:
+            assert reader.srs == 3857 and reader.zoom_levels == [3, 4]
+            for tile in tiles:
+                assert reader.get_tile(tile['z'], tile['x'], tile['y']) == \
+                    '{z}/{x}/{y}'.format(**tile).encode()
+            assert reader.get_tile(4, 3, 10) is None
+            assert reader.get_tile(5, 8, 20) is None
+            assert reader.get_tile(3, 2, 5) == b'3/2/5'
+            stats = reader.stats()
+            assert stats['hits'] == 1 and stats['misses'] == 21
+            assert stats['cached_tiles'] == 20
+
+    def test_get_tile_wmts(self):
+        file_path, tiles = self.__make_gpkg(4326)
+        with GeopackageReader(file_path, lower_left=False) as reader:
+            for tile in tiles:
+                y = Geodetic.invert_y(tile['z'], tile['y'])
+                assert reader.get_tile(tile['z'], tile['x'], y) == \
+                    '{z}/{x}/{y}'.format(**tile).encode()
+
+    def test_get_tiles(self):
+        file_path, _ = self.__make_gpkg()
+        with GeopackageReader(file_path, cache_bytes=12) as reader:
+            keys = [(3, 2, 5), (3, 3, 6), (4, 0, 0), (7, 0, 0), (3, 2, 5)]
+            assert reader.get_tiles(keys) == {(3, 2, 5): b'3/2/5',
+                                              (3, 3, 6): b'3/3/6',
+                                              (4, 0, 0): None,
+                                              (7, 0, 0): None}
+            # Only two 5 byte tiles fit the cache
+            stats = reader.stats()
+            assert stats['cached_tiles'] == 2 and stats['cached_bytes'] == 10
+            reader.get_tile(3, 3, 6)
+            assert reader.stats()['hit_rate'] == 0.25
+
+    def test_iterators(self):
+        file_path, tiles = self.__make_gpkg()
+        with GeopackageReader(file_path) as reader:
+            everything = sorted(reader.iter_zoom_range())
+            assert everything == sorted(
+                (tile['z'], tile['x'], tile['y'],
+                 '{z}/{x}/{y}'.format(**tile).encode()) for tile in tiles)
+            assert len(list(reader.iter_zoom_range(4))) == 16
+            assert len(list(reader.iter_zoom_range(max_zoom=3))) == 4
+            # The bottom-left tile of zoom 3 and its four children
+            x, y = Mercator().get_coord(3, 2, 5)
+            found = sorted(tile[:3] for tile in
+                           reader.iter_bbox((x + 1, y + 1, x + 2, y + 2)))
+            assert found == [(3, 2, 5), (4, 4, 10)]
+            assert list(reader.iter_bbox((x - 2, y - 2, x - 1, y - 1))) == []
+            assert reader.stats()['hits'] + reader.stats()['misses'] == 0
+
+    def test_threads(self):
+        file_path, tiles = self.__make_gpkg()
+        reader = GeopackageReader(file_path, connections=2)
+        pool = ThreadPool(4)
+        keys = [(tile['z'], tile['x'], tile['y']) for tile in tiles] * 4
+        found = pool.map(lambda key: reader.get_tile(*key), keys)
+        pool.close()
+        pool.join()
+        assert found == ['{}/{}/{}'.format(*key).encode() for key in keys]
+        reader.close()
+
+    def test_get_tile_while_iterating(self, monkeypatch):
+        # Batches of 3 tiles end inside a tile column
+        monkeypatch.setattr('tiles2gpkg_parallel.READER_SCAN_BATCH', 3)
+        file_path, tiles = self.__make_gpkg()
+        reader = GeopackageReader(file_path, connections=1, cache_bytes=0)
+        found = []
+        # A suspended iteration does not hold the only connection
+        for z, x, y, data in reader.iter_zoom_range():
+            assert reader.get_tile(z, x, y) == data
+            found.append((z, x, y))
+        assert sorted(found) == sorted((tile['z'], tile['x'], tile['y'])
+                                       for tile in tiles)
+        assert len(list(reader.iter_rows(4, 1, 2))) == 8
+        # Closing the reader also closes a connection that is borrowed,
+        # which is not returned to the pool
+        with reader._GeopackageReader__connection() as db_con:
+            reader.close()
+            with raises(ProgrammingError):
+                db_con.execute("SELECT 1;")
+        assert reader.get_tile(3, 2, 5) == b'3/2/5'
+        reader.close()
+
+    def test_missing_table(self):
+        file_path, _ = self.__make_gpkg()
+        with raises(ValueError):
+            GeopackageReader(file_path, 'other')
+
 
 class TestTempDB:
 
@@ -541,6 +800,156 @@ class TestTempDB:
         result = tempDB.execute("select count(*) from tiles;")
         assert result.fetchone()[0] == 1
 
+    def test_insert_image_blob_batched(self):
+        data = Binary(img_to_buf(new("RGB", (256, 256), "red"),
+                                 'jpeg').read())
+        chdir(gettempdir())
+        temp_folder = uuid4().hex
+        mkdir(temp_folder)
+
+        def written(temp_db):
+            con = connect(join(temp_folder, temp_db.name))
+            (count,) = con.execute("select count(*) from tiles;").fetchone()
+            con.close()
+            return count
+        with TempDB(temp_folder, batch_tiles=2) as temp_db:
+            temp_db.insert_image_blob(0, 0, 0, data)
+            assert written(temp_db) == 0
+            temp_db.insert_image_blob(1, 0, 0, data)
+            assert written(temp_db) == 2
+            temp_db.insert_image_blob(2, 0, 0, data)
+            assert written(temp_db) == 2
+        assert written(temp_db) == 3
+
+    def test_insert_image_blob_batch_bytes(self):
+        chdir(gettempdir())
+        temp_folder = uuid4().hex
+        mkdir(temp_folder)
+        with TempDB(temp_folder, batch_bytes=10) as temp_db:
+            temp_db.insert_image_blob(0, 0, 0, Binary(b'0123456789'))
+            con = connect(join(temp_folder, temp_db.name))
+            assert con.execute("select count(*) from tiles;").fetchone()[0] \
+                == 1
+            con.close()
+
+    def test_page_size(self):
+        chdir(gettempdir())
+        temp_folder = uuid4().hex
+        mkdir(temp_folder)
+        with TempDB(temp_folder, page_size=16384) as temp_db:
+            result = temp_db.execute("pragma page_size;").fetchone()
+            assert result == (16384,)
+
+    @mark.skipif(not SERIALIZE, reason="needs sqlite3 serialize()")
+    def test_memory(self):
+        temp_folder = make_session_folder()
+        with TempDB(temp_folder, memory_bytes=1024 * 1024) as temp_db:
+            temp_db.insert_image_blob(0, 0, 0, Binary(b'0123456789'))
+        assert temp_db.file_path is None
+        assert listdir(temp_folder) == []
+        with Geopackage(join(temp_folder, 'out.gpkg'), 3857) as gpkg:
+            assert gpkg.assimilate_data(temp_db.data) == 1
+            (count,) = gpkg.execute("select count(*) from tiles;")
+        assert count[0] == 1
+
+    @mark.skipif(not SERIALIZE, reason="needs sqlite3 serialize()")
+    def test_memory_spill(self):
+        temp_folder = make_session_folder()
+        with TempDB(temp_folder, batch_tiles=1, page_size=4096,
+                    memory_bytes=16384) as temp_db:
+            temp_db.insert_image_blob(0, 0, 0, Binary(b'0' * 100))
+            assert temp_db.file_path is None
+            for y in xrange(1, 4):
+                temp_db.insert_image_blob(1, 0, y, Binary(b'0' * 5000))
+            # the database moved to its part file and goes on there
+            assert temp_db.file_path == join(temp_folder, temp_db.name)
+            temp_db.insert_image_blob(2, 0, 0, Binary(b'0' * 100))
+        assert temp_db.data is None
+        con = connect(temp_db.file_path)
+        assert con.execute("select count(*) from tiles;").fetchone()[0] == 5
+        con.close()
+
+
+class TestEncodeCache:
+
+    """Test the EncodeCache object."""
+
+    def test_hit_and_miss(self):
+        cache = EncodeCache(100)
+        key = cache.key(b'source')
+        assert key not in cache
+        assert cache.put(key, b'encoded') == b'encoded'
+        assert key in cache and cache.get(key) == b'encoded'
+        assert cache.hits == 1 and cache.misses == 1
+
+    def test_eviction(self):
+        cache = EncodeCache(10)
+        cache.put('a', b'1234')
+        cache.put('b', b'1234')
+        cache.get('a')
+        # 'b' is now the least recently used entry
+        cache.put('c', b'1234')
+        assert 'a' in cache and 'c' in cache and 'b' not in cache
+
+    def test_oversized_and_none(self):
+        cache = EncodeCache(4)
+        cache.put('big', b'12345')
+        cache.put('empty', None)
+        assert 'big' not in cache and 'empty' in cache
+        assert cache.get('empty') is None
+
+
+class TestTileIndex:
+
+    """Test the TileIndex object."""
+
+    def test_from_tiles(self):
+        tiles = list(scan_tiles(GEODETIC_FILE_PATH))
+        index = TileIndex.from_tiles(GEODETIC_FILE_PATH, tiles)
+        assert len(index) == len(tiles)
+        assert sorted(index, key=lambda item: item['path']) == \
+            sorted(tiles, key=lambda item: item['path'])
+
+    def test_path(self):
+        index = TileIndex(GEODETIC_FILE_PATH)
+        index.append(2, 1, 0, '.png')
+        assert index.path(0) == join(GEODETIC_FILE_PATH, "2", "1", "0.png")
+        assert index[-1]['path'] == index.path(0)
+
+    def test_slice(self):
+        index = TileIndex.from_tiles(GEODETIC_FILE_PATH,
+                                     scan_tiles(GEODETIC_FILE_PATH))
+        head = index[:2]
+        assert isinstance(head, TileIndex) and len(head) == 2
+        assert list(head) == list(index)[:2]
+
+    def test_sort(self):
+        index = TileIndex("root")
+        for z, x, y in ((2, 1, 1), (1, 0, 0), (2, 0, 1), (2, 1, 0)):
+            index.append(z, x, y, '.jpg')
+        index.sort()
+        assert [(item['z'], item['x'], item['y']) for item in index] == \
+            [(1, 0, 0), (2, 0, 1), (2, 1, 0), (2, 1, 1)]
+
+    def test_zoom(self):
+        index = TileIndex("root")
+        for z, x, y in ((2, 1, 1), (1, 0, 0), (2, 0, 1)):
+            index.append(z, x, y, '.png')
+        assert index.zoom_levels() == [1, 2]
+        assert len(index.zoom(2)) == 2
+        index.sort()
+        assert [item['y'] for item in index.zoom(2)] == [1, 1]
+
+    def test_pickle(self):
+        index = TileIndex("root")
+        tiles = []
+        for y in xrange(1000):
+            index.append(10, 5, y, '.png')
+            tiles.append(index[-1])
+        result = loads(dumps(index))
+        assert list(result) == tiles
+        assert len(dumps(index)) < len(dumps(tiles)) / 2
+
 
 class TestImgToBuf:
 
@@ -560,6 +969,11 @@ class TestImgToBuf:
         # all necessary chunks in a .PNG bitstream
         assert b'IHDR' in data and b'IDAT' in data and b'IEND' in data
 
+    def test_img_to_buf_jpg_rgba(self):
+        img = new("RGBA", (256, 256), "red")
+        data = img_to_buf(img, 'jpeg').read()
+        assert b'JFIF' in data
+
     def test_img_to_buf_source(self):
         img = new("RGB", (256, 256), "red")
         img.save("test2.jpg")
@@ -596,11 +1010,187 @@ class TestImgHasTransparency:
         img = new('P', (256, 256))
         assert img_has_transparency(img) == 0
 
+    def test_other_tile_size(self):
+        img = new('RGBA', (512, 512))
+        assert img_has_transparency(img) == -1
+        draw = ImageDraw.Draw(img)
+        draw.rectangle((0, 0, 511, 255), fill=(0, 0, 255, 255))
+        assert img_has_transparency(img) == 1
+
+    def test_translucent_not_transparent(self):
+        img = new('RGBA', (256, 256), (255, 0, 0, 128))
+        assert img_has_transparency(img) == 0
+
+    def test_luminance_alpha(self):
+        img = new('LA', (256, 256), (255, 0))
+        assert img_has_transparency(img) == -1
+
+
+def test_choose_page_size():
+    # Small tiles share pages, so the smallest page reads them as well
+    assert choose_page_size([75] * 9) == 4096
+    # A 22 KB tile takes six 4 KB pages, or a leaf and an overflow page of
+    # 16 KB for 9% more space; 32 KB pages would waste a third of the file
+    assert choose_page_size([1000, 22361, 30000]) == 16384
+    assert choose_page_size([]) == 4096
+
+
+def test_sample_tile_sizes():
+    sizes = sample_tile_sizes(GEODETIC_FILE_PATH, [1, 2], count=3,
+                              columns=2)
+    assert len(sizes) == 2 and all(size > 0 for size in sizes)
+
 
 def test_file_count():
     assert len(file_count(MERCATOR_FILE_PATH)) == 4
 
 
+def test_scan_tiles():
+    result = sorted((item['z'], item['x'], item['y'])
+                    for item in scan_tiles(MERCATOR_FILE_PATH))
+    assert result == [(1, 0, 0), (1, 0, 1), (1, 1, 0), (1, 1, 1)]
+
+
+def test_scan_tiles_zoom_levels():
+    result = list(scan_tiles(GEODETIC_FILE_PATH, [2]))
+    assert len(result) == 4 and all(item['z'] == 2 for item in result)
+
+
+def test_scan_tiles_with_stat():
+    result = list(scan_tiles(MERCATOR_FILE_PATH, with_stat=True))
+    assert len(result) == 4
+    for item in result:
+        assert item['size'] == len(read_tile(item['path']))
+        assert item['mtime'] > 0
+
+
+def test_manifest():
+    session_folder = make_session_folder()
+    source = join(session_folder, 'source')
+    copytree(MERCATOR_FILE_PATH, source)
+    tile_info = build_lut(list(scan_tiles(source)), True, 3857)
+    invert_y = get_invert_y(True, 3857)
+    file_path = join(session_folder, 'test.gpkg')
+    Geopackage(file_path, 3857)
+
+    def run(use_hash=False):
+        with Manifest(file_path, source) as manifest:
+            for _ in manifest.record(scan_tiles(source, with_stat=True)):
+                pass
+            changes = manifest.diff(use_hash)
+            changed = manifest.changed()
+            manifest.delete_stale()
+            manifest.update(tile_info, invert_y)
+        return changes, sorted((tile['x'], tile['y']) for tile in changed)
+    assert run(True) == ((4, 0, 0), [(0, 0), (0, 1), (1, 0), (1, 1)])
+    assert run(True) == ((0, 0, 4), [])
+    con = connect(file_path)
+    rows = con.execute("""SELECT path, zoom_level, tile_column, tile_row
+        FROM tiles_manifest ORDER BY path""").fetchall()
+    assert rows[0] == (join('1', '0', '0.png'), 1, 0, 1)
+    con.execute("""INSERT INTO tiles (zoom_level, tile_column, tile_row,
+        tile_data) VALUES (1, 1, 0, x'00')""")
+    con.commit()
+    con.close()
+    # touching a tile only counts as a change without hashes
+    utime(join(source, '1', '0', '0.png'), (1, 1))
+    assert run(True) == ((0, 0, 4), [])
+    utime(join(source, '1', '0', '0.png'), (2, 2))
+    assert run() == ((1, 0, 3), [(0, 0)])
+    # removing a tile deletes it from the geopackage and the manifest
+    remove(join(source, '1', '1', '1.png'))
+    assert run() == ((0, 1, 3), [])
+    con = connect(file_path)
+    assert con.execute("SELECT count(*) FROM tiles").fetchone() == (0,)
+    assert con.execute("SELECT count(*) FROM tiles_manifest").fetchone() \
+        == (3,)
+    con.close()
+
+
+def test_run_journal():
+    session_folder = make_session_folder()
+    file_path = join(session_folder, 'out.gpkg.journal')
+    settings = dict(srs=3857, imagery='png')
+    part = join(session_folder, 'a.gpkg.part')
+    open(part, 'w').close()
+    chunk = TileIndex('')
+    for x, y in [(0, 0), (0, 1), (0, 2), (0, 5), (1, 3)]:
+        chunk.add(dict(z=3, x=x, y=y, path=".png"))
+    other = TileIndex('')
+    other.add(dict(z=4, x=0, y=1, path=".png"))
+    with RunJournal(file_path, settings) as journal:
+        journal.chunk_done(chunk, part)
+        # a part holds the chunks a worker wrote one after the other
+        journal.chunk_done(other, part)
+        journal.set('stage', 2)
+    con = connect(file_path)
+    # consecutive y values are stored as one range
+    assert con.execute("SELECT zoom_level, x, min_y, max_y FROM done "
+                       "ORDER BY x, min_y;").fetchall() == \
+        [(3, 0, 0, 2), (4, 0, 1, 1), (3, 0, 5, 5), (3, 1, 3, 3)]
+    con.close()
+    with raises(ValueError):
+        RunJournal(file_path, dict(srs=4326, imagery='png'), True)
+    with raises(IOError):
+        RunJournal(file_path + '.missing', settings, True)
+    journal = RunJournal(file_path, settings, True)
+    assert journal.get('stage') == 2
+    tiles = [dict(z=3, x=0, y=y) for y in range(7)] + [dict(z=4, x=0, y=0)]
+    assert [(t['x'], t['y']) for t in journal.filter(tiles)] == \
+        [(0, 3), (0, 4), (0, 6), (0, 0)]
+    assert journal.skipped == 4
+    assert journal.parts() == [part]
+    journal.part_merged(part)
+    assert journal.parts() == []
+    # chunks of other tile tables are kept apart
+    journal.chunk_done(chunk, None, 'ortho')
+    assert journal.is_done(dict(z=3, x=0, y=5), 'ortho')
+    assert not journal.is_done(dict(z=3, x=0, y=4), 'ortho')
+    assert journal.parts('ortho') == []
+    journal.remove()
+    assert not exists(file_path)
+
+
+def test_main_resume_manifest(monkeypatch):
+    session_folder = make_session_folder()
+    source = join(session_folder, 'source')
+    copytree(MERCATOR_FILE_PATH, source)
+    file_path = join(session_folder, 'out.gpkg')
+    arg_list = make_arg_list(source, file_path, manifest=True)
+    main(arg_list)
+    changed = join(source, '1', '0', '0.png')
+    new('RGB', (256, 256), (255, 0, 0)).save(changed)
+    with open(changed, 'rb') as tile:
+        data = tile.read()
+
+    def interrupt(*args):
+        raise RuntimeError("interrupted")
+    # The changed tile is merged, but the run stops before it is done
+    monkeypatch.setattr(Manifest, 'update', interrupt)
+    arg_list = make_arg_list(source, file_path, manifest=True, append=True)
+    with raises(RuntimeError):
+        main(arg_list)
+    monkeypatch.undo()
+    # Resuming must not delete the changed tile again
+    arg_list = make_arg_list(source, file_path, manifest=True, append=True,
+                             resume=True)
+    main(arg_list)
+    con = connect(file_path)
+    assert con.execute("SELECT count(*) FROM tiles").fetchone() == (4,)
+    assert con.execute("SELECT tile_data FROM tiles WHERE zoom_level = 1 "
+                       "AND tile_column = 0 AND tile_row = 1").fetchone() \
+        == (data,)
+    con.close()
+    assert not exists(file_path + '.journal')
+
+
+def test_scan_anchor_tiles():
+    zoom_levels, tiles = scan_anchor_tiles(GEODETIC_FILE_PATH, [1, 2, 5])
+    # zoom 2 can be derived from zoom 1 and zoom 5 does not exist
+    assert zoom_levels == [1, 2]
+    assert [item['z'] for item in tiles] == [1]
+
+
 def test_split_all():
     coords = ["1", "2", "3.png"]
     file_path = join(getcwd(), "data", coords[0], coords[1], coords[2])
@@ -626,6 +1216,212 @@ def test_worker_map():
     assert len(files) == 1 and '.gpkg.part' in files[0]
 
 
+def test_sniff_format():
+    img = new("RGB", (256, 256), "red")
+    assert sniff_format(img_to_buf(img, 'png').read()) == 'png'
+    assert sniff_format(img_to_buf(img, 'jpeg').read()) == 'jpeg'
+    assert sniff_format(b'GIF89a') is None
+    assert sniff_format(b'') is None
+
+
+def test_read_tile():
+    tile = next(scan_tiles(MERCATOR_FILE_PATH))
+    with open(tile['path'], 'rb') as file_handle:
+        expected = file_handle.read()
+    assert read_tile(tile['path']) == expected
+    assert read_tile(tile['path'], use_mmap=True) == expected
+
+
+def test_worker_map_passthrough():
+    tile_dict = next(scan_tiles(MERCATOR_FILE_PATH))
+    expected = read_tile(tile_dict['path'])
+    for imagery in ('source', 'png'):
+        session_folder = make_session_folder()
+        extra_args = dict(tile_info=[make_zmd()], imagery=imagery,
+                          jpeg_quality=75)
+        with TempDB(session_folder) as temp_db:
+            worker_map(temp_db, tile_dict, extra_args, None)
+            (data,) = temp_db.execute("select tile_data from tiles;")
+        assert bytes(data[0]) == expected
+
+
+def test_worker_map_skip_empty():
+    session_folder = make_session_folder()
+    chdir(session_folder)
+    new('RGBA', (256, 256)).save("empty.png", "PNG")
+    tile_dict = dict(z=1, x=1, y=1, path=join(getcwd(), "empty.png"))
+    for skip_empty, expected in ((False, 1), (True, 0)):
+        extra_args = dict(tile_info=[make_zmd()], imagery='mixed',
+                          jpeg_quality=75, skip_empty=skip_empty)
+        with TempDB(getcwd()) as temp_db:
+            worker_map(temp_db, tile_dict, extra_args, None)
+            (count,) = temp_db.execute("select count(*) from tiles;")
+        assert count[0] == expected
+
+
+def test_sqlite_worker_encode_cache():
+    session_folder = make_session_folder()
+    path = next(scan_tiles(MERCATOR_FILE_PATH))['path']
+    file_list = [dict(z=1, x=x, y=y, path=path) for x in (0, 1)
+                 for y in (0, 1)]
+    extra_args = dict(root_dir=session_folder,
+                      tile_info=build_lut(file_list, True, 3857),
+                      lower_left=True, srs=3857, imagery='jpeg',
+                      jpeg_quality=75, encode_cache_bytes=1024 * 1024)
+    stats = sqlite_worker(file_list, extra_args)
+    close_worker_parts()
+    assert stats.pop('seconds') >= 0
+    assert stats.pop('bytes_in') == 4 * len(read_tile(path))
+    assert stats.pop('bytes_out') > 0
+    part = stats.pop('part')
+    assert stats == dict(tiles=4, cache_hits=3, cache_misses=1)
+    assert listdir(session_folder) == [split(part)[1]]
+    con = connect(part)
+    blobs = con.execute("select distinct tile_data from tiles;").fetchall()
+    con.close()
+    assert len(blobs) == 1
+
+
+def test_sqlite_worker_progress():
+    session_folder = make_session_folder()
+    path = next(scan_tiles(MERCATOR_FILE_PATH))['path']
+    file_list = [dict(z=1, x=x, y=y, path=path) for x in (0, 1)
+                 for y in (0, 1)]
+    extra_args = dict(root_dir=session_folder,
+                      tile_info=build_lut(file_list, True, 3857),
+                      lower_left=True, srs=3857, imagery='source',
+                      jpeg_quality=75)
+    counters = ProgressCounters()
+    init_worker(None, counters)
+    try:
+        stats = sqlite_worker(file_list, extra_args)
+    finally:
+        init_worker()
+    close_worker_parts()
+    assert counters.values() == (4, stats['bytes_in'], stats['bytes_out'])
+    assert stats['bytes_in'] == stats['bytes_out']
+
+
+def test_sqlite_worker_profile():
+    session_folder = make_session_folder()
+    path = next(scan_tiles(MERCATOR_FILE_PATH))['path']
+    file_list = [dict(z=1, x=x, y=y, path=path) for x in (0, 1)
+                 for y in (0, 1)]
+    profile = join(session_folder, 'run.pstats')
+    extra_args = dict(root_dir=session_folder,
+                      tile_info=build_lut(file_list, True, 3857),
+                      lower_left=True, srs=3857, imagery='jpeg',
+                      jpeg_quality=75, profile=profile)
+    first = sqlite_worker(file_list, extra_args)
+    # The same tiles again, so into a new part
+    close_worker_parts()
+    second = sqlite_worker(file_list, extra_args)
+    for stats in (first, second):
+        assert stats['worker'] == getpid()
+        assert stats['profile'] == profile + '.{}'.format(getpid())
+        assert sorted(stats['stages']) == sorted(
+            ['read', 'cache', 'decode', 'transparency', 'encode', 'insert'])
+        assert stats['stages']['decode'] > 0 and \
+            stats['stages']['encode'] > 0
+        assert stats['stages']['transparency'] == 0
+        assert sum(stats['stages'].values()) <= stats['seconds']
+    # Each chunk reports its own stage times, and the profile grows
+    merge_profiles([second['profile']], profile)
+    assert not exists(second['profile'])
+    calls = [value[1] for key, value in Stats(profile).stats.items()
+             if key[2] == 'worker_map']
+    assert calls == [8]
+    # Without the option, nothing is timed or profiled
+    extra_args['profile'] = None
+    close_worker_parts()
+    assert 'stages' not in sqlite_worker(file_list, extra_args)
+    close_worker_parts()
+
+
+@mark.skipif(not SERIALIZE, reason="needs sqlite3 serialize()")
+def test_sqlite_worker_memory():
+    session_folder = make_session_folder()
+    temp_dir = make_session_folder()
+    file_list = list(scan_tiles(MERCATOR_FILE_PATH))
+    extra_args = dict(root_dir=session_folder, temp_dir=temp_dir,
+                      tile_info=build_lut(file_list, True, 3857),
+                      lower_left=True, srs=3857, imagery='source',
+                      jpeg_quality=75, memory_bytes=1024 * 1024)
+    stats = sqlite_worker(file_list, extra_args)
+    assert 'part' not in stats and len(stats['data']) > 0
+    # too small for memory, so the part goes into the temp folder
+    extra_args['memory_bytes'] = 1
+    stats = sqlite_worker(file_list, extra_args)
+    assert 'data' not in stats
+    close_worker_parts()
+    assert split(stats['part'])[0] == temp_dir
+    assert listdir(session_folder) == []
+
+
+def test_sqlite_worker_shared_part():
+    session_folder = make_session_folder()
+    file_list = list(scan_tiles(MERCATOR_FILE_PATH))
+    extra_args = dict(root_dir=session_folder,
+                      tile_info=build_lut(file_list, True, 3857),
+                      lower_left=True, srs=3857, imagery='source',
+                      jpeg_quality=75)
+    first = sqlite_worker(file_list[:2], extra_args)
+    second = sqlite_worker(file_list[2:], extra_args)
+    # both chunks went into the part the worker keeps open
+    assert first['part'] == second['part']
+    close_worker_parts()
+    assert listdir(session_folder) == [split(first['part'])[1]]
+    con = connect(first['part'])
+    assert con.execute("select count(*) from tiles;").fetchone()[0] == \
+        len(file_list)
+    con.close()
+
+
+def test_stage_report():
+    workers = {7: dict(tiles=3, seconds=4.0, read=1.0, encode=2.0),
+               9: dict(tiles=1, seconds=4.0, read=1.0, decode=1.0)}
+    lines = stage_report(workers)
+    assert lines[0].split() == ['worker', 'tiles', 'read', 'cache',
+                                'decode', 'transparency', 'encode',
+                                'insert', 'other']
+    assert lines[1].split() == ['7', '3', '1.000', '0.000', '0.000',
+                                '0.000', '2.000', '0.000', '1.000']
+    assert lines[3].split()[:3] == ['total', '4', '2.000']
+    assert lines[4].split() == ['share', '25.0%', '0.0%', '12.5%', '0.0%',
+                                '25.0%', '0.0%', '37.5%']
+
+
+def test_progress_counters():
+    counters = ProgressCounters()
+    counters.add(2, 100, 50)
+    counters.add(1, 10, 5)
+    assert counters.values() == (3, 110, 55)
+
+
+def test_format_duration():
+    assert format_duration(0) == "0:00:00"
+    assert format_duration(3725.4) == "1:02:05"
+
+
+def test_progress_line():
+    line = progress_line(50, 200, 10.0, bytes_in=20e6, bytes_out=10e6)
+    assert line == "50/200 tiles (25.0%), 5 tiles/s, 2.0 MB/s in, " \
+        "1.0 MB/s out, ETA 0:00:30"
+    assert progress_line(50, 200, 10.0, final=False) == \
+        "50/200+ tiles (25.0%), 5 tiles/s, ETA >0:00:30"
+    assert progress_line(0, 10, 0) == "0/10 tiles (0.0%), 0 tiles/s"
+    assert progress_line(5e6, 10e6, 5.0, tiles=40) == \
+        "40 tiles (50.0%), 8 tiles/s, ETA 0:00:05"
+
+
+def test_phase_summary():
+    summary = phase_summary(100, 4.0, 8e6, 2e6)
+    assert summary == dict(tiles=100, seconds=4.0, tiles_per_second=25.0,
+                           bytes_in=8e6, mb_per_second_in=2.0,
+                           bytes_out=2e6, mb_per_second_out=0.5)
+    assert 'bytes_in' not in phase_summary(0, 0)
+
+
 class testsqliteworker:
 
     """Test the sqlite_worker function."""
@@ -700,6 +1496,119 @@ class testallocate:
             assert e is not None and type(e) == TypeError
 
 
+def test_allocate_fair_split():
+    class MockPool:
+        def apply_async(self, worker, args):
+            return args[0]
+    slices = allocate(4, MockPool(), list(range(10)), {})
+    assert [len(item) for item in slices] == [3, 3, 2, 2]
+    assert sum(slices, []) == list(range(10))
+
+
+def test_chunk_sizer():
+    sizer = ChunkSizer(target=1.0, initial=8, minimum=2, maximum=100)
+    assert sizer.size() == 8
+    sizer.update(10, 0.5)
+    assert sizer.size() == 20
+    sizer.update(10, 100.0)
+    assert sizer.size() == 2
+    sizer.update(0, 1.0)
+    assert sizer.cost is not None
+    fast = ChunkSizer(target=1.0, maximum=100)
+    fast.update(10, 0.0)
+    assert fast.size() == 100
+
+
+def test_interleave_chunks():
+    layers = [([dict(z=0, x=i, y=0, path='0/{}/0.png'.format(i))
+                for i in xrange(count)], 'root', dict(table_name=name))
+              for count, name in ((5, 'a'), (2, 'b'))]
+    chunks = list(interleave_chunks(layers, [ChunkSizer(initial=2)] * 2))
+    assert [(index, len(chunk)) for index, chunk in chunks] == \
+        [(0, 2), (1, 2), (0, 2), (0, 1)]
+
+
+def test_column_ranges():
+    chunk = TileIndex('')
+    for x, y in [(1, 3), (0, 5), (0, 1), (0, 0), (0, 2)]:
+        chunk.add(dict(z=3, x=x, y=y, path=".png"))
+    assert column_ranges(chunk) == [[3, 0, 0, 2], [3, 0, 5, 5], [3, 1, 3, 3]]
+    assert column_ranges(TileIndex('')) == []
+
+
+def test_shard_columns():
+    shards = list(shard_columns([1, 2], lambda: 3, MERCATOR_FILE_PATH,
+                                lambda zoom: {1: [(0, 0)]}))
+    # zoom 2 has no directory, and zoom 1 has two columns of two tiles
+    assert [(shard.zoom, list(shard.columns), len(shard))
+            for shard in shards] == [(1, [0], 2), (1, [1], 2)]
+    assert shards[0].done == {}
+    index, skipped = shards[1].tiles()
+    assert [(tile['x'], tile['y']) for tile in index] == [(1, 1)]
+    assert skipped == 1
+    shard = TileShard(MERCATOR_FILE_PATH, 1, [0, 1], 4)
+    index, skipped = shard.tiles()
+    assert [(tile['x'], tile['y']) for tile in index] == \
+        [(0, 0), (0, 1), (1, 0), (1, 1)]
+    assert skipped == 0
+
+
+def test_shard_worker():
+    session_folder = make_session_folder()
+    extra_args = dict(root_dir=session_folder,
+                      tile_info=build_lut(list(scan_tiles(MERCATOR_FILE_PATH)),
+                                          True, 3857),
+                      lower_left=True, srs=3857, imagery='source',
+                      jpeg_quality=75)
+    stats = shard_worker(TileShard(MERCATOR_FILE_PATH, 1, [0, 1], 1,
+                                   {0: [(0, 1)]}), extra_args)
+    assert stats['tiles'] == 2 and stats['skipped'] == 2
+    assert stats['ranges'] == [[1, 1, 0, 1]]
+    assert exists(stats['part'])
+    stats = shard_worker(TileShard(MERCATOR_FILE_PATH, 1, [0], 2,
+                                   {0: [(0, 1)]}), extra_args)
+    assert stats['tiles'] == 0 and stats['skipped'] == 2
+    assert 'part' not in stats
+
+
+def test_run_workers_shards():
+    session_folder = make_session_folder()
+    extra_args = dict(root_dir=session_folder,
+                      tile_info=build_lut(list(scan_tiles(MERCATOR_FILE_PATH)),
+                                          True, 3857),
+                      lower_left=True, srs=3857, imagery='source',
+                      jpeg_quality=75)
+    total, stats = run_workers([([1, 2], MERCATOR_FILE_PATH, extra_args)],
+                               False, shards=True)
+    assert total == 4
+    assert stats['layers'] == dict(tiles=4)
+    assert stats['zooms'] == dict(tiles=set([1]))
+    assert len(stats['parts']) >= 1
+
+
+def test_parse_layer():
+    arg_list = Namespace(srs=3857, tileorigin='ll', imagery='source', q=None)
+    assert parse_layer(MERCATOR_FILE_PATH, arg_list) == dict(
+        source=MERCATOR_FILE_PATH, table_name=None, srs=3857,
+        tileorigin='ll', imagery='source', jpeg_quality=None)
+    layer = parse_layer('tms=ortho,srs=4326,imagery=jpeg,q=80', arg_list)
+    assert layer == dict(source='tms', table_name='ortho', srs=4326,
+                         tileorigin='ll', imagery='jpeg', jpeg_quality=80)
+    for spec in ('tms', 'tms=1st', 'tms=gpkg_x', 'tms=a,srs=1', 'tms=a,b=c'):
+        with raises(ValueError):
+            parse_layer(spec, arg_list)
+
+
+def test_chunk_tiles_dynamic_size():
+    tiles = [dict(z=0, x=i, y=0, path='0/{}/0.png'.format(i))
+             for i in xrange(10)]
+    sizes = iter([2, 3, 100])
+    chunks = list(chunk_tiles(tiles, lambda: next(sizes), 'root'))
+    assert [len(chunk) for chunk in chunks] == [2, 3, 5]
+    assert [tile['x'] for chunk in chunks for tile in chunk] == \
+        list(range(10))
+
+
 class testbuildlut:
 
     """Test the build_lut function."""
@@ -757,6 +1666,40 @@ class testbuildlut:
         assert result[0].max_y == 90.0
 
 
+ZOOM_METADATA_FIELDS = ('zoom', 'min_tile_row', 'max_tile_row',
+                        'min_tile_col', 'max_tile_col', 'min_x', 'max_x',
+                        'min_y', 'max_y', 'matrix_width', 'matrix_height')
+
+
+def test_zoom_extents():
+    tiles = list(scan_tiles(GEODETIC_FILE_PATH))
+    expected = {1: [0, 0, 0, 0], 2: [0, 1, 0, 1]}
+    assert zoom_extents(tiles) == expected
+    assert zoom_extents(TileIndex.from_tiles(GEODETIC_FILE_PATH,
+                                             tiles)) == expected
+
+
+def test_build_lut_matches_legacy():
+    """The single pass build_lut() must match the original per-zoom scan."""
+    sparse = [dict(z=z, x=x, y=y, path=join(str(z), str(x), str(y) + '.png'))
+              for z, x, y in ((3, 2, 5), (3, 4, 1), (4, 9, 3), (6, 40, 17),
+                              (6, 33, 20), (7, 70, 40))]
+    file_lists = [list(scan_tiles(GEODETIC_FILE_PATH)),
+                  list(scan_tiles(MERCATOR_FILE_PATH)),
+                  sparse]
+    for file_list in file_lists:
+        for srs in (3857, 4326, 3395, 9804):
+            for lower_left in (True, False):
+                expected = legacy_build_lut(file_list, lower_left, srs)
+                for tiles in (file_list, TileIndex.from_tiles('', file_list)):
+                    result = build_lut(tiles, lower_left, srs)
+                    assert len(result) == len(expected)
+                    for new_level, old_level in zip(result, expected):
+                        for field in ZOOM_METADATA_FIELDS:
+                            assert getattr(new_level, field) == \
+                                getattr(old_level, field)
+
+
 def test_combine_worker_dbs():
     session_folder = make_session_folder()
     # make a random number of tempdbs with dummy data
@@ -764,13 +1707,91 @@ def test_combine_worker_dbs():
     data = img_to_buf(img, 'jpeg').read()
     z = randint(2, 5)
     for x in xrange(z):
-        TempDB(session_folder).insert_image_blob(x, 0, 0, Binary(data))
+        with TempDB(session_folder) as temp_db:
+            temp_db.insert_image_blob(x, 0, 0, Binary(data))
     # confirm that combine_worker_dbs assimilates all tempdb's into gpkg
     chdir(session_folder) # necessary to put gpkg in session_folder
     gpkg = Geopackage("test.gpkg", 4326)
-    combine_worker_dbs(gpkg)
+    merged = combine_worker_dbs(gpkg)
     result = gpkg.execute("select count(*) from tiles;")
     assert (result.fetchone())[0] == z
+    assert merged['tiles'] == z and merged['bytes'] > 0
+
+
+def test_hilbert_index():
+    # the order 1 curve visits (0,0), (0,1), (1,1), (1,0)
+    assert [hilbert_index(1, x, y) for x, y in
+            ((0, 0), (0, 1), (1, 1), (1, 0))] == [0, 1, 2, 3]
+    # every cell of a larger grid gets a distinct position
+    positions = set(hilbert_index(3, x, y)
+                    for x in xrange(8) for y in xrange(8))
+    assert positions == set(xrange(64))
+
+
+def test_bulk_load():
+    session_folder = make_session_folder()
+    data = Binary(img_to_buf(new("RGB", (256, 256), "red"), 'jpeg').read())
+    coords = [(2, 1, 1), (1, 0, 0), (2, 0, 1), (2, 1, 0), (2, 0, 0)]
+    for z, x, y in coords:
+        with TempDB(session_folder) as temp_db:
+            temp_db.insert_image_blob(z, x, y, data)
+    chdir(session_folder)
+    with Geopackage("test.gpkg", 4326) as gpkg:
+        gpkg.start_bulk_load()
+        combine_worker_dbs(gpkg)
+        assert gpkg.execute("select count(*) from tiles;").fetchone()[0] == 0
+        gpkg.finish_bulk_load('zoom')
+        result = gpkg.execute("""
+            select zoom_level, tile_column, tile_row from tiles order by id;
+        """).fetchall()
+    assert result == [(1, 0, 0), (2, 0, 0), (2, 1, 0), (2, 0, 1), (2, 1, 1)]
+    assert listdir(getcwd()) == ["test.gpkg"]
+
+
+def test_single_writer():
+    session_folder = make_session_folder()
+    chdir(session_folder)
+    data = Binary(img_to_buf(new("RGB", (256, 256), "red"), 'jpeg').read())
+    queue = Queue()
+    with QueueDB(queue, batch_tiles=2) as queue_db:
+        for x in xrange(3):
+            queue_db.insert_image_blob(x, 0, 0, data)
+    queue.put(None)
+    with Geopackage("test.gpkg", 4326) as gpkg:
+        gpkg_writer(queue, gpkg.file_path)
+        result = gpkg.execute("select count(*) from tiles;")
+        assert (result.fetchone())[0] == 3
+
+
+def test_single_writer_tables():
+    session_folder = make_session_folder()
+    chdir(session_folder)
+    queue = Queue()
+    for zoom, table_name in ((1, 'tiles'), (2, 'ortho'), (2, 'ortho')):
+        with QueueDB(queue, table_name=table_name) as queue_db:
+            queue_db.insert_image_blob(zoom, 0, 0, Binary(b'x'))
+    queue.put(None)
+    Geopackage("test.gpkg", 4326).close()
+    with Geopackage("test.gpkg", 4326, table_name='ortho') as gpkg:
+        gpkg.start_bulk_load()
+        gpkg_writer(queue, dict(tiles=gpkg.file_path, ortho=gpkg.bulk_path))
+        assert gpkg.bulk_path == "test.gpkg.ortho.bulk"
+        gpkg.finish_bulk_load()
+        result = gpkg.execute("""select zoom_level, count(*) from ortho
+            group by zoom_level;""").fetchall()
+        assert result == [(2, 1)]
+        result = gpkg.execute("select zoom_level from tiles;").fetchall()
+        assert result == [(1,)]
+
+
+def test_queue_db_backpressure():
+    queue = Queue(1)
+    queue_db = QueueDB(queue, batch_tiles=1)
+    queue_db.insert_image_blob(0, 0, 0, Binary(b'tile'))
+    # the second batch has to wait until the writer takes the first one
+    with raises(Exception):
+        queue.put([], timeout=0.1)
+    assert queue.get(timeout=1) == ('tiles', [(0, 0, 0, b'tile')])
 
 
 # todo: test main
@@ -865,8 +1886,102 @@ def make_geodetic_filelist():
     return [d1, d2, d3, d4, d5]
 
 
+def make_arg_list(source, output_file, **options):
+    """Return the options main() is called with for one source folder."""
+    arg_list = Namespace(
+        output_file=output_file, srs=3857, tileorigin='ll',
+        imagery='source', q=None, skip_empty=False, encode_cache_bytes=0,
+        use_mmap=False, append=False, manifest=False, manifest_hash=False,
+        shards=False, scan_threads=4, batch_tiles=1000,
+        batch_bytes=1024 * 1024, temp_dir=None, memory_bytes=0,
+        single_writer=False, queue_size=16, bulk_order=None, page_size=0,
+        profile=None, compact=False, resume=False, threading=False)
+    for key, value in options.items():
+        setattr(arg_list, key, value)
+    layer = parse_layer(source, arg_list)
+    layer['table_name'] = 'tiles'
+    arg_list.layers = [layer]
+    return arg_list
+
+
 def make_session_folder():
     session_folder = uuid4().hex
     chdir(gettempdir())
     mkdir(session_folder)
     return session_folder
+
+
+def make_tile_gpkg(tiles, srs=3857, data_fn=None, table_name='tiles'):
+    """
+    Make a geopackage in a new session folder with a tile table holding the
+    given TMS tile dictionaries, and return its absolute path.
+
+    Inputs:
+    tiles -- the tile dictionaries, numbered from the lower left
+    srs -- the spatial reference system of the geopackage
+    data_fn -- a function from a tile to its blob; by default the blob is
+               its z/x/y
+    table_name -- the name of the tile table
+    """
+    file_path = abspath(join(make_session_folder(), 'tiles.gpkg'))
+    lut = build_lut(tiles, True, srs)
+    invert_y = get_invert_y(True, srs)
+    with Geopackage(file_path, srs, table_name=table_name) as gpkg:
+        gpkg.update_metadata(lut)
+        for tile in tiles:
+            data = '{z}/{x}/{y}'.format(**tile).encode() \
+                if data_fn is None else data_fn(tile)
+            gpkg.execute("""INSERT INTO """ + table_name + """
+                (zoom_level, tile_column, tile_row, tile_data)
+                VALUES (?, ?, ?, ?)""",
+                         tile_position(tile, lut, invert_y) + (Binary(data),))
+    return file_path
+
+
+def legacy_build_lut(file_list, lower_left, srs):
+    """The original multi-pass build_lut(), kept as a reference."""
+    if srs == 3857:
+        projection = Mercator()
+    elif srs == 4326:
+        projection = Geodetic()
+    elif srs == 9804:
+        projection = ScaledWorldMercator()
+    else:
+        projection = EllipsoidalMercator()
+    zoom_levels = list(set([int(item['z']) for item in file_list]))
+    zoom_levels.sort()
+    matrix = []
+    for zoom in zoom_levels:
+        level = ZoomMetadata()
+        level.zoom = zoom
+        if zoom - 1 in [item for item in zoom_levels if item == (zoom - 1)]:
+            (prev, ) = ([item for item in matrix if item.zoom == (zoom - 1)])
+            level.min_tile_row = 2 * prev.min_tile_row
+            level.min_tile_col = 2 * prev.min_tile_col
+            level.max_tile_row = 2 * prev.max_tile_row + 1
+            level.max_tile_col = 2 * prev.max_tile_col + 1
+            level.matrix_width = prev.matrix_width * 2
+            level.matrix_height = prev.matrix_height * 2
+        else:
+            x_vals = [int(item['x'])
+                      for item in file_list if int(item['z']) == zoom]
+            y_vals = [int(item['y'])
+                      for item in file_list if int(item['z']) == zoom]
+            level.min_tile_row, level.max_tile_row = min(x_vals), max(x_vals)
+            level.min_tile_col, level.max_tile_col = min(y_vals), max(y_vals)
+            level.matrix_width = max(x_vals) - min(x_vals) + 1
+            level.matrix_height = max(y_vals) - min(y_vals) + 1
+        if lower_left:
+            level.min_x, level.max_y = projection.get_coord(
+                level.zoom, level.min_tile_row, level.max_tile_col + 1)
+            level.max_x, level.min_y = projection.get_coord(
+                level.zoom, level.max_tile_row + 1, level.min_tile_col)
+        else:
+            inv_min_y = projection.invert_y(level.zoom, level.min_tile_col)
+            inv_max_y = projection.invert_y(level.zoom, level.max_tile_col)
+            level.min_x, level.max_y = projection.get_coord(
+                level.zoom, level.min_tile_row, inv_min_y + 1)
+            level.max_x, level.min_y = projection.get_coord(
+                level.zoom, level.max_tile_row + 1, inv_max_y)
+        matrix.append(level)
+    return matrix
@@ -60,6 +60,7 @@ from math import pi, tan, log, exp, atan, ceil, log10, floor
 from multiprocessing import cpu_count, Pool, Process, Queue
 from optparse import OptionParser, OptionGroup
 from re import sub
+from sqlite3 import connect, Binary
 
 try:
     from osgeo import gdal, osr
@@ -123,12 +124,33 @@ Class is available under the open-source GDAL license (www.gdal.org).
 
 MAXZOOMLEVEL = 32
 
+# Number of tiles a worker writes to a GeoPackage output in one transaction
+GPKG_BATCH_TILES = 64
+
 Tile = namedtuple("Tile", ["tx", "ty"])
 LonLatPoint = namedtuple("LonLatPoint", ["lon", "lat"])
 MetersPoint = namedtuple("MetersPoint", ["mx", "my"])
 PixelsPoint = namedtuple("PixelsPoint", ["x", "y"])
 
 
+def gpkg_tile_position(tile, zoom, top_tiles, top_zoom):
+    """
+    Returns the GeoPackage tile_column and tile_row of a TMS tile.  The
+    tile matrix set covers the tiles of the top zoom level, so at every zoom
+    level the matrix starts at the top-left corner of those tiles and rows
+    count down from it.
+
+    Inputs:
+    tile -- the TMS Tile, with its origin in the bottom-left corner
+    zoom -- the zoom level of the tile
+    top_tiles -- the (tminx, tminy, tmaxx, tmaxy) tile range of top_zoom
+    top_zoom -- the zoom level the tile matrix set was made from
+    """
+    tminx, tminy, tmaxx, tmaxy = top_tiles
+    scale = 2**(zoom - top_zoom)
+    return tile.tx - tminx * scale, (tmaxy + 1) * scale - 1 - tile.ty
+
+
 class ITileProfile(object):
     @staticmethod
     def lower_left_tile(tile, zoom):
@@ -866,6 +888,15 @@ class GDAL2Tiles(object):
             # Directory with input filename without extension in actual directory
             self.output = path.splitext(path.basename(self.input))[0]
 
+        # An output ending in .gpkg is a GeoPackage instead of a TMS folder;
+        # tiles are encoded in memory and stored in its tiles table
+        self.gpkg = self.output.lower().endswith('.gpkg')
+        self.gpkg_db = None
+        self.gpkg_pending = 0
+        if self.gpkg and self.options.profile == 'raster':
+            self.error("GeoPackage output needs the 'mercator' or "
+                       "'geodetic' profile.")
+
         if not self.options.title:
             self.options.title = path.basename(self.input)
 
@@ -956,7 +987,8 @@ class GDAL2Tiles(object):
     def optparse_init(self):
         """Prepare the option parser for input (argv)"""
 
-        usage = "Usage: %prog [options] input_file(s) [output]"
+        usage = "Usage: %prog [options] input_file(s) [output]\n\n" + \
+            "An output ending in .gpkg is written as a GeoPackage."
         p = OptionParser(usage, version="%prog " + __version__)
         p.add_option(
             "-p",
@@ -1526,6 +1558,11 @@ class GDAL2Tiles(object):
         """Generation of main metadata files and HTML viewers (metadata related to particular tiles are generated during the tile processing)."""
         # Do not generate any metadata outside of tile map resource
 
+        if self.gpkg:
+            # The viewers and tilemapresource.xml need a TMS folder
+            self.create_geopackage()
+            return
+
         if not path.exists(self.output):
             makedirs(self.output)
 
@@ -1652,7 +1689,8 @@ class GDAL2Tiles(object):
                     print(ti, '/', tcount, tilefilename
                           )  #, "( TileMapService: z / x / y )"
 
-                if self.options.resume and path.exists(tilefilename):
+                if self.options.resume and self.tile_exists(tz, tx, ty,
+                                                            tilefilename):
                     if self.options.verbose:
                         print("Tile generation skiped because of --resume")
                     else:
@@ -1661,7 +1699,8 @@ class GDAL2Tiles(object):
                     continue
 
                 # Create directories for the tile
-                if not path.exists(path.dirname(tilefilename)):
+                if not self.gpkg and not path.exists(path.dirname(
+                        tilefilename)):
                     makedirs(path.dirname(tilefilename))
 
                 if self.options.profile == 'mercator':
@@ -1792,9 +1831,9 @@ class GDAL2Tiles(object):
 
                 del data
 
-                if self.options.resampling != 'antialias':
+                if self.options.resampling != 'antialias' or self.gpkg:
                     # Write a copy of tile to png/jpg
-                    self.out_drv.CreateCopy(tilefilename, dstile, strict=0)
+                    self.write_tile(tz, tx, ty, dstile, tilefilename)
 
                 del dstile
                 
@@ -1816,6 +1855,8 @@ class GDAL2Tiles(object):
                     #queue.put(tcount)
                     pass
 
+        self.flush_tiles()
+
         # -------------------------------------------------------------------------
     def generate_overview_tiles(self, cpu, tz):
         """Generation of the overview tiles (higher in the pyramid) based on existing tiles"""
@@ -1850,7 +1891,8 @@ class GDAL2Tiles(object):
                     print(ti, '/', tcount, tilefilename
                           )  #, "( TileMapService: z / x / y )"
 
-                if self.options.resume and path.exists(tilefilename):
+                if self.options.resume and self.tile_exists(tz, tx, ty,
+                                                            tilefilename):
                     #Remove JPEG aux.xml sidecars
                     sidecar = tilefilename+".aux.xml"
                     if(path.exists(sidecar)):
@@ -1863,7 +1905,8 @@ class GDAL2Tiles(object):
                     continue
 
                 # Create directories for the tile
-                if not path.exists(path.dirname(tilefilename)):
+                if not self.gpkg and not path.exists(path.dirname(
+                        tilefilename)):
                     makedirs(path.dirname(tilefilename))
                 
                 # TODO: improve that
@@ -1888,10 +1931,7 @@ class GDAL2Tiles(object):
                     for x in range(2 * tx, 2 * tx + 2):
                         minx, miny, maxx, maxy = self.tminmax[tz + 1]
                         if x >= minx and x <= maxx and y >= miny and y <= maxy:
-                            dsquerytile = gdal.Open(
-                                path.join(self.output, str(tz + 1), str(x),
-                                          "%s.%s" %
-                                          (y, self.tileext)), gdal.GA_ReadOnly)
+                            querytile = self.read_tile(tz + 1, x, y)
                             if (ty == 0 and y == 1) or (ty != 0 and
                                                         (y % (2 * ty)) != 0):
                                 tileposy = 0
@@ -1908,16 +1948,15 @@ class GDAL2Tiles(object):
                                 tileposy,
                                 self.tilesize,
                                 self.tilesize,
-                                dsquerytile.ReadRaster(0, 0, self.tilesize,
-                                                       self.tilesize),
+                                querytile,
                                 band_list=list(range(1, tilebands + 1)))
                             children.append([x, y, tz + 1])
 
                 self.scale_query_to_tile(dsquery, dstile, tilefilename)
                 # Write a copy of tile to png/jpg
-                if self.options.resampling != 'antialias':
+                if self.options.resampling != 'antialias' or self.gpkg:
                     # Write a copy of tile to png/jpg
-                    self.out_drv.CreateCopy(tilefilename, dstile, strict=0)
+                    self.write_tile(tz, tx, ty, dstile, tilefilename)
 
                 if self.options.verbose:
                     print("\tbuild from zoom", tz + 1, " tiles:",
@@ -1940,6 +1979,8 @@ class GDAL2Tiles(object):
                     #queue.put(tcount)
                     pass
 
+        self.flush_tiles()
+
         # -------------------------------------------------------------------------
     def geo_query(self, ds, ulx, uly, lrx, lry, querysize=0):
         """For given dataset and query in cartographic coordinates
@@ -2014,6 +2055,13 @@ class GDAL2Tiles(object):
                     dsquery.GetRasterBand(i + 1), 0, 0, querysize, querysize)
             im = Image.fromarray(array, 'RGBA')  # Always four bands
             im1 = im.resize((tilesize, tilesize), Image.ANTIALIAS)
+            if self.gpkg:
+                # The tile is encoded by write_tile() like the other ones
+                array = numpy.asarray(im1)
+                for i in range(tilebands):
+                    gdalarray.BandWriteArray(dstile.GetRasterBand(i + 1),
+                                             array[:, :, i])
+                return
             if path.exists(tilefilename):
                 im0 = Image.open(tilefilename)
                 im1 = Image.composite(im1, im0, im1)
@@ -2033,6 +2081,225 @@ class GDAL2Tiles(object):
                 self.error("ReprojectImage() failed on %s, error %d" %
                            (tilefilename, res))
 
+    # -------------------------------------------------------------------------
+    def create_geopackage(self):
+        """Create the GeoPackage tables and the tile matrix of the pyramid"""
+
+        if self.options.profile == 'mercator':
+            srs_id, grid, srs_name = 3857, self.mercator, \
+                'WGS 84 / Pseudo-Mercator'
+        else:
+            srs_id, grid, srs_name = 4326, self.geodetic, 'WGS 84'
+        srs4326 = osr.SpatialReference()
+        srs4326.ImportFromEPSG(4326)
+
+        # The tile matrix set covers the tiles of the top zoom level
+        tminx, tminy, tmaxx, tmaxy = self.tminmax[self.tminz]
+        minx, miny = grid.TileBounds(tminx, tminy, self.tminz)[:2]
+        maxx, maxy = grid.TileBounds(tmaxx, tmaxy, self.tminz)[2:]
+
+        db = connect(self.output)
+        # Lets the base and overview tile workers write at the same time;
+        # finish_geopackage() turns it off again
+        db.execute("pragma journal_mode = wal;")
+        with db:
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS gpkg_spatial_ref_sys (
+                    srs_name TEXT NOT NULL,
+                    srs_id INTEGER NOT NULL PRIMARY KEY,
+                    organization TEXT NOT NULL,
+                    organization_coordsys_id INTEGER NOT NULL,
+                    definition TEXT NOT NULL,
+                    description TEXT)""")
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS gpkg_contents (
+                    table_name TEXT NOT NULL PRIMARY KEY,
+                    data_type TEXT NOT NULL,
+                    identifier TEXT UNIQUE,
+                    description TEXT DEFAULT '',
+                    last_change DATETIME NOT NULL DEFAULT
+                    (strftime('%Y-%m-%dT%H:%M:%fZ','now')),
+                    min_x DOUBLE,
+                    min_y DOUBLE,
+                    max_x DOUBLE,
+                    max_y DOUBLE,
+                    srs_id INTEGER,
+                    CONSTRAINT fk_gc_r_srs_id FOREIGN KEY (srs_id)
+                        REFERENCES gpkg_spatial_ref_sys(srs_id))""")
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS gpkg_tile_matrix_set (
+                    table_name TEXT NOT NULL PRIMARY KEY,
+                    srs_id INTEGER NOT NULL,
+                    min_x DOUBLE NOT NULL,
+                    min_y DOUBLE NOT NULL,
+                    max_x DOUBLE NOT NULL,
+                    max_y DOUBLE NOT NULL,
+                    CONSTRAINT fk_gtms_table_name FOREIGN KEY (table_name)
+                        REFERENCES gpkg_contents(table_name),
+                    CONSTRAINT fk_gtms_srs FOREIGN KEY (srs_id)
+                        REFERENCES gpkg_spatial_ref_sys(srs_id))""")
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS gpkg_tile_matrix (
+                    table_name TEXT NOT NULL,
+                    zoom_level INTEGER NOT NULL,
+                    matrix_width INTEGER NOT NULL,
+                    matrix_height INTEGER NOT NULL,
+                    tile_width INTEGER NOT NULL,
+                    tile_height INTEGER NOT NULL,
+                    pixel_x_size DOUBLE NOT NULL,
+                    pixel_y_size DOUBLE NOT NULL,
+                    CONSTRAINT pk_ttm PRIMARY KEY (table_name, zoom_level),
+                    CONSTRAINT fk_ttm_table_name FOREIGN KEY (table_name)
+                        REFERENCES gpkg_contents(table_name))""")
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS tiles (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    zoom_level INTEGER NOT NULL,
+                    tile_column INTEGER NOT NULL,
+                    tile_row INTEGER NOT NULL,
+                    tile_data BLOB NOT NULL,
+                    UNIQUE (zoom_level, tile_column, tile_row))""")
+            db.executemany("""
+                INSERT OR IGNORE INTO gpkg_spatial_ref_sys (
+                    srs_name, srs_id, organization, organization_coordsys_id,
+                    definition)
+                VALUES (?, ?, ?, ?, ?)""", [
+                ('Undefined cartesian SRS', -1, 'NONE', -1, 'undefined'),
+                ('Undefined geographic SRS', 0, 'NONE', 0, 'undefined'),
+                ('WGS 84', 4326, 'EPSG', 4326, srs4326.ExportToWkt()),
+                (srs_name, srs_id, 'EPSG', srs_id, self.out_srs.ExportToWkt())
+            ])
+            db.execute("""
+                INSERT OR REPLACE INTO gpkg_contents (
+                    table_name, data_type, identifier, description,
+                    min_x, min_y, max_x, max_y, srs_id)
+                VALUES ('tiles', 'tiles', ?, ?, ?, ?, ?, ?, ?)""",
+                       (self.options.title, 'Created by gdal2tiles_parallel.py',
+                        max(minx, self.ominx), max(miny, self.ominy),
+                        min(maxx, self.omaxx), min(maxy, self.omaxy), srs_id))
+            db.execute("""
+                INSERT OR REPLACE INTO gpkg_tile_matrix_set (
+                    table_name, srs_id, min_x, min_y, max_x, max_y)
+                VALUES ('tiles', ?, ?, ?, ?, ?)""",
+                       (srs_id, minx, miny, maxx, maxy))
+            for tz in range(self.tminz, self.tmaxz + 1):
+                scale = 2**(tz - self.tminz)
+                db.execute("""
+                    INSERT OR REPLACE INTO gpkg_tile_matrix (
+                        table_name, zoom_level, matrix_width, matrix_height,
+                        tile_width, tile_height, pixel_x_size, pixel_y_size)
+                    VALUES ('tiles', ?, ?, ?, ?, ?, ?, ?)""",
+                           (tz, (tmaxx - tminx + 1) * scale,
+                            (tmaxy - tminy + 1) * scale, self.tilesize,
+                            self.tilesize, grid.Resolution(tz),
+                            grid.Resolution(tz)))
+        # Add GP10 to the Sqlite header
+        db.execute("pragma application_id = 1196437808;")
+        db.close()
+
+    # -------------------------------------------------------------------------
+    def finish_geopackage(self):
+        """Fold the write-ahead log back into a single GeoPackage file"""
+
+        db = connect(self.output)
+        db.execute("pragma journal_mode = delete;")
+        db.close()
+
+    # -------------------------------------------------------------------------
+    def geopackage(self):
+        """Return this process's connection to the GeoPackage output"""
+
+        if self.gpkg_db is None:
+            # Other workers may be committing, so wait for the lock
+            self.gpkg_db = connect(self.output, timeout=600)
+        return self.gpkg_db
+
+    # -------------------------------------------------------------------------
+    def flush_tiles(self):
+        """Commit the tiles written to the GeoPackage output, if any"""
+
+        if self.gpkg_db is not None:
+            self.gpkg_db.commit()
+            self.gpkg_db.close()
+            self.gpkg_db = None
+            self.gpkg_pending = 0
+
+    # -------------------------------------------------------------------------
+    def gpkg_position(self, tz, tx, ty):
+        """Returns the tile_column and tile_row of a tile in the GeoPackage"""
+
+        return gpkg_tile_position(Tile(tx, ty), tz, self.tminmax[self.tminz],
+                                  self.tminz)
+
+    # -------------------------------------------------------------------------
+    def tile_exists(self, tz, tx, ty, tilefilename):
+        """Tells whether a tile has been written already (for --resume)"""
+
+        if not self.gpkg:
+            return path.exists(tilefilename)
+        column, row = self.gpkg_position(tz, tx, ty)
+        return self.geopackage().execute("""
+            SELECT 1 FROM tiles
+            WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?""",
+                                         (tz, column, row)).fetchone() \
+            is not None
+
+    # -------------------------------------------------------------------------
+    def write_tile(self, tz, tx, ty, dstile, tilefilename):
+        """Encode a tile dataset to png/jpg and store it in the output"""
+
+        if not self.gpkg:
+            self.out_drv.CreateCopy(tilefilename, dstile, strict=0)
+            return
+
+        # Encode into GDAL's in-memory file system instead of a file
+        memfilename = '/vsimem/%s/%s/%s.%s' % (tz, tx, ty, self.tileext)
+        self.out_drv.CreateCopy(memfilename, dstile, strict=0)
+        memfile = gdal.VSIFOpenL(memfilename, 'rb')
+        gdal.VSIFSeekL(memfile, 0, 2)
+        size = gdal.VSIFTellL(memfile)
+        gdal.VSIFSeekL(memfile, 0, 0)
+        data = gdal.VSIFReadL(1, size, memfile)
+        gdal.VSIFCloseL(memfile)
+        gdal.Unlink(memfilename)
+        if gdal.VSIStatL(memfilename + '.aux.xml') is not None:
+            gdal.Unlink(memfilename + '.aux.xml')
+
+        column, row = self.gpkg_position(tz, tx, ty)
+        db = self.geopackage()
+        db.execute("""
+            INSERT OR REPLACE INTO tiles
+                (zoom_level, tile_column, tile_row, tile_data)
+            VALUES (?, ?, ?, ?)""", (tz, column, row, Binary(data)))
+        self.gpkg_pending += 1
+        if self.gpkg_pending >= GPKG_BATCH_TILES:
+            db.commit()
+            self.gpkg_pending = 0
+
+    # -------------------------------------------------------------------------
+    def read_tile(self, tz, tx, ty):
+        """Returns the pixels of a tile of a lower level of the pyramid"""
+
+        if not self.gpkg:
+            dsquerytile = gdal.Open(
+                path.join(self.output, str(tz), str(tx),
+                          "%s.%s" % (ty, self.tileext)), gdal.GA_ReadOnly)
+            return dsquerytile.ReadRaster(0, 0, self.tilesize, self.tilesize)
+
+        column, row = self.gpkg_position(tz, tx, ty)
+        data = self.geopackage().execute("""
+            SELECT tile_data FROM tiles
+            WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?""",
+                                         (tz, column, row)).fetchone()[0]
+        # Decode from GDAL's in-memory file system instead of a file
+        memfilename = '/vsimem/%s/%s/%s.%s' % (tz, tx, ty, self.tileext)
+        gdal.FileFromMemBuffer(memfilename, bytes(data))
+        dsquerytile = gdal.Open(memfilename, gdal.GA_ReadOnly)
+        raster = dsquerytile.ReadRaster(0, 0, self.tilesize, self.tilesize)
+        del dsquerytile
+        gdal.Unlink(memfilename)
+        return raster
+
     # -------------------------------------------------------------------------
     def generate_tilemapresource(self):
         """
@@ -2886,6 +3153,9 @@ def main(argv=None):
             pool.join()
             print("\tZoom level " + str(tz) + " complete.")
         print("Overview tile generation complete")
+        if gdal2tiles.gpkg:
+            gdal2tiles.finish_geopackage()
+            print("GeoPackage written to " + gdal2tiles.output)
 
 
 if __name__ == '__main__':
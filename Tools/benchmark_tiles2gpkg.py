@@ -0,0 +1,314 @@
+#!/usr/bin/python3
+"""
+Benchmark of the stages of tiles2gpkg_parallel.py on a tile tree, such as
+one made by generate_pyramid.py.  The stages run one after another in this
+process, each on all of the tiles, so their times add up and do not depend
+on the number of cores:
+
+    scan       -- list the tile tree (scan_tiles())
+    build_lut  -- build the tile matrix of every zoom level (build_lut())
+    read       -- read every tile file, which also warms the page cache
+    encode     -- read and decode/encode every tile (worker_map())
+    insert     -- buffer and write the tiles into .gpkg.part files (TempDB)
+    merge      -- merge the part files into the geopackage
+    optimize   -- write the metadata and ANALYZE the geopackage
+
+Each run is appended as one JSON line to the results file, with the commit
+it ran on, so regressions show up between commits.  The stages are compared
+to the last earlier run of the same tiles and options.
+
+    python3 Tools/generate_pyramid.py /tmp/bench -tiles 100000
+    python3 Tools/benchmark_tiles2gpkg.py /tmp/bench -imagery mixed
+
+Requires: Python 3
+"""
+
+from argparse import ArgumentParser
+from datetime import datetime
+from json import dumps, loads
+from multiprocessing import cpu_count
+from os.path import abspath, dirname, exists, join
+from platform import platform, python_version
+from shutil import rmtree
+from subprocess import CalledProcessError, PIPE, check_output
+from sys import executable, path
+from tempfile import mkdtemp
+from time import perf_counter
+
+ROOT = join(dirname(abspath(__file__)), "..")
+path.append(join(ROOT, "Packaging"))
+import tiles2gpkg_parallel
+from tiles2gpkg_parallel import ENCODE_CACHE_BYTES, EncodeCache, Geopackage, \
+    SCAN_THREADS, TempDB, build_lut, choose_page_size, combine_worker_dbs, \
+    get_invert_y, read_tile, sample_tile_sizes, scan_tiles, \
+    scan_zoom_levels, sniff_format, worker_map
+
+STAGES = ('scan', 'build_lut', 'read', 'encode', 'insert', 'merge',
+          'optimize')
+# Tiles are encoded into one .gpkg.part file per CHUNK_TILES tiles
+CHUNK_TILES = 4096
+# Stages that take this much longer than in the previous run are flagged
+REGRESSION = 0.1
+
+
+class TimedSink(object):
+    """TempDB wrapper that adds up the time spent writing tiles."""
+
+    def __init__(self, temp_db):
+        self.temp_db = temp_db
+        self.seconds = 0.0
+
+    def insert_image_blob(self, z, x, y, data):
+        start = perf_counter()
+        self.temp_db.insert_image_blob(z, x, y, data)
+        self.seconds += perf_counter() - start
+
+    def flush(self):
+        start = perf_counter()
+        self.temp_db.flush()
+        self.seconds += perf_counter() - start
+
+
+def git_commit():
+    """Return the (commit, dirty) state of the checkout, or (None, None)."""
+    try:
+        commit = check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT,
+                              stderr=PIPE).decode().strip()
+        dirty = bool(check_output(['git', 'status', '--porcelain',
+                                   '--untracked-files=no'], cwd=ROOT,
+                                  stderr=PIPE).strip())
+        return commit, dirty
+    except (OSError, CalledProcessError):
+        return None, None
+
+
+def run_stages(source, work_dir, options):
+    """
+    Run the stages once on a tile tree.
+
+    Inputs:
+    source -- the tile tree
+    work_dir -- an empty folder for the part files and the geopackage
+    options -- the parsed command line
+
+    Returns:
+    A (stage seconds, source description) tuple of dictionaries.
+    """
+    lower_left = options.tileorigin in ('ll', 'sw')
+    seconds = {}
+    start = perf_counter()
+    zoom_levels = scan_zoom_levels(source)
+    tiles = list(scan_tiles(source, zoom_levels, options.scan_threads))
+    seconds['scan'] = perf_counter() - start
+    start = perf_counter()
+    tile_info = build_lut(tiles, lower_left, options.srs, zoom_levels)
+    seconds['build_lut'] = perf_counter() - start
+    formats = {}
+    bytes_in = 0
+    start = perf_counter()
+    for tile in tiles:
+        data = read_tile(tile['path'], options.use_mmap)
+        bytes_in += len(data)
+        kind = sniff_format(data) or 'other'
+        formats[kind] = formats.get(kind, 0) + 1
+    seconds['read'] = perf_counter() - start
+    page_size = options.page_size or \
+        choose_page_size(sample_tile_sizes(source, zoom_levels))
+    # worker_map() uses the encode cache of its worker process
+    tiles2gpkg_parallel._ENCODE_CACHE = EncodeCache(options.encode_cache) \
+        if options.encode_cache else None
+    extra_args = dict(tile_info=tile_info, imagery=options.imagery,
+                      jpeg_quality=options.q, skip_empty=options.skip_empty,
+                      use_mmap=options.use_mmap)
+    invert_y = get_invert_y(lower_left, options.srs)
+    parts = []
+    worker_seconds = insert_seconds = 0.0
+    bytes_out = 0
+    for first in range(0, len(tiles), options.chunk):
+        with TempDB(work_dir, page_size=page_size) as temp_db:
+            sink = TimedSink(temp_db)
+            start = perf_counter()
+            for tile in tiles[first:first + options.chunk]:
+                bytes_out += worker_map(sink, tile, extra_args, invert_y)[1]
+            sink.flush()
+            worker_seconds += perf_counter() - start
+            insert_seconds += sink.seconds
+        parts.append(temp_db.file_path)
+    seconds['encode'] = worker_seconds - insert_seconds
+    seconds['insert'] = insert_seconds
+    output = join(work_dir, 'benchmark.gpkg')
+    gpkg = Geopackage(output, options.srs, page_size=page_size)
+    start = perf_counter()
+    # Merged part files are removed
+    combine_worker_dbs(gpkg, parts)
+    seconds['merge'] = perf_counter() - start
+    start = perf_counter()
+    gpkg.update_metadata(tile_info)
+    gpkg.close()
+    output_bytes = Geopackage.optimize(output)
+    seconds['optimize'] = perf_counter() - start
+    described = dict(tiles=len(tiles), bytes=bytes_in, formats=formats,
+                     zoom_levels=zoom_levels, page_size=page_size,
+                     bytes_out=bytes_out, output_bytes=output_bytes)
+    return seconds, described
+
+
+def run_pipeline(source, work_dir, options):
+    """
+    Run tiles2gpkg_parallel.py on the tile tree with all cores and return
+    the summary line it prints.
+    """
+    output = join(work_dir, 'pipeline.gpkg')
+    command = [executable, join(ROOT, "Packaging", "tiles2gpkg_parallel.py"),
+               source, output, '-srs', str(options.srs), '-tileorigin',
+               options.tileorigin, '-imagery', options.imagery,
+               '-q', str(options.q), '-encode-cache',
+               str(options.encode_cache)]
+    if options.skip_empty:
+        command.append('-skip-empty')
+    if options.use_mmap:
+        command.append('-mmap')
+    if options.page_size:
+        command += ['-page-size', str(options.page_size)]
+    summary = loads(check_output(command).decode().splitlines()[-1])
+    summary.pop('output')
+    return summary
+
+
+def previous_run(results_file, record):
+    """
+    Return the last run in a results file of the same tiles and options as
+    record, or None.
+    """
+    if not exists(results_file):
+        return None
+    match = None
+    with open(results_file) as results:
+        for line in results:
+            if not line.strip():
+                continue
+            run = loads(line)
+            if run.get('options') == record['options'] and \
+                    run.get('source', {}).get('tiles') == \
+                    record['source']['tiles'] and \
+                    run.get('source', {}).get('bytes') == \
+                    record['source']['bytes']:
+                match = run
+    return match
+
+
+def report(record, previous):
+    """Print the stages of a run and their change since the previous one."""
+    if previous is not None:
+        print("Compared to {} on {}".format(
+            (previous.get('commit') or 'unknown commit')[:10],
+            previous['time']))
+    tiles = record['source']['tiles']
+    for stage in STAGES:
+        seconds = record['stages'][stage]['seconds']
+        line = "{:10} {:9.3f}s {:12.0f} tiles/s".format(
+            stage, seconds, tiles / seconds if seconds else 0.0)
+        if previous is not None and stage in previous['stages']:
+            before = previous['stages'][stage]['seconds']
+            if before:
+                change = seconds / before - 1
+                line += "  {:+6.1f}%".format(100 * change)
+                if change > REGRESSION:
+                    line += "  slower"
+        print(line)
+
+
+def main(options):
+    """Run the benchmark, append it to the results file and report it."""
+    source = abspath(options.source)
+    best = {}
+    described = None
+    pipeline = None
+    for _ in range(options.repeat):
+        work_dir = mkdtemp(dir=options.work_dir)
+        try:
+            seconds, described = run_stages(source, work_dir, options)
+            for stage, value in seconds.items():
+                best[stage] = min(value, best.get(stage, value))
+        finally:
+            rmtree(work_dir)
+    if options.full:
+        work_dir = mkdtemp(dir=options.work_dir)
+        try:
+            pipeline = run_pipeline(source, work_dir, options)
+        finally:
+            rmtree(work_dir)
+    commit, dirty = git_commit()
+    record = dict(
+        time=datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+        commit=commit,
+        dirty=dirty,
+        python=python_version(),
+        platform=platform(),
+        cpus=cpu_count(),
+        source=dict(described, path=source),
+        options=dict(srs=options.srs, tileorigin=options.tileorigin,
+                     imagery=options.imagery, q=options.q,
+                     skip_empty=options.skip_empty,
+                     encode_cache=options.encode_cache,
+                     use_mmap=options.use_mmap, chunk=options.chunk,
+                     page_size=options.page_size),
+        repeat=options.repeat,
+        stages=dict((stage, dict(
+            seconds=round(best[stage], 4),
+            tiles_per_second=round(described['tiles'] / best[stage], 1)
+            if best[stage] else None)) for stage in STAGES),
+        pipeline=pipeline)
+    previous = previous_run(options.results, record)
+    with open(options.results, 'a') as results:
+        results.write(dumps(record, sort_keys=True) + '\n')
+    print("")
+    report(record, previous)
+    if pipeline is not None:
+        print("{:10} {:9.3f}s {:12.0f} tiles/s on {} cores".format(
+            'pipeline', pipeline['seconds'],
+            pipeline['tiles'] / pipeline['seconds'], cpu_count()))
+    return record
+
+
+if __name__ == '__main__':
+    PARSER = ArgumentParser(description="Benchmark the stages of " +
+                            "tiles2gpkg_parallel.py")
+    PARSER.add_argument("source",
+                        help="Tile tree to package, e.g. made by " +
+                        "generate_pyramid.py.")
+    PARSER.add_argument("-results", default="benchmark_results.jsonl",
+                        help="File the runs are appended to, one JSON " +
+                        "line each.")
+    PARSER.add_argument("-srs", type=int, choices=[3857, 4326, 3395, 9804],
+                        default=3857)
+    PARSER.add_argument("-tileorigin", choices=["ll", "ul", "sw", "nw"],
+                        default="ll")
+    PARSER.add_argument("-imagery", choices=["mixed", "jpeg", "png", "source"],
+                        default="source")
+    PARSER.add_argument("-q", type=int, default=75,
+                        help="Quality of the JPEGs encoded.")
+    PARSER.add_argument("-skip-empty", dest="skip_empty",
+                        action="store_true", default=False)
+    PARSER.add_argument("-encode-cache", dest="encode_cache", type=int,
+                        default=ENCODE_CACHE_BYTES,
+                        help="Size of the encode cache in bytes, 0 to " +
+                        "disable it.")
+    PARSER.add_argument("-mmap", dest="use_mmap", action="store_true",
+                        default=False)
+    PARSER.add_argument("-page-size", dest="page_size", type=int, default=0,
+                        help="Page size of the databases; chosen from the " +
+                        "tiles by default.")
+    PARSER.add_argument("-chunk", type=int, default=CHUNK_TILES,
+                        help="Tiles per .gpkg.part file.")
+    PARSER.add_argument("-scan-threads", dest="scan_threads", type=int,
+                        default=SCAN_THREADS)
+    PARSER.add_argument("-repeat", type=int, default=1,
+                        help="Run the stages this many times and keep the " +
+                        "fastest time of each.")
+    PARSER.add_argument("-full", action="store_true", default=False,
+                        help="Also time a whole tiles2gpkg_parallel.py run " +
+                        "on all cores.")
+    PARSER.add_argument("-work-dir", dest="work_dir", default=None,
+                        help="Folder for the temporary files.")
+    main(PARSER.parse_args())
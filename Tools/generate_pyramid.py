@@ -0,0 +1,282 @@
+#!/usr/bin/python3
+"""
+Generates a synthetic TMS or WMTS tile tree for benchmarking
+tiles2gpkg_parallel.py, from a few thousand to tens of millions of tiles.
+Each tile is one of these kinds, drawn at random by weight:
+
+    opaque       -- a fully opaque PNG, or a JPEG (see -jpeg)
+    transparent  -- a PNG whose left half is transparent
+    empty        -- a fully transparent PNG
+    duplicate    -- a byte-for-byte copy of one of a few common tiles
+
+Tiles of the first three kinds are built from a handful of templates and
+made unique with a comment chunk, so that only the duplicates share bytes.
+PNGs are written with zlib alone; JPEGs need PIL.
+
+    python3 Tools/generate_pyramid.py /tmp/bench -tiles 100000 \\
+        -mix opaque=70,transparent=15,empty=10,duplicate=5 -jpeg 0.5
+
+Requires: Python 3, PIL for JPEG tiles
+"""
+
+from argparse import ArgumentParser
+from errno import EEXIST
+from io import BytesIO
+from multiprocessing.pool import ThreadPool
+from os import makedirs
+from os.path import abspath, dirname, join
+from random import Random
+from struct import pack
+from sys import path, stdout
+from time import time
+from zlib import compress, crc32
+
+path.append(join(dirname(abspath(__file__)), "..", "Packaging"))
+from gpkg2tiles_parallel import write_tile
+from tiles2gpkg_parallel import PROGRESS_INTERVAL, progress_line
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+TILE_SIZE = 256
+KINDS = ('opaque', 'transparent', 'empty', 'duplicate')
+DEFAULT_MIX = 'opaque=70,transparent=15,empty=10,duplicate=5'
+# Number of templates of each kind, and of common tiles that duplicates copy
+TEMPLATES = 8
+COMMON_TILES = 4
+# Tiles are written a tile column at a time by WRITER_THREADS threads
+WRITER_THREADS = 8
+
+
+def png_chunk(kind, data):
+    """Return a PNG chunk with its length and CRC."""
+    return pack('>I', len(data)) + kind + data + \
+        pack('>I', crc32(kind + data) & 0xffffffff)
+
+
+def png_bytes(rows):
+    """
+    Encode rows of RGBA pixels as a PNG.
+
+    Inputs:
+    rows -- a list of bytes objects, one per pixel row, of 4 bytes a pixel
+    """
+    header = pack('>IIBBBBB', len(rows[0]) // 4, len(rows), 8, 6, 0, 0, 0)
+    raw = b''.join(b'\x00' + row for row in rows)
+    return b'\x89PNG\r\n\x1a\n' + png_chunk(b'IHDR', header) + \
+        png_chunk(b'IDAT', compress(raw, 6)) + png_chunk(b'IEND', b'')
+
+
+def make_pixels(rng, alpha):
+    """
+    Return the pixel rows of a tile of runs of a few random colors, which
+    compress about as well as imagery does.
+
+    Inputs:
+    rng -- the Random to draw from
+    alpha -- a function from the pixel column to its alpha value
+    """
+    palette = [bytearray(rng.getrandbits(8) for _ in range(3))
+               for _ in range(16)]
+    rows = []
+    for _ in range(TILE_SIZE):
+        row = bytearray()
+        while len(row) < 4 * TILE_SIZE:
+            color = rng.choice(palette)
+            for _ in range(rng.randint(1, 12)):
+                column = len(row) // 4
+                if column == TILE_SIZE:
+                    break
+                row += color + bytearray((alpha(column),))
+        rows.append(bytes(row))
+    return rows
+
+
+def jpeg_bytes(rows, quality=75):
+    """Encode rows of RGBA pixels as a JPEG, dropping the alpha channel."""
+    img = Image.frombytes('RGBA', (TILE_SIZE, TILE_SIZE), b''.join(rows))
+    buf = BytesIO()
+    img.convert('RGB').save(buf, 'jpeg', quality=quality)
+    return buf.getvalue()
+
+
+def make_templates(rng, jpeg):
+    """
+    Return a dictionary from tile kind (with 'jpeg' for opaque JPEGs) to a
+    list of encoded template tiles.
+    """
+    templates = dict(opaque=[], transparent=[], empty=[], jpeg=[])
+    for _ in range(TEMPLATES):
+        rows = make_pixels(rng, lambda column: 255)
+        templates['opaque'].append(png_bytes(rows))
+        if jpeg:
+            templates['jpeg'].append(jpeg_bytes(rows))
+        templates['transparent'].append(png_bytes(make_pixels(
+            rng, lambda column: 0 if column < TILE_SIZE // 2 else 255)))
+    templates['empty'].append(png_bytes(
+        [b'\x00' * 4 * TILE_SIZE] * TILE_SIZE))
+    return templates
+
+
+def unique_tile(template, label):
+    """
+    Return a copy of a template tile that differs from every other tile by
+    a comment: a tEXt chunk before the IEND of a PNG, or a COM segment after
+    the SOI marker of a JPEG.  Decoders ignore both.
+    """
+    if template.startswith(b'\xff\xd8'):
+        return template[:2] + b'\xff\xfe' + pack('>H', len(label) + 2) + \
+            label + template[2:]
+    return template[:-12] + png_chunk(b'tEXt', b'tile\x00' + label) + \
+        template[-12:]
+
+
+def parse_mix(spec):
+    """
+    Parse a kind=weight,... string into a list of (kind, cumulative share)
+    tuples.
+    """
+    weights = dict((kind, 0.0) for kind in KINDS)
+    for item in spec.split(','):
+        kind, _, weight = item.partition('=')
+        if kind not in weights:
+            raise ValueError("Unknown tile kind {}, use one of {}".format(
+                kind, ', '.join(KINDS)))
+        weights[kind] = float(weight)
+    total = sum(weights.values())
+    if total <= 0:
+        raise ValueError("The mix needs a positive weight")
+    shares = []
+    cumulative = 0.0
+    for kind in KINDS:
+        cumulative += weights[kind] / total
+        shares.append((kind, cumulative))
+    return shares
+
+
+def pyramid_columns(count, srs=3857):
+    """
+    Lay out a pyramid of about count tiles: whole zoom levels from zoom 0 up,
+    then as many whole columns of the next level as are needed, and part of
+    one more.
+
+    Inputs:
+    count -- the number of tiles
+    srs -- 4326 for the two-tile-wide geodetic grid, anything else for the
+           square Mercator grid
+
+    Returns:
+    A list of (zoom level, x, number of rows) tuples.
+    """
+    columns = []
+    zoom = 0
+    while count > 0:
+        width = 2 ** (zoom + 1) if srs == 4326 else 2 ** zoom
+        height = 2 ** zoom
+        for x in range(width):
+            if count <= 0:
+                break
+            columns.append((zoom, x, min(height, count)))
+            count -= height
+        zoom += 1
+    return columns
+
+
+def generate(dest, count, mix=DEFAULT_MIX, jpeg=0.0, lower_left=True,
+             srs=3857, seed=0, threads=WRITER_THREADS):
+    """
+    Write a synthetic tile tree.
+
+    Inputs:
+    dest -- the root folder of the tree
+    count -- the number of tiles
+    mix -- the weights of the tile kinds, as kind=weight,...
+    jpeg -- the share of the opaque tiles that are JPEGs
+    lower_left -- number the rows from the bottom (TMS) or the top (WMTS)
+    srs -- the spatial reference system whose tile grid is filled
+    seed -- the seed of the random choices
+
+    Returns:
+    A dictionary with the number of tiles of each kind and format, and the
+    number of bytes written.
+    """
+    if jpeg and Image is None:
+        raise ValueError("JPEG tiles need PIL")
+    shares = parse_mix(mix)
+    rng = Random(seed)
+    templates = make_templates(rng, jpeg)
+    common = [unique_tile(templates['opaque'][i % TEMPLATES],
+                          'common {}'.format(i).encode())
+              for i in range(COMMON_TILES)]
+    counts = dict((kind, 0) for kind in KINDS + ('jpeg',))
+    written = done = 0
+    pool = ThreadPool(threads)
+    start = drawn = time()
+    try:
+        for zoom, x, rows in pyramid_columns(count, srs):
+            folder = join(dest, str(zoom), str(x))
+            try:
+                makedirs(folder)
+            except OSError as err:
+                if err.errno != EEXIST:
+                    raise
+            items = []
+            for y in range(rows):
+                draw = rng.random()
+                kind = next(kind for kind, share in shares if draw < share)
+                counts[kind] += 1
+                if kind == 'duplicate':
+                    data = rng.choice(common)
+                else:
+                    if kind == 'opaque' and rng.random() < jpeg:
+                        counts['jpeg'] += 1
+                        kind = 'jpeg'
+                    data = unique_tile(rng.choice(templates[kind]),
+                                       '{}/{}/{}'.format(zoom, x, y).encode())
+                if not lower_left:
+                    y = 2 ** zoom - 1 - y
+                ext = '.jpg' if data.startswith(b'\xff\xd8') else '.png'
+                items.append((join(folder, str(y) + ext), data))
+            written += sum(pool.map(write_tile, items,
+                                    max(1, len(items) // (4 * threads))))
+            done += len(items)
+            if time() - drawn >= PROGRESS_INTERVAL or done == count:
+                drawn = time()
+                stdout.write("\rGenerate: " + progress_line(
+                    done, count, drawn - start, bytes_out=written))
+                stdout.flush()
+    finally:
+        pool.close()
+        pool.join()
+    print("")
+    counts['bytes'] = written
+    return counts
+
+
+if __name__ == '__main__':
+    PARSER = ArgumentParser(description="Generate a synthetic tile tree " +
+                            "for benchmarks")
+    PARSER.add_argument("dest",
+                        help="Folder to write the tiles into.")
+    PARSER.add_argument("-tiles", type=int, default=10000,
+                        help="Number of tiles.")
+    PARSER.add_argument("-mix", default=DEFAULT_MIX,
+                        help="Weights of the tile kinds, as kind=weight,... " +
+                        "with kinds " + ", ".join(KINDS) + ".")
+    PARSER.add_argument("-jpeg", type=float, default=0.0,
+                        help="Share of the opaque tiles written as JPEGs.")
+    PARSER.add_argument("-tileorigin", choices=["ll", "ul", "sw", "nw"],
+                        default="ll",
+                        help="Tile point of origin of the tree.")
+    PARSER.add_argument("-srs", type=int, choices=[3857, 4326, 3395, 9804],
+                        default=3857,
+                        help="Spatial reference system of the tile grid.")
+    PARSER.add_argument("-seed", type=int, default=0)
+    PARSER.add_argument("-threads", type=int, default=WRITER_THREADS,
+                        help="Number of threads writing files.")
+    ARGS = PARSER.parse_args()
+    print(generate(ARGS.dest, ARGS.tiles, ARGS.mix, ARGS.jpeg,
+                   ARGS.tileorigin in ('ll', 'sw'), ARGS.srs, ARGS.seed,
+                   ARGS.threads))
@@ -0,0 +1,123 @@
+#!/usr/bin/python3
+"""
+Load test for gpkg_server.py.  Requests tiles that exist in a geopackage
+from a running server over keep-alive connections, and reports the request
+rate and the latency percentiles.
+
+    python3 Packaging/gpkg_server.py out.gpkg &
+    python3 Tools/gpkg_server_loadtest.py out.gpkg -requests 20000
+
+Requires: Python 3.7 or later
+"""
+
+from argparse import ArgumentParser
+from asyncio import gather, open_connection, run
+from collections import Counter
+from os.path import abspath, dirname, join
+from random import Random
+from sys import path
+from time import perf_counter
+
+path.append(join(dirname(abspath(__file__)), "..", "Packaging"))
+from tiles2gpkg_parallel import GeopackageReader
+
+
+def sample_tiles(file_path, table, lower_left, count, seed=0):
+    """
+    Return up to count (z, x, y) keys of tiles in a tile table, sampled
+    uniformly from all of its tiles.
+    """
+    rng = Random(seed)
+    keys = []
+    with GeopackageReader(file_path, table, lower_left,
+                          cache_bytes=0) as reader:
+        for seen, (z, x, y, _) in enumerate(reader.iter_zoom_range()):
+            if seen < count:
+                keys.append((z, x, y))
+            else:
+                slot = rng.randint(0, seen)
+                if slot < count:
+                    keys[slot] = (z, x, y)
+    return keys
+
+
+async def client(host, port, paths, latencies, statuses):
+    """Request paths one after another on one keep-alive connection."""
+    reader, writer = await open_connection(host, port)
+    for request_path in paths:
+        start = perf_counter()
+        writer.write("GET {} HTTP/1.1\r\nHost: {}\r\n\r\n".format(
+            request_path, host).encode())
+        head = await reader.readuntil(b'\r\n\r\n')
+        lines = head.decode('latin-1').split('\r\n')
+        length = 0
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            if name.lower() == 'content-length':
+                length = int(value)
+        await reader.readexactly(length)
+        latencies.append(perf_counter() - start)
+        statuses[int(lines[0].split()[1])] += 1
+    writer.close()
+
+
+def percentile(ordered, share):
+    """Return a percentile of a sorted list of values."""
+    return ordered[min(len(ordered) - 1, int(share * len(ordered)))]
+
+
+async def load(arg_list, keys):
+    """Run the clients and return (seconds, latencies, statuses)."""
+    rng = Random(arg_list.seed)
+    paths = ["/{}/{}/{}/{}".format(arg_list.table, *rng.choice(keys))
+             for _ in range(arg_list.requests)]
+    latencies = []
+    statuses = Counter()
+    share = -(-len(paths) // arg_list.connections)
+    start = perf_counter()
+    await gather(*[client(arg_list.host, arg_list.port,
+                          paths[i:i + share], latencies, statuses)
+                   for i in range(0, len(paths), share)])
+    return perf_counter() - start, latencies, statuses
+
+
+def main(arg_list):
+    """Sample tiles, load the server and print a report."""
+    keys = sample_tiles(arg_list.gpkg, arg_list.table,
+                        arg_list.tileorigin in ('ll', 'sw'), arg_list.sample,
+                        arg_list.seed)
+    if not keys:
+        print("{} has no tiles in {}".format(arg_list.gpkg, arg_list.table))
+        return
+    seconds, latencies, statuses = run(load(arg_list, keys))
+    latencies.sort()
+    print("{} requests over {} connections in {:.2f}s: {:.0f} req/s".format(
+        len(latencies), arg_list.connections, seconds,
+        len(latencies) / seconds))
+    print("latency ms: p50 {:.2f}  p90 {:.2f}  p99 {:.2f}  max {:.2f}".format(
+        *[1000 * percentile(latencies, share)
+          for share in (0.5, 0.9, 0.99, 1.0)]))
+    print("status: " + ", ".join("{} x{}".format(status, count)
+                                 for status, count in sorted(
+                                     statuses.items())))
+
+
+if __name__ == '__main__':
+    PARSER = ArgumentParser(description="Load test a gpkg_server.py " +
+                            "instance")
+    PARSER.add_argument("gpkg",
+                        help="The geopackage the server serves, to pick " +
+                        "existing tiles from.")
+    PARSER.add_argument("-table", default="tiles",
+                        help="Tile table to request.")
+    PARSER.add_argument("-host", default="127.0.0.1")
+    PARSER.add_argument("-port", type=int, default=8080)
+    PARSER.add_argument("-tileorigin", choices=["ll", "ul", "sw", "nw"],
+                        default="ul",
+                        help="Tile origin the server was started with.")
+    PARSER.add_argument("-requests", type=int, default=10000)
+    PARSER.add_argument("-connections", type=int, default=32)
+    PARSER.add_argument("-sample", type=int, default=10000,
+                        help="Number of distinct tiles to request.")
+    PARSER.add_argument("-seed", type=int, default=0)
+    main(PARSER.parse_args())